@@ -57,8 +57,16 @@
 import subprocess
 import logging
 import os
+import stat
+import json
+import threading
+import time
 import rocks.db.helper
 
+# the rocks commands import this package, the modules only the daemons
+# need (tornado, metrics, profiler, logging setup) are imported by
+# imgstorage.imgstoragedaemon
+
 
 class ActionError(Exception):
 
@@ -70,11 +78,25 @@ class ZvolBusyActionError(ActionError):
     pass
 
 
+# called as command_tracker(params, start, returncode, output) for every
+# command run, imgstoragedaemon sets it to count and profile the commands
+# of the daemons
+
+command_tracker = None
+
+
+def _track(params, start, returncode=None, output=0):
+    if command_tracker is not None:
+        command_tracker(params, start, returncode, output)
+
+
 def runCommand(params, params2=None, shell=False):
+    start = time.time()
     try:
         cmd = subprocess.Popen(params, stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE, shell=shell)
     except OSError, e:
+        _track(params, start)
         raise ActionError('Command %s failed: %s' % (params[0], str(e)))
 
     if params2:
@@ -83,40 +105,21 @@ def runCommand(params, params2=None, shell=False):
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.PIPE, shell=shell)
         except OSError, e:
+            _track(params2, start)
             raise ActionError('Command %s failed: %s' % (params2[0],
                               str(e)))
         cmd.stdout.close()
-        (out, err) = cmd2.communicate()
-        if cmd2.returncode:
-            raise ActionError('Error executing %s: %s' % (params2[0],
-                              err))
-        else:
-            return out.splitlines()
-    else:
-
-        (out, err) = cmd.communicate()
-        if cmd.returncode:
-            raise ActionError('Error executing %s: %s' % (params[0],
-                              err))
-        else:
-            return out.splitlines()
-
 
-def setupLogger(logger):
-    formatter = \
-        logging.Formatter("'%(levelname) -10s %(asctime)s %(name) -30s %(funcName) -35s %(lineno) -5d: %(message)s'"
-                          )
-    handler = logging.FileHandler('/var/log/rocks/img-storage.log')
-    handler.setFormatter(formatter)
+        # the status of the pipeline is the one of its last command
 
-    # for log_name in (logger, 'pika.channel', 'pika.connection', 'rabbit_client.RabbitMQClient'):
+        (params, cmd) = (params2, cmd2)
 
-    for log_name in [logger, 'rabbit_client.RabbitMQCommonClient',
-                     'tornado.application']:
-        logging.getLogger(log_name).setLevel(logging.DEBUG)
-        logging.getLogger(log_name).addHandler(handler)
-
-    return handler
+    (out, err) = cmd.communicate()
+    _track(params, start, cmd.returncode, len(out))
+    if cmd.returncode:
+        raise ActionError('Error executing %s: %s' % (params[0], err))
+    else:
+        return out.splitlines()
 
 
 def get_attribute(attr_name, hostname, logger=None):
@@ -143,26 +146,332 @@ def get_attribute(attr_name, hostname, logger=None):
         db.closeSession()
 
 
+class AttributeCache:
+
+    """
+    Cache of the Rocks host attributes read by the daemons.
+
+    All the attributes of a host are read with a single getHostAttrs call
+    and kept for ttl seconds, so the message and sync paths do not open a
+    database connection for every lookup. When an entry expires, all the
+    expired hosts are reloaded together over one connection. The database
+    is read without holding the lock: the other lookups go on with the
+    cached values, a lookup of a host being loaded by another thread
+    returns the old value or, if there is none, waits for the load.
+    invalidate() drops the cached values, the daemons call it on SIGHUP.
+    """
+
+    TTL = 300
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl or self.TTL
+        self.lock = threading.Condition()
+
+        # canonical host name -> (load time, attributes) and the names
+        # used by the callers (None is this host) -> canonical name
+
+        self.hosts = {}
+        self.names = {}
+
+        # names being loaded, and a counter of the invalidations so that
+        # a load started before one is not stored
+
+        self.loading = set()
+        self.generation = 0
+
+    def load(self, hostnames):
+        """read the attributes of hostnames, return a dictionary name ->
+        (canonical name, attributes) without the hosts not found"""
+
+        db = rocks.db.helper.DatabaseHelper()
+        db.connect()
+        loaded = {}
+        try:
+            for hostname in hostnames:
+                try:
+                    name = str(db.getHostname(hostname))
+                    loaded[hostname] = (name, db.getHostAttrs(name))
+                except Exception:
+
+                    # the host was removed, it is loaded again if asked
+
+                    continue
+        finally:
+            db.close()
+            db.closeSession()
+        return loaded
+
+    def store(
+        self,
+        hostnames,
+        loaded,
+        now,
+        ):
+        for hostname in hostnames:
+            if hostname in loaded:
+                (name, attrs) = loaded[hostname]
+                self.hosts[name] = (now, attrs)
+                self.names[hostname] = name
+            else:
+                self.names.pop(hostname, None)
+
+    def expired(self, hostname, now):
+        entry = self.hosts.get(self.names.get(hostname))
+        return not entry or now - entry[0] >= self.ttl
+
+    def get(
+        self,
+        attr_name,
+        hostname=None,
+        logger=None,
+        ):
+        """return the value of attr_name for the hostname"""
+
+        try:
+            while True:
+                with self.lock:
+                    now = time.time()
+                    entry = self.hosts.get(self.names.get(hostname))
+                    if hostname in self.loading:
+                        if entry:
+                            return entry[1].get(attr_name)
+                        self.lock.wait()
+                        continue
+                    if not self.expired(hostname, now):
+                        return entry[1].get(attr_name)
+                    hostnames = set([hostname] + [name for name in
+                                    self.names.keys()
+                                    if self.expired(name, now)])
+                    hostnames -= self.loading
+                    self.loading |= hostnames
+                    generation = self.generation
+
+                loaded = None
+                try:
+                    loaded = self.load(hostnames)
+                finally:
+                    with self.lock:
+                        self.loading -= hostnames
+                        if loaded is not None and generation \
+                            == self.generation:
+                            self.store(hostnames, loaded, now)
+                        self.lock.notify_all()
+                if hostname not in loaded:
+                    raise ActionError('Host not found')
+                return loaded[hostname][1].get(attr_name)
+        except Exception, e:
+            error = 'Unable to get attribute %s for host %s (%s)' \
+                % (attr_name, hostname, str(e))
+            if logger:
+                logger.exception(error)
+            raise ActionError(error)
+
+    def invalidate(self, hostname=None):
+        """forget the attributes of hostname, or of all the hosts"""
+
+        with self.lock:
+            self.generation += 1
+            if hostname is None:
+                self.hosts.clear()
+                self.names.clear()
+            else:
+                self.hosts.pop(self.names.pop(hostname, hostname), None)
+
+
+host_attributes = AttributeCache()
+
+
+class FileUsage:
+
+    """
+    Tells whether a file or a block device is held open, without forking
+    fuser.
+
+    The identity of the file (device number for block devices, inode
+    otherwise) is read once, every check then compares it against the
+    open file descriptors in /proc/<pid>/fd. Block devices stacked on top
+    of the device (listed in the sysfs holders directory) count as users
+    too. The descriptor found at the last check is tried first, so
+    polling a device that stays open does not rescan /proc.
+    """
+
+    def __init__(self, path, proc='/proc', sysfs='/sys/dev/block'):
+        self.path = path
+        self.proc = proc
+        st = os.stat(path)
+        self.block = stat.S_ISBLK(st.st_mode)
+        if self.block:
+            self.key = st.st_rdev
+            self.holders = os.path.join(sysfs, '%d:%d'
+                    % (os.major(st.st_rdev), os.minor(st.st_rdev)),
+                    'holders')
+        else:
+            self.key = (st.st_dev, st.st_ino)
+            self.holders = None
+        self.last = None
+
+    def matches(self, fd):
+        try:
+            st = os.stat(fd)
+        except OSError:
+
+            # process or descriptor went away while we were looking
+
+            return False
+        if self.block:
+            return stat.S_ISBLK(st.st_mode) and st.st_rdev == self.key
+        return (st.st_dev, st.st_ino) == self.key
+
+    def holder(self):
+        """return the /proc fd entry (or sysfs holders directory) keeping
+        the file open, None if nobody uses it"""
+
+        if self.last and self.matches(self.last):
+            return self.last
+        self.last = None
+
+        if self.holders:
+            try:
+                if os.listdir(self.holders):
+                    return self.holders
+            except OSError:
+                pass
+
+        for pid in os.listdir(self.proc):
+            if not pid.isdigit():
+                continue
+            fd_dir = os.path.join(self.proc, pid, 'fd')
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue
+            for fd in fds:
+                fd = os.path.join(fd_dir, fd)
+                if self.matches(fd):
+                    self.last = fd
+                    return fd
+        return None
+
+    def is_used(self):
+        return self.holder() is not None
+
+
 def isFileUsed(file):
     """return true if file is in use otherwise false"""
 
-    ret = os.system('fuser %s' % file)
-    returnValue = ret >> 5
-    if returnValue:
+    try:
+        return FileUsage(file).is_used()
+    except OSError:
+
+        # a file which does not exist is not used
+
         return False
-    else:
 
-        # fuser fails if the file is unused
 
-        return True
+class LazyNodeConfig:
+
+    """
+    Configuration of this node, read from the Rocks database the first
+    time one of its values is used.
+
+    Importing imgstorage does not touch the database, so the rocks
+    commands which never need these values do not pay for the queries.
+    The values are saved in cache_file and read from there while it is
+    younger than max_age seconds; when the database can not be reached
+    an older cache file is used as well. The daemons call refresh() when
+    they start, so they never run with an attribute from the cache.
+    """
+
+    # value name -> host attribute, NODE_NAME is the host name
+
+    ATTRIBUTES = {'IB_NET': 'IB_net',
+                  'VM_CONTAINER_ZPOOL': 'vm_container_zpool',
+                  'IMG_SYNC_WORKERS': 'img_sync_workers',
+                  'IMG_METRICS_PORT': 'img_metrics_port',
+                  'IMG_PROFILE': 'img_profile',
+                  'IMG_LOG_LEVELS': 'img_log_levels'}
+
+    def __init__(self, cache_file='/opt/rocks/var/img_storage_node.json',
+                 max_age=3600):
+        self.cache_file = cache_file
+        self.max_age = max_age
+        self.values = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name != 'NODE_NAME' and name not in self.ATTRIBUTES:
+            raise AttributeError(name)
+        with self.lock:
+            if self.values is None:
+                self.values = self.load()
+            return self.values.get(name)
+
+    def load(self, max_age=None):
+        if max_age is None:
+            max_age = self.max_age
+        try:
+            if time.time() - os.path.getmtime(self.cache_file) \
+                < max_age:
+                values = self.read_cache()
+
+                # a cache written before an attribute was added is stale
+
+                if set(self.ATTRIBUTES) <= set(values):
+                    return values
+        except (OSError, IOError, ValueError):
+            pass
+
+        try:
+            values = self.read_db()
+        except Exception:
+            logging.getLogger('imgstorage.NodeConfig').warning('Unable to read the node configuration from the database, using %s'
+                     % self.cache_file, exc_info=True)
+            return self.read_cache()
+
+        try:
+            tmp_file = '%s.%s' % (self.cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(values, f)
+            os.rename(tmp_file, self.cache_file)
+        except (OSError, IOError):
+
+            # not running as root, the cache is only an optimization
+
+            pass
+        return values
+
+    def read_cache(self):
+        with open(self.cache_file) as f:
+            return dict((str(name), (str(value) if value is not None else
+                        None)) for (name, value) in json.load(f).items())
+
+    def read_db(self):
+        db = rocks.db.helper.DatabaseHelper()
+        db.connect()
+        try:
+            values = {'NODE_NAME': db.getHostname()}
+            for (name, attr) in self.ATTRIBUTES.items():
+                values[name] = db.getHostAttr(values['NODE_NAME'], attr)
+            return values
+        finally:
+            db.close()
+
+    def refresh(self):
+        """read the values from the database now, the cache file is only
+        used when the database can not be reached"""
+
+        with self.lock:
+            self.values = self.load(max_age=0)
+
+    def reload(self):
+        """read the values from the database on the next use"""
+
+        with self.lock:
+            self.values = None
+            try:
+                os.remove(self.cache_file)
+            except OSError:
+                pass
+
 
-class NodeConfig:
-    db = rocks.db.helper.DatabaseHelper()
-    db.connect()
-    NODE_NAME = db.getHostname()
-    IB_NET = db.getHostAttr(db.getHostname(), 'IB_net')
-    VM_CONTAINER_ZPOOL = db.getHostAttr(db.getHostname(),
-            'vm_container_zpool')
-    IMG_SYNC_WORKERS = db.getHostAttr(db.getHostname(),
-            'img_sync_workers')
-    db.close()
+NodeConfig = LazyNodeConfig()
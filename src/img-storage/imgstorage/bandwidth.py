@@ -0,0 +1,193 @@
+#!/opt/rocks/bin/python
+# @Copyright@
+#
+#                               Rocks(r)
+#                        www.rocksclusters.org
+#                        version 5.6 (Emerald Boa)
+#                        version 6.1 (Emerald Boa)
+#
+# Copyright (c) 2000 - 2013 The Regents of the University of California.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement:
+#
+#       "This product includes software developed by the Rocks(r)
+#       Cluster Group at the San Diego Supercomputer Center at the
+#       University of California, San Diego and its contributors."
+#
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of
+# the associated name, interested parties should contact Technology
+# Transfer & Intellectual Property Services, University of California,
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910,
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# @Copyright@
+#
+
+import logging
+import threading
+import time
+
+
+class Flow:
+
+    """
+    One transfer registered with a BandwidthScheduler. The transfer calls
+    throttle after moving each block of data and is paced at the rate the
+    scheduler currently grants the flow.
+    """
+
+    # seconds of unused bandwidth a flow can catch up on after a stall
+
+    BURST = 0.5
+
+    def __init__(self, scheduler, key):
+        self.scheduler = scheduler
+        self.key = key
+        self.rate = None
+        self.ready = time.time()
+
+    def throttle(self, nbytes):
+        rate = self.rate
+        if not rate:
+            return
+        now = time.time()
+        self.ready = max(self.ready, now - self.BURST) + float(nbytes) \
+            / rate
+        if self.ready > now:
+            time.sleep(self.ready - now)
+
+    def close(self):
+        self.scheduler.close(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BandwidthScheduler:
+
+    """
+    Share the bandwidth of the NAS between the running sync transfers.
+
+    Every transfer opens a flow with a key naming its destination, like
+    (remotehost, 'upload'). The limit of a key is split evenly between
+    its flows and the aggregate limit between all the flows with max-min
+    fairness: the bandwidth a flow can not use because of its key limit
+    goes to the other flows. The rates are recomputed when a flow opens
+    or closes and when a limit changes, so new limits apply to the
+    running transfers. Limits are in bytes per second, None is
+    unlimited. All the methods are safe to call from any thread.
+    """
+
+    def __init__(self, limit=None):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.key_limits = {}
+        self.flows = []
+        self.logger = \
+            logging.getLogger('imgstorage.bandwidth.BandwidthScheduler')
+
+    def open(self, key, limit=None):
+        """register a new flow for key, limit is the limit of the key"""
+
+        flow = Flow(self, key)
+        with self.lock:
+            self.key_limits[key] = limit
+            self.flows.append(flow)
+            self.allocate()
+        return flow
+
+    def close(self, flow):
+        with self.lock:
+            if flow in self.flows:
+                self.flows.remove(flow)
+            if not [f for f in self.flows if f.key == flow.key]:
+                self.key_limits.pop(flow.key, None)
+            self.allocate()
+
+    def keys(self):
+        """keys of the open flows"""
+
+        with self.lock:
+            return list(set(flow.key for flow in self.flows))
+
+    def set_limit(self, limit):
+        with self.lock:
+            if limit != self.limit:
+                self.logger.info('Aggregate transfer limit set to %s'
+                                 % limit)
+            self.limit = limit
+            self.allocate()
+
+    def set_key_limit(self, key, limit):
+        with self.lock:
+            if key in self.key_limits:
+                self.key_limits[key] = limit
+                self.allocate()
+
+    def allocate(self):
+        """compute the rate of every flow, must be called with the lock
+        held"""
+
+        count = {}
+        for flow in self.flows:
+            count[flow.key] = count.get(flow.key, 0) + 1
+
+        def cap(flow):
+            limit = self.key_limits.get(flow.key)
+            return (float(limit) / count[flow.key] if limit else None)
+
+        if not self.limit:
+            for flow in self.flows:
+                flow.rate = cap(flow)
+            return
+
+        # water filling: the flows capped below the fair share keep their
+        # cap and the rest is shared again between the others
+
+        pending = sorted(self.flows, key=lambda f: (cap(f) is None,
+                         cap(f)))
+        remaining = float(self.limit)
+        while pending:
+            share = remaining / len(pending)
+            flow_cap = cap(pending[0])
+            if flow_cap is None or flow_cap > share:
+                for flow in pending:
+                    flow.rate = share
+                break
+            pending[0].rate = flow_cap
+            remaining -= flow_cap
+            pending.pop(0)
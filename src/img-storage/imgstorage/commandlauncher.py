@@ -60,12 +60,229 @@ import pika
 import time
 import json
 import uuid
+import threading
+from multiprocessing.pool import ThreadPool
 from rocks.util import CommandError
 import logging
 from rabbitmqclient import RabbitMQLocator
+from imgstorage import tracing, logqueue
 
 logging.basicConfig()
 
+# basicConfig only shows the warnings, the spans of the frontend are
+# written to their own log to be read with the NAS and vm container logs
+
+TRACE_LOG = '/var/log/rocks/img-storage-frontend.log'
+
+_trace_lock = threading.Lock()
+_trace_log_opened = False
+
+
+def log_spans():
+    """send the spans to TRACE_LOG, called by the first callCommand so
+    that the commands which only import this module open no file"""
+
+    global _trace_log_opened
+    with _trace_lock:
+        if _trace_log_opened:
+            return
+        _trace_log_opened = True
+        try:
+            handler = logging.FileHandler(TRACE_LOG)
+        except IOError, e:
+            logging.getLogger(__name__).warning('The spans are not recorded: %s'
+                     % e)
+            return
+        handler.setFormatter(logqueue.JsonFormatter())
+        tracing.LOGGER.addHandler(handler)
+        tracing.LOGGER.setLevel(logging.INFO)
+        tracing.LOGGER.propagate = False
+
+
+# zvols fetched per list_zvols request
+
+LIST_PAGE_SIZE = 500
+
+# seconds a caller blocks on the connection waiting for replies before
+# giving the lock to the other callers
+
+POLL_INTERVAL = 0.05
+
+# seconds a fan-out query waits for the nodes to answer
+
+BROADCAST_TIMEOUT = 10
+
+
+class RPCConnection:
+
+    """
+    Process-wide AMQP connection shared by every CommandLauncher.
+
+    A single connection and a single exclusive reply queue are opened the
+    first time a command is sent and reused for the life of the process.
+    Each request is tagged with a unique message_id; daemons echo it back
+    as the correlation_id of their reply, which is how replies are routed
+    to the caller that is waiting for them. Callers running in different
+    threads share the connection: the lock is only held while talking to
+    pika, never for the whole round trip.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls, username, password, url):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(username, password, url)
+            return cls._instance
+
+    def __init__(self, username, password, url):
+        self.username = username
+        self.password = password
+        self.url = url
+        self.lock = threading.RLock()
+        self.connection = None
+        self.channel = None
+        self.reply_queue = None
+        self.pending = {}
+        self.replies = {}
+
+    def connect(self):
+        """open the connection if it is not already open, must be called
+        with self.lock held"""
+
+        if self.connection and self.connection.is_open:
+            return
+
+        credentials = pika.PlainCredentials(self.username,
+                self.password)
+        parameters = pika.ConnectionParameters(self.url, 5672,
+                self.username, credentials)
+        self.connection = pika.BlockingConnection(parameters)
+        self.channel = self.connection.channel()
+
+        method_frame = self.channel.queue_declare(exclusive=True,
+                auto_delete=True)
+        self.reply_queue = method_frame.method.queue
+        self.channel.confirm_delivery()
+        self.channel.basic_consume(self.on_message, self.reply_queue)
+
+    def reset(self):
+        """drop a broken connection, the next call will reconnect"""
+
+        try:
+            if self.connection and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = None
+        self.channel = None
+        self.reply_queue = None
+
+    def send(self, message, routing_key):
+        """publish message and return the id used to wait for the reply"""
+
+        message_id = str(uuid.uuid4())
+        with self.lock:
+            try:
+                self.connect()
+                self.pending[message_id] = True
+                delivered = self.channel.basic_publish(
+                    exchange='rocks.vm-manage', routing_key=routing_key,
+                    mandatory=True,
+                    body=json.dumps(message, ensure_ascii=True),
+                    properties=pika.BasicProperties(
+                        content_type='application/json',
+                        delivery_mode=1, reply_to=self.reply_queue,
+                        message_id=message_id,
+                        correlation_id=message_id))
+            except Exception:
+                self.pending.pop(message_id, None)
+                self.reset()
+                raise
+            if not delivered:
+                self.pending.pop(message_id, None)
+                raise CommandError('Message could not be delivered')
+        return message_id
+
+    def wait(self, message_id, timeout=None):
+        """block until the reply to message_id arrives and return it"""
+
+        deadline = (time.time() + timeout if timeout else None)
+        while True:
+            with self.lock:
+                if message_id in self.replies:
+                    self.pending.pop(message_id, None)
+                    return self.replies.pop(message_id)
+                if deadline and time.time() > deadline:
+                    self.pending.pop(message_id, None)
+                    raise CommandError('Timeout waiting for reply')
+                try:
+                    self.connect()
+                    self.connection.process_data_events(
+                        time_limit=POLL_INTERVAL)
+                except Exception:
+                    self.pending.pop(message_id, None)
+                    self.reset()
+                    raise
+
+    def gather(self, message_ids, timeout):
+        """wait until all the message_ids are answered or timeout seconds
+        have passed, return a dictionary message_id -> reply of the ones
+        which arrived in time"""
+
+        deadline = time.time() + timeout
+        waiting = set(message_ids)
+        replies = {}
+        while True:
+            with self.lock:
+                for message_id in list(waiting):
+                    if message_id in self.replies:
+                        self.pending.pop(message_id, None)
+                        replies[message_id] = \
+                            self.replies.pop(message_id)
+                        waiting.discard(message_id)
+                if not waiting or time.time() > deadline:
+                    for message_id in waiting:
+                        self.pending.pop(message_id, None)
+                    return replies
+                try:
+                    self.connect()
+                    self.connection.process_data_events(
+                        time_limit=POLL_INTERVAL)
+                except Exception:
+                    for message_id in waiting:
+                        self.pending.pop(message_id, None)
+                    self.reset()
+                    raise
+
+    def on_message(
+        self,
+        channel,
+        method_frame,
+        header_frame,
+        body,
+        ):
+        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        message_id = header_frame.correlation_id
+        if message_id is None and len(self.pending) == 1:
+
+            # daemons that do not echo the correlation_id can only be
+            # matched when there is a single request in flight
+
+            message_id = self.pending.keys()[0]
+        if message_id not in self.pending:
+
+            # a late reply to a request which timed out, or a reply
+            # without correlation_id while several requests are waiting
+
+            logging.getLogger(__name__).warning(
+                'Dropping reply with unknown correlation_id %s'
+                % message_id)
+            return
+        self.replies[message_id] = json.loads(body)
+
 
 class CommandLauncher:
 
@@ -75,6 +292,8 @@ class CommandLauncher:
         self.RABBITMQ_PW = loc.RABBITMQ_PW
         self.RABBITMQ_URL = loc.RABBITMQ_URL
         self.ret_message = None
+        self.rpc = RPCConnection.instance(self.USERNAME,
+                self.RABBITMQ_PW, self.RABBITMQ_URL)
 
     def callAddHostStoragemap(
         self,
@@ -95,11 +314,59 @@ class CommandLauncher:
         block_dev = self.ret_message['bdev']
         return block_dev
 
+    def callAddHostStoragemaps(self, nas, volumes):
+        """map many volumes of the same nas with a single request,
+        volumes is a list of (zpool, volume, remotehost, size) tuples.
+        Return a list of dictionaries with the zvol, the status and
+        either the bdev or the error of every volume"""
+
+        message = {'action': 'map_zvols', 'zvols': [list(v) for v in
+                   volumes]}
+        self.callCommand(message, nas)
+        return self.ret_message['body']
+
+    def callAddHostStoragemapParallel(self, requests, parallel):
+        """map the volumes of many hosts concurrently running at most
+        `parallel` requests at the same time. requests is a dictionary
+        host -> (nas, zpool, volume, remotehost, size), the returned
+        dictionary maps every host to its block device or to the
+        CommandError raised by its request"""
+
+        if not requests:
+            return {}
+        pool = ThreadPool(processes=max(1, min(int(parallel),
+                          len(requests))))
+        try:
+            jobs = dict((host,
+                        pool.apply_async(CommandLauncher().callAddHostStoragemap,
+                        args)) for (host, args) in requests.items())
+            results = {}
+            for (host, job) in jobs.items():
+                try:
+                    results[host] = job.get()
+                except CommandError, e:
+                    results[host] = e
+                except Exception, e:
+                    results[host] = CommandError(str(e))
+            return results
+        finally:
+            pool.close()
+            pool.join()
+
     def callDelHostStoragemap(self, nas, volume):
         message = {'action': 'unmap_zvol', 'zvol': volume}
         self.callCommand(message, nas)
         return
 
+    def callDelHostStoragemaps(self, nas, volumes):
+        """unmap a list of volumes of the same nas with a single request,
+        return a list of dictionaries with the zvol, the status and the
+        error if any of every volume"""
+
+        message = {'action': 'unmap_zvols', 'zvols': list(volumes)}
+        self.callCommand(message, nas)
+        return self.ret_message['body']
+
     def callDelHostStorageimg(
         self,
         nas,
@@ -110,10 +377,33 @@ class CommandLauncher:
         self.callCommand(message, nas)
         return
 
-    def callListHostStoragemap(self, nas):
-        message = {'action': 'list_zvols'}
-        self.callCommand(message, nas)
-        return self.ret_message['body']
+    def callListHostStoragemap(
+        self,
+        nas,
+        zvol=None,
+        remotehost=None,
+        state=None,
+        page_size=LIST_PAGE_SIZE,
+        ):
+        """iterate over the zvols of nas matching the given filters,
+        state is one of mapped, unmapped, upload or download. The zvols
+        are fetched page_size at a time while the caller consumes them"""
+
+        message = {'action': 'list_zvols', 'limit': page_size}
+        for (key, value) in [('zvol', zvol), ('remotehost', remotehost),
+                             ('state', state)]:
+            if value is not None:
+                message[key] = value
+        while True:
+            self.callCommand(message, nas)
+            for zvol in self.ret_message['body']:
+                yield zvol
+
+            # daemons without pagination send everything at once
+
+            if not self.ret_message.get('next'):
+                return
+            message['after'] = self.ret_message['next']
 
     def callListHostStoragedev(self, compute):
         message = {'action': 'list_dev'}
@@ -121,55 +411,114 @@ class CommandLauncher:
         return {'node_type': self.ret_message['node_type'],
                 'body': self.ret_message['body']}
 
-    def callCommand(self, message, nas):
-        credentials = pika.PlainCredentials(self.USERNAME, self.RABBITMQ_PW)
-        parameters = pika.ConnectionParameters(self.RABBITMQ_URL,
-                                                       5672,
-                                                       self.USERNAME,
-                                                       credentials)
-        connection = \
-            pika.BlockingConnection(parameters)
-
-        channel = connection.channel()
-
-        try:
+    def callBroadcast(
+        self,
+        message,
+        hosts,
+        timeout=BROADCAST_TIMEOUT,
+        ):
+        """send message to all the hosts at once over the shared
+        connection and wait at most timeout seconds for their replies.
+        Return a dictionary host -> reply for the hosts which answered
+        and a dictionary host -> error for the ones which failed or did
+        not answer in time"""
 
-            # Declare the queue
+        return self.callEach(dict((host, message) for host in hosts),
+                             timeout)
 
-            method_frame = channel.queue_declare(exclusive=True,
-                    auto_delete=True)
-            zvol_manage_queue = method_frame.method.queue
-            channel.confirm_delivery()
+    def callEach(self, messages, timeout=BROADCAST_TIMEOUT):
+        """like callBroadcast, messages is a dictionary host -> message
+        so that every host gets its own message"""
 
-            # Send a message
+        sent = {}
+        failed = {}
+        for (host, message) in messages.items():
+            try:
+                sent[self.rpc.send(message, host)] = host
+            except CommandError, e:
+                failed[host] = str(e)
 
-            if channel.basic_publish(exchange='rocks.vm-manage',
-                    routing_key=nas, mandatory=True,
-                    body=json.dumps(message, ensure_ascii=True),
-                    properties=pika.BasicProperties(content_type='application/json'
-                    , delivery_mode=1, reply_to=zvol_manage_queue)):
-
-                channel.basic_consume(self.on_message,
-                        zvol_manage_queue)
-                channel.start_consuming()
-                if self.ret_message['status'] == 'error':
-                    if 'error' in self.ret_message.keys():
-                        raise CommandError(self.ret_message['error'])
-                    else:
-                        raise CommandError('Error occured')
-                return
+        replies = self.rpc.gather(sent.keys(), timeout)
+        results = {}
+        for (message_id, host) in sent.items():
+            reply = replies.get(message_id)
+            if reply is None:
+                failed[host] = 'No reply in %s seconds' % timeout
+            elif reply['status'] == 'error':
+                failed[host] = reply.get('error', 'Error occured')
             else:
-                raise CommandError('Message could not be delivered')
-        finally:
-            connection.close()
+                results[host] = reply
+        return (results, failed)
 
-    def on_message(
+    def callListAllStoragemaps(
         self,
-        channel,
-        method_frame,
-        header_frame,
-        body,
+        nases,
+        zvol=None,
+        remotehost=None,
+        state=None,
+        timeout=BROADCAST_TIMEOUT,
+        page_size=LIST_PAGE_SIZE,
         ):
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-        channel.stop_consuming()
-        self.ret_message = json.loads(body)
+        """list the zvols of many nas at once, return a dictionary
+        nas -> zvols and a dictionary nas -> error. The zvols are
+        fetched page_size at a time, every round asks the next page of
+        all the nas which have more"""
+
+        message = {'action': 'list_zvols', 'limit': page_size}
+        for (key, value) in [('zvol', zvol), ('remotehost', remotehost),
+                             ('state', state)]:
+            if value is not None:
+                message[key] = value
+        zvols = dict((nas, []) for nas in nases)
+        failed = {}
+        messages = dict((nas, message) for nas in nases)
+        while messages:
+            (replies, errors) = self.callEach(messages, timeout)
+            failed.update(errors)
+            messages = {}
+            for (nas, reply) in replies.items():
+                zvols[nas] += reply['body']
+
+                # daemons without pagination send everything at once
+
+                if reply.get('next'):
+                    messages[nas] = dict(message, after=reply['next'])
+
+        # the zvols of a nas which failed on a later page are incomplete
+
+        return (dict((nas, zvols[nas]) for nas in nases if nas
+                not in failed), failed)
+
+    def callListAllStoragedevs(self, computes,
+                               timeout=BROADCAST_TIMEOUT):
+        """list the devices of many vm containers at once, return a
+        dictionary compute -> {node_type, body} and a dictionary
+        compute -> error"""
+
+        (replies, failed) = self.callBroadcast({'action': 'list_dev'},
+                computes, timeout)
+        return (dict((compute, {'node_type': reply['node_type'],
+                'body': reply['body']}) for (compute, reply) in
+                replies.items()), failed)
+
+    def callCommand(self, message, nas):
+
+        # the trace follows the request through the NAS and the vm
+        # container, see imgstorage.tracing
+
+        log_spans()
+        span = tracing.Span(message['action'], tracing.new_trace(),
+                            zvol=message.get('zvol'), to=nas)
+        message = dict(message, trace=span.trace)
+        try:
+            message_id = self.rpc.send(message, nas)
+            self.ret_message = self.rpc.wait(message_id)
+        except Exception, e:
+            span.finish(error=e)
+            raise
+        if self.ret_message['status'] == 'error':
+            error = self.ret_message.get('error', 'Error occured')
+            span.finish(error=error)
+            raise CommandError(error)
+        span.finish()
+        return
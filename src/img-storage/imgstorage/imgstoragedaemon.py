@@ -55,8 +55,19 @@
 #
 
 from daemon import runner
+import logging
 import signal
+import time
+
+from tornado.gen import Task, Return, coroutine
+import tornado.process
+
+import imgstorage
 from imgstorage import *
+from imgstorage import metrics
+from imgstorage import profiler
+from imgstorage import tracing
+from imgstorage import logqueue
 
 zfs_create = [
     'zfs',
@@ -68,13 +79,105 @@ zfs_create = [
     ]
 
 
+def trackCommand(params, start, returncode=None, output=0):
+    """record a command which ran from start to now, a returncode of None
+    means it could not be started"""
+
+    metrics.track_command(params, start, failed=returncode != 0)
+    profiler.PROFILER.command(params, start, returncode, output)
+
+
+imgstorage.command_tracker = trackCommand
+
+STREAM = tornado.process.Subprocess.STREAM
+
+
+@coroutine
+def runCommandBackground(cmdlist, shell=False):
+    """
+    Wrapper around subprocess call using Tornado's Subprocess class.
+    This routine can fork a process in the background without blocking the
+    main IOloop, the the forked process can run for a long time without
+    problem
+    """
+
+    LOG = logging.getLogger('imgstorage.commands')
+    LOG.debug('Executing: ' + str(cmdlist))
+
+    # tornado.process.initialize()
+
+    start = time.time()
+    try:
+        sub_process = tornado.process.Subprocess(cmdlist, stdout=STREAM,
+                stderr=STREAM, shell=shell)
+    except OSError, e:
+        trackCommand(cmdlist, start)
+        raise ActionError('Command %s failed: %s' % (cmdlist[0], str(e)))
+
+    # we need to set_exit_callback to fetch the return value
+    # the function can even be empty by it must be set or the
+    # sub_process.returncode will be always None
+
+    sub_process.set_exit_callback(lambda value: value)
+
+    (result, error) = \
+        (yield [Task(sub_process.stdout.read_until_close),
+                Task(sub_process.stderr.read_until_close)])
+
+    trackCommand(cmdlist, start, sub_process.returncode, len(result))
+    if sub_process.returncode:
+        raise ActionError('Error executing %s: %s' % (cmdlist, error))
+
+    raise Return((result.splitlines(), error))
+
+
+def setupLogger(logger):
+    """log the daemon to /var/log/rocks/img-storage.log through a
+    logqueue.QueueHandler, the levels of the loggers can be changed with
+    the img_log_levels attribute"""
+
+    target = logging.FileHandler('/var/log/rocks/img-storage.log')
+    target.setFormatter(logqueue.JsonFormatter())
+    handler = logqueue.QueueHandler(target, tracing.current_trace)
+
+    # for log_name in (logger, 'pika.channel', 'pika.connection', 'rabbit_client.RabbitMQClient'):
+
+    log_names = [logger, 'imgstorage.commands', 'imgstorage.trace',
+                 'rabbit_client.RabbitMQCommonClient',
+                 'tornado.application']
+    for log_name in log_names:
+        logging.getLogger(log_name).addHandler(handler)
+
+    # the spans and the command records are read back by the tools,
+    # they are never limited
+
+    rate_limit = logqueue.RateLimitFilter()
+    for log_name in log_names:
+        if log_name not in ('imgstorage.commands', 'imgstorage.trace'):
+            logging.getLogger(log_name).addFilter(rate_limit)
+    try:
+        logqueue.set_levels(NodeConfig.IMG_LOG_LEVELS, log_names)
+    except ValueError, e:
+        logqueue.set_levels(None, log_names)
+        logging.getLogger(logger).error('Invalid img_log_levels: %s'
+                % str(e))
+
+    return handler
+
+
 def runDaemon(app, handler):
     daemon_runner = runner.DaemonRunner(app)
 
     # This ensures that the logger file handle does not get closed during daemonization
 
     daemon_runner.daemon_context.files_preserve = [handler.stream]
+
+    # write what was logged so far before forking
+
+    handler.flush()
     daemon_runner.daemon_context.signal_map = \
-        {signal.SIGTERM: lambda signum, frame: app.stop()}
+        {signal.SIGTERM: lambda signum, frame: app.stop(),
+         signal.SIGHUP: lambda signum, frame: \
+         host_attributes.invalidate()}
 
     daemon_runner.do_action()
@@ -54,7 +54,16 @@
 # @Copyright@
 #
 from rabbitmqclient import RabbitMQCommonClient
-from imgstorage import runCommand, ActionError, ZvolBusyActionError, NodeConfig
+from imgstorage import runCommand, ActionError, ZvolBusyActionError, \
+    NodeConfig
+from imgstorage.imgstoragedaemon import runCommandBackground
+from imgstorage.statestore import StateStore
+from imgstorage import schema
+from imgstorage.zfstransfer import ZfsTransfer, parse_rate
+from imgstorage.bandwidth import BandwidthScheduler
+from imgstorage import metrics
+from imgstorage import profiler
+from imgstorage import tracing
 import logging
 
 import traceback
@@ -78,56 +87,139 @@ import uuid
 import subprocess
 
 from tornado.gen import Task, Return, coroutine
+from tornado.ioloop import IOLoop
 import tornado.process
 
 
-def get_iscsi_targets():
-    """return a list of all the active target the dictionary keys
-    are the target names and the data is their associated TID"""
+def parse_iscsi_targets(out):
+    """parse the output of tgtadm --op show --mode target and return a
+    dictionary where the keys are the target names and the data is their
+    associated TID"""
 
-    out = runCommand(['tgtadm', '--op', 'show', '--mode', 'target'])
-    ret = []
+    ret = {}
     for line in out:
-        if line.startswith('Target ') and len(line.split()) >= 2:
-            ret.append(line.split()[2])
+        if line.startswith('Target ') and len(line.split()) >= 3:
+            ret[line.split()[2]] = (line.split()[1])[:-1]
     return ret
 
 
-STREAM = tornado.process.Subprocess.STREAM
+def get_iscsi_targets():
+    """return a list of all the active target names"""
+
+    out = runCommand(['tgtadm', '--op', 'show', '--mode', 'target'])
+    return parse_iscsi_targets(out).keys()
+
+
+# sync_queue priority classes, the lower class runs first
+
+SYNC_UPLOAD = 0  # a VM is starting and waits for its disk
+SYNC_UNMAP = 1  # the VM stopped, its disk goes back to the NAS
+SYNC_PULL = 2  # periodic copy of the disks of the running VMs
 
+# list_zvols state filters, upload and download are the NAS->VM and
+# NAS<-VM states of rocks list host storagemap
+
+ZVOL_STATES = {
+    'mapped': 'zvols.remotehost IS NOT NULL AND sync_queue.is_sending IS NULL',
+    'unmapped': 'zvols.remotehost IS NULL',
+    'upload': 'zvols.remotehost IS NOT NULL AND sync_queue.is_sending = 1',
+    'download': 'zvols.remotehost IS NOT NULL AND sync_queue.is_sending = 0',
+    }
+
+
+class IscsiTargetTable:
 
-@coroutine
-def runCommandBackground(cmdlist, shell=False):
     """
-    Wrapper around subprocess call using Tornado's Subprocess class.
-    This routine can fork a process in the background without blocking the
-    main IOloop, the the forked process can run for a long time without
-    problem
+    In memory index of the tgtd targets (target name -> TID).
+
+    It is filled from tgtadm the first time it is used, kept up to date
+    when the daemon creates or deletes a target and reconciled against
+    tgtadm periodically to catch the changes done outside of the daemon.
+    A listing taken in the background is merged with the targets the
+    daemon created or deleted while tgtadm was running, see
+    start_listing.
     """
 
-    LOG = logging.getLogger('imgstorage.imgstoragenas.NasDaemon')
-    LOG.debug('Executing: ' + str(cmdlist))
+    def __init__(self):
+        self.targets = None
+        self.reserved = set()
+
+        # target name -> TID, or None if deleted, of the changes done
+        # while a background listing is in progress
+
+        self.listings = []
+
+    def reload(self, out=None):
+        """rebuild the table from the tgtadm output, if out is not given
+        tgtadm is run"""
 
-    # tornado.process.initialize()
+        if out is None:
+            out = runCommand(['tgtadm', '--op', 'show', '--mode',
+                             'target'])
+        self.targets = parse_iscsi_targets(out)
 
-    sub_process = tornado.process.Subprocess(cmdlist, stdout=STREAM,
-            stderr=STREAM, shell=shell)
+    def get(self, target):
+        if self.targets is None:
+            self.reload()
+        return self.targets.get(target)
 
-    # we need to set_exit_callback to fetch the return value
-    # the function can even be empty by it must be set or the
-    # sub_process.returncode will be always None
+    def start_listing(self):
+        """record the changes of the table until end_listing, so that
+        the output of a tgtadm listing started now can be merged"""
 
-    retval = 0
-    sub_process.set_exit_callback(lambda value: value)
+        changes = {}
+        self.listings.append(changes)
+        return changes
 
-    (result, error) = \
-        (yield [Task(sub_process.stdout.read_until_close),
-                Task(sub_process.stderr.read_until_close)])
+    def end_listing(self, changes):
+        self.listings.remove(changes)
 
-    if sub_process.returncode:
-        raise ActionError('Error executing %s: %s' % (cmdlist, error))
+    def merge(self, out, changes):
+        """rebuild the table from the output of a listing, keeping the
+        targets created or deleted since its start_listing"""
 
-    raise Return((result.splitlines(), error))
+        targets = parse_iscsi_targets(out)
+        for (target, tid) in changes.items():
+            if tid is None:
+                targets.pop(target, None)
+            else:
+                targets[target] = tid
+        self.targets = targets
+
+    def add(self, target, tid):
+        for changes in self.listings:
+            changes[target] = tid
+        if self.targets is not None:
+            self.targets[target] = tid
+
+    def remove(self, target):
+        for changes in self.listings:
+            changes[target] = None
+        if self.targets is not None:
+            self.targets.pop(target, None)
+
+    def names(self):
+        if self.targets is None:
+            self.reload()
+        return self.targets.keys()
+
+    def allocate_tid(self):
+        """return the lowest TID which is neither in use nor reserved by
+        a target creation in progress. The TID stays reserved until
+        release_tid is called"""
+
+        if self.targets is None:
+            self.reload()
+        used = set(int(tid) for tid in self.targets.values()) \
+            | self.reserved
+        tid = 1
+        while tid in used:
+            tid += 1
+        self.reserved.add(tid)
+        return tid
+
+    def release_tid(self, tid):
+        self.reserved.discard(tid)
 
 
 class NasDaemon:
@@ -144,7 +236,9 @@ class NasDaemon:
         self.pidfile_timeout = 5
         self.function_dict = {
             'map_zvol': self.map_zvol,
+            'map_zvols': self.map_zvols,
             'unmap_zvol': self.unmap_zvol,
+            'unmap_zvols': self.unmap_zvols,
             'zvol_mapped': self.zvol_mapped,
             'zvol_unmapped': self.zvol_unmapped,
             'list_zvols': self.list_zvols,
@@ -159,6 +253,17 @@ class NasDaemon:
         self.sync_result = None
 
         self.results = {}
+
+        # set while the sync queue is being processed, and when it has to
+        # be processed again after the current pass
+
+        self.sync_running = False
+        self.sync_pending = False
+
+        # pending map_zvols/unmap_zvols requests
+
+        self.batches = {}
+        self.zvol_batch = {}
         if NodeConfig.IMG_SYNC_WORKERS:
             self.SYNC_WORKERS = int(NodeConfig.IMG_SYNC_WORKERS)
         else:
@@ -167,6 +272,41 @@ class NasDaemon:
         self.SYNC_CHECK_TIMEOUT = 10
         self.SYNC_PULL_TIMEOUT = 60 * 5
 
+        # within a priority class a job waits as long as its size would
+        # take to transfer at this speed, so the small jobs go first but
+        # the big ones are not starved
+
+        self.SYNC_SORT_SPEED = 100 * 1024 ** 2
+
+        # periodic pulls never take the last worker, it is kept for the
+        # VMs starting and stopping
+
+        self.SYNC_PULL_WORKERS = max(1, self.SYNC_WORKERS - 1)
+        self.TARGETS_RECONCILE_TIMEOUT = 60 * 5
+        self.TARGETS_RECLAIM_DELAY = 1
+        self.BANDWIDTH_UPDATE_TIMEOUT = 30
+
+        # shares the img_sync_bandwidth of the NAS and the
+        # img_upload_speed/img_download_speed of the vm containers
+        # between the running transfers
+
+        self.bandwidth = BandwidthScheduler()
+
+        # /metrics is served on localhost once the daemon is connected,
+        # 0 disables it
+
+        self.METRICS_PORT = int(NodeConfig.IMG_METRICS_PORT or 9410)
+        self.metrics_started = False
+
+        self.iscsi_targets = IscsiTargetTable()
+
+        # targets released by the compute nodes which are still waiting
+        # to be deleted from tgtd
+
+        self.detached_targets = set()
+        self.reclaim_scheduled = False
+        self.reclaim_running = False
+
         rocks.db.helper.DatabaseHelper().closeSession()  # to reopen after daemonization
 
         self.logger = \
@@ -174,25 +314,10 @@ class NasDaemon:
 
     def run(self):
         self.pool = ThreadPool(processes=self.SYNC_WORKERS)
-        with sqlite3.connect(self.SQLITE_DB) as con:
-            cur = con.cursor()
-            cur.execute('''CREATE TABLE IF NOT EXISTS zvol_calls(
-                          zvol TEXT PRIMARY KEY NOT NULL,
-                          reply_to TEXT NOT NULL,
-                          time INT NOT NULL)''')
-            cur.execute('''CREATE TABLE IF NOT EXISTS zvols(
-                          zvol TEXT PRIMARY KEY NOT NULL,
-                          zpool TEXT,
-                          iscsi_target TEXT UNIQUE,
-                          remotehost TEXT)''')
-            cur.execute('''CREATE TABLE IF NOT EXISTS sync_queue(
-                          zvol TEXT PRIMARY KEY NOT NULL,
-                          zpool TEXT NOT NULL,
-                          remotehost TEXT,
-                          is_sending BOOLEAN,
-                          is_delete_remote BOOLEAN,
-                          time INT)''')
-            con.commit()
+        self.state = StateStore(self.SQLITE_DB)
+        schema.upgrade(self.state.connect())
+        if NodeConfig.IMG_PROFILE:
+            profiler.PROFILER.enable(NodeConfig.IMG_PROFILE)
 
         self.queue_connector = RabbitMQCommonClient('rocks.vm-manage',
                 'direct', "img-storage", "img-storage",
@@ -206,133 +331,338 @@ class NasDaemon:
         routing_key,
         action,
         error_message,
+        correlation_id=None,
+        zvol=None,
+        batch_id=None,
         ):
-        if routing_key != None and action != None:
+        if zvol != None and action != None:
+            self.reply_zvol(zvol, {'action': action, 'status': 'error',
+                            'error': error_message}, routing_key,
+                            correlation_id, batch_id)
+        elif routing_key != None and action != None:
             self.queue_connector.publish_message(json.dumps({'action': action,
                     'status': 'error', 'error': error_message}),
-                    exchange='', routing_key=routing_key)
+                    exchange='', routing_key=routing_key,
+                    correlation_id=correlation_id)
         self.logger.error('Failed %s: %s' % (action, error_message))
 
+    def reply_zvol(
+        self,
+        zvol,
+        message,
+        routing_key,
+        correlation_id=None,
+        batch_id=None,
+        ):
+        """Send the result of a map or unmap request for a single zvol to
+        the frontend. If the zvol is part of a map_zvols/unmap_zvols batch
+        the result is collected and the frontend gets a single reply when
+        all the zvols of the batch are done"""
+
+        if batch_id == None:
+            batch_id = self.zvol_batch.get(zvol)
+        batch = self.batches.get(batch_id)
+        if batch == None:
+            if routing_key != None:
+                self.queue_connector.publish_message(json.dumps(message),
+                        exchange='', routing_key=routing_key,
+                        correlation_id=correlation_id)
+            return
+
+        if self.zvol_batch.get(zvol) == batch_id:
+            del self.zvol_batch[zvol]
+        result = dict(message)
+        del result['action']
+        result['zvol'] = zvol
+        batch['results'][zvol] = result
+
+        if len(batch['results']) == len(batch['zvols']):
+            del self.batches[batch_id]
+            self.logger.debug('Batch %s finished' % batch_id)
+            self.queue_connector.publish_message(json.dumps({
+                'action': batch['action'],
+                'status': 'success',
+                'body': [batch['results'][z] for z in batch['zvols']],
+                }), exchange='', routing_key=batch['reply_to'],
+                    correlation_id=batch['correlation_id'])
+
+    def start_batch(
+        self,
+        action,
+        zvols,
+        props,
+        ):
+        """register a new batch request and return its id"""
+
+        if len(set(zvols)) != len(zvols):
+            raise ActionError('Duplicate zvols in batch request')
+        batch_id = str(uuid.uuid4())
+        self.batches[batch_id] = {
+            'action': action,
+            'zvols': zvols,
+            'results': {},
+            'reply_to': props.reply_to,
+            'correlation_id': props.message_id,
+            }
+        return batch_id
+
     def startup(self):
         self.schedule_zvols_pull()
         self.schedule_next_sync()
+        self.reconcile_iscsi_targets()
+        self.update_bandwidth_limits()
+        if not self.metrics_started:
+            self.metrics_started = True
+            self.register_metrics()
+            metrics.serve(self.METRICS_PORT, self.logger)
+
+    def register_metrics(self):
+        classes = {SYNC_UPLOAD: 'upload', SYNC_UNMAP: 'unmap',
+                   SYNC_PULL: 'pull'}
+
+        def queued():
+            depth = dict(((name, ), 0) for name in classes.values())
+            cur = self.state.connect().cursor()
+            cur.execute('''SELECT IFNULL(priority, ?), count(*)
+                FROM sync_queue GROUP BY 1''', [SYNC_PULL])
+            for (priority, count) in cur.fetchall():
+                depth[(classes.get(priority, str(priority)), )] = count
+            return depth
+
+        def locked():
+            cur = self.state.connect().cursor()
+            cur.execute('SELECT count(*) FROM zvol_calls')
+            return cur.fetchone()[0]
+
+        metrics.REGISTRY.gauge('imgstorage_sync_queue_jobs',
+                               'Jobs in the sync queue, by priority class'
+                               , ['priority'], queued)
+        metrics.REGISTRY.gauge('imgstorage_sync_workers_busy',
+                               'Sync workers running a job', (),
+                               lambda : len([r for r in
+                               self.results.values() if not r.ready()]))
+        metrics.REGISTRY.gauge('imgstorage_sync_workers',
+                               'Size of the sync worker pool', (),
+                               lambda : self.SYNC_WORKERS)
+        metrics.REGISTRY.gauge('imgstorage_zvols_locked',
+                               'Zvols with a request in progress', (),
+                               locked)
+        metrics.REGISTRY.gauge('imgstorage_iscsi_targets_detached',
+                               'iSCSI targets waiting to be reclaimed',
+                               (), lambda : len(self.detached_targets))
+
+    @coroutine
+    def reconcile_iscsi_targets(self):
+        """resync the in memory target table with tgtadm"""
+
+        changes = self.iscsi_targets.start_listing()
+        try:
+            (out, err) = (yield runCommandBackground(['tgtadm', '--op',
+                          'show', '--mode', 'target']))
+            self.iscsi_targets.merge(out, changes)
+        except ActionError, msg:
+            self.logger.error('Unable to list iSCSI targets: %s' % msg)
+        finally:
+            self.iscsi_targets.end_listing(changes)
+
+        self.queue_connector._connection.add_timeout(self.TARGETS_RECONCILE_TIMEOUT,
+                self.reconcile_iscsi_targets)
 
     @coroutine
     def map_zvol(self, message, props):
-        remotehost = message['remotehost']
-        zpool_name = message['zpool']
-        zvol_name = message['zvol']
+        yield self.setup_zvol_mapping(message['zpool'], message['zvol'],
+                message['remotehost'], message['size'], props)
+
+    @coroutine
+    def map_zvols(self, message, props):
+        """Map a list of [zpool, zvol, remotehost, size] in one request.
+        The zvols are set up concurrently and the frontend receives a
+        single zvols_mapped reply with the status of every zvol"""
+
+        try:
+            volumes = message['zvols']
+            batch_id = self.start_batch('zvols_mapped', [v[1] for v in
+                    volumes], props)
+        except (ActionError, IndexError, KeyError, TypeError), err:
+            self.failAction(props.reply_to, 'zvols_mapped',
+                            'Invalid batch request: %s' % err,
+                            props.message_id)
+            return
+
+        self.logger.debug('Setting %s zvols in batch %s'
+                          % (len(volumes), batch_id))
+        if not volumes:
+            self.queue_connector.publish_message(json.dumps({'action': 'zvols_mapped'
+                    , 'status': 'success', 'body': []}), exchange='',
+                    routing_key=props.reply_to,
+                    correlation_id=props.message_id)
+            del self.batches[batch_id]
+            return
+
+        yield [self.setup_zvol_mapping(
+            zpool_name,
+            zvol_name,
+            remotehost,
+            size,
+            props,
+            batch_id,
+            ) for (zpool_name, zvol_name, remotehost, size) in volumes]
+
+    @coroutine
+    def setup_zvol_mapping(
+        self,
+        zpool_name,
+        zvol_name,
+        remotehost,
+        size,
+        props,
+        batch_id=None,
+        ):
         self.logger.debug('Setting zvol %s' % zvol_name)
 
-        with sqlite3.connect(self.SQLITE_DB) as con:
-            cur = con.cursor()
-            try:
-                self.lock_zvol(zvol_name, props.reply_to)
-                cur.execute('SELECT count(*) FROM zvols WHERE zvol = ?'
-                            , [zvol_name])
+        # the connection is shared by the coroutines of the IOLoop thread,
+        # no transaction is held across a yield
+
+        try:
+            self.lock_zvol(zvol_name, props.reply_to, props.message_id)
+            if batch_id:
+                self.zvol_batch[zvol_name] = batch_id
+            with self.state.connect() as con:
+                cur = con.cursor()
+                cur.execute('SELECT count(*) FROM zvols WHERE zvol = ?',
+                            [zvol_name])
+                known = cur.fetchone()[0]
+
+            volume = '%s/%s' % (zpool_name, zvol_name)
+            if known == 0:
+
+                # Create a zvol, if it doesn't already exist
+
+                self.logger.debug('checking if  zvol %s exists' % volume)
+                try:
+                    yield runCommandBackground(['zfs', 'list', volume])
+                    self.logger.debug('Vol %s exists' % volume)
+                except ActionError:
+
+                    # create the zfs FS
 
-		volume = "%s/%s" % (zpool_name, zvol_name)
-                if cur.fetchone()[0] == 0:
-
-       	            """ Create a zvol, if it doesn't already exist """ 
-       	            # check if volume already exists
-                    self.logger.debug('checking if  zvol %s exists' % volume)
-                    rcode = subprocess.call(["zfs","list",volume])
-                    self.logger.debug('check complete (%s)' % volume)
-       	            if rcode != 0:
-                        # create the zfs FS
-                        yield runCommandBackground(zfs_create
-                            + ['-V', '%sgb' % message['size'], volume ])
-                        self.logger.debug('Created new zvol %s' % volume)
-       	            else:
-                        self.logger.debug('Vol %s exists' % volume)
+                    yield runCommandBackground(zfs_create + ['-V',
+                            '%sgb' % size, volume])
+                    self.logger.debug('Created new zvol %s' % volume)
 
+                with self.state.connect() as con:
+                    cur = con.cursor()
                     cur.execute('INSERT OR REPLACE INTO zvols VALUES (?,?,?,?) '
                                 , (zvol_name, None, None, None))
                     con.commit()
-                    self.logger.debug('Created new zvol %s' % volume)
 
+            with self.state.connect() as con:
+                cur = con.cursor()
                 cur.execute('SELECT remotehost FROM zvols WHERE zvol = ?'
                             , [zvol_name])
                 row = cur.fetchone()
-                if row != None and row[0] != None:  # zvol is mapped
-                    raise ActionError('Error when mapping zvol: already mapped'
-                            )
-
-                ip = None
-                use_ib = False
-
-                if self.ib_net:
-                    try:
-                        ip = socket.gethostbyname('%s.%s'
-                                % (remotehost, self.ib_net))
-                        use_ib = True
-                    except:
-                        pass
-
-                if not use_ib:
-                    try:
-                        ip = socket.gethostbyname(remotehost)
-                    except:
-                        raise ActionError('Host %s is unknown'
-                                % remotehost)
-
-                iscsi_target = ''
-                (out, err) = (yield runCommandBackground([
-                    '/opt/rocks/bin/tgt-setup-lun-lock',
-                    '-n',
-                    zvol_name,
-                    '-d',
-                    '/dev/%s/%s' % (zpool_name, zvol_name),
-                    ip,
-                    ]))
-
-                for line in out:
-                    if 'Creating new target' in line:
-                        start = 'Creating new target (name='.__len__()
-                        iscsi_target = line[start:line.index(',')]
-                self.logger.debug('Mapped %s to iscsi target %s'
-                                  % (zvol_name, iscsi_target))
-
+            if row != None and row[0] != None:  # zvol is mapped
+                raise ActionError('Error when mapping zvol: already mapped'
+                                  )
+
+            ip = None
+            use_ib = False
+
+            if self.ib_net:
+                try:
+                    ip = socket.gethostbyname('%s.%s' % (remotehost,
+                            self.ib_net))
+                    use_ib = True
+                except:
+                    pass
+
+            if not use_ib:
+                try:
+                    ip = socket.gethostbyname(remotehost)
+                except:
+                    raise ActionError('Host %s is unknown' % remotehost)
+
+            iscsi_target = (yield self.create_iscsi_target(zvol_name,
+                            '/dev/%s/%s' % (zpool_name, zvol_name), ip))
+            self.logger.debug('Mapped %s to iscsi target %s'
+                              % (zvol_name, iscsi_target))
+
+            with self.state.connect() as con:
+                cur = con.cursor()
                 cur.execute('INSERT OR REPLACE INTO zvols VALUES (?,?,?,?) '
                             , (zvol_name, zpool_name, iscsi_target,
                             remotehost))
                 con.commit()
 
-                def failDeliver(
-                    target,
-                    zvol,
-                    reply_to,
-                    remotehost,
-                    ):
-                    self.detach_target(target, True)
-                    self.failAction(props.reply_to, 'zvol_mapped',
-                                    'Compute node %s is unavailable'
-                                    % remotehost)
-                    self.release_zvol(zvol_name)
+            def failDeliver(
+                target,
+                zvol,
+                reply_to,
+                remotehost,
+                ):
+                self.detach_target(target, True)
+                self.failAction(props.reply_to, 'zvol_mapped',
+                                'Compute node %s is unavailable'
+                                % remotehost, props.message_id,
+                                zvol_name)
+                self.release_zvol(zvol_name)
 
-                self.queue_connector.publish_message(json.dumps({
-                    'action': 'map_zvol',
-                    'target': iscsi_target,
-                    'nas': ('%s.%s' % (self.NODE_NAME,
-                            self.ib_net) if use_ib else self.NODE_NAME),
-                    'size': message['size'],
-                    'zvol': zvol_name,
-                    }), remotehost, self.NODE_NAME, on_fail=lambda : \
-                        failDeliver(iscsi_target, zvol_name,
-                                    props.reply_to, remotehost))
-                self.logger.debug('Setting iscsi %s sent'
-                                  % iscsi_target)
-            except ActionError, err:
-                if not isinstance(err, ZvolBusyActionError):
-                    self.release_zvol(zvol_name)
-                self.failAction(props.reply_to, 'zvol_mapped', str(err))
+            self.queue_connector.publish_message(json.dumps({
+                'action': 'map_zvol',
+                'trace': tracing.current_trace(),
+                'target': iscsi_target,
+                'nas': ('%s.%s' % (self.NODE_NAME,
+                        self.ib_net) if use_ib else self.NODE_NAME),
+                'size': size,
+                'zvol': zvol_name,
+                }), remotehost, self.NODE_NAME, on_fail=lambda : \
+                    failDeliver(iscsi_target, zvol_name,
+                                props.reply_to, remotehost))
+            self.logger.debug('Setting iscsi %s sent' % iscsi_target)
+        except ActionError, err:
+            if not isinstance(err, ZvolBusyActionError):
+                self.release_zvol(zvol_name)
+            self.failAction(props.reply_to, 'zvol_mapped', str(err),
+                            props.message_id, zvol_name, batch_id)
 
     def unmap_zvol(self, message, props):
-        zvol_name = message['zvol']
+        return self.teardown_zvol_mapping(message['zvol'], props)
+
+    def unmap_zvols(self, message, props):
+        """Unmap a list of zvols in one request, the frontend receives a
+        single zvols_unmapped reply with the status of every zvol"""
+
+        try:
+            zvols = message['zvols']
+            batch_id = self.start_batch('zvols_unmapped', zvols, props)
+        except (ActionError, KeyError, TypeError), err:
+            self.failAction(props.reply_to, 'zvols_unmapped',
+                            'Invalid batch request: %s' % err,
+                            props.message_id)
+            return
+
+        self.logger.debug('Tearing down %s zvols in batch %s'
+                          % (len(zvols), batch_id))
+        if not zvols:
+            self.queue_connector.publish_message(json.dumps({'action': 'zvols_unmapped'
+                    , 'status': 'success', 'body': []}), exchange='',
+                    routing_key=props.reply_to,
+                    correlation_id=props.message_id)
+            del self.batches[batch_id]
+            return
+
+        for zvol_name in zvols:
+            self.teardown_zvol_mapping(zvol_name, props, batch_id)
+
+    def teardown_zvol_mapping(
+        self,
+        zvol_name,
+        props,
+        batch_id=None,
+        ):
         self.logger.debug('Tearing down zvol %s' % zvol_name)
 
-        with sqlite3.connect(self.SQLITE_DB) as con:
+        with self.state.connect() as con:
             cur = con.cursor()
             try:
                 cur.execute('SELECT remotehost, iscsi_target FROM zvols WHERE zvol = ?'
@@ -346,13 +676,17 @@ class NasDaemon:
                     raise ActionError('ZVol %s is not mapped'
                             % zvol_name)
 
-                self.lock_zvol(zvol_name, props.reply_to)
+                self.lock_zvol(zvol_name, props.reply_to,
+                               props.message_id)
+                if batch_id:
+                    self.zvol_batch[zvol_name] = batch_id
                 self.queue_connector.publish_message(json.dumps({'action': 'unmap_zvol'
-                        , 'target': target, 'zvol': zvol_name}),
+                        , 'trace': tracing.current_trace(),
+                        'target': target, 'zvol': zvol_name}),
                         remotehost, self.NODE_NAME, on_fail=lambda : \
                         self.failAction(props.reply_to, 'zvol_unmapped'
                         , 'Compute node %s is unavailable'
-                        % remotehost))
+                        % remotehost, props.message_id, zvol_name))
                 self.logger.debug('Tearing down zvol %s sent'
                                   % zvol_name)
             except ActionError, err:
@@ -360,7 +694,15 @@ class NasDaemon:
                 if not isinstance(err, ZvolBusyActionError):
                     self.release_zvol(zvol_name)
                     self.failAction(props.reply_to, 'zvol_unmapped',
-                                    str(err))
+                                    str(err), props.message_id,
+                                    zvol_name, batch_id)
+                elif batch_id:
+
+                    # a batch can not be requeued, report the busy zvol
+
+                    self.failAction(props.reply_to, 'zvol_unmapped',
+                                    str(err), props.message_id,
+                                    zvol_name, batch_id)
                 else:
                     return False
 
@@ -369,56 +711,61 @@ class NasDaemon:
         zvol_name = message['zvol']
         zpool_name = message['zpool']
         self.logger.debug('Deleting zvol %s' % zvol_name)
-        with sqlite3.connect(self.SQLITE_DB) as con:
-            cur = con.cursor()
-            try:
-                self.lock_zvol(zvol_name, props.reply_to)
+        try:
+            self.lock_zvol(zvol_name, props.reply_to, props.message_id)
+            with self.state.connect() as con:
+                cur = con.cursor()
                 cur.execute('SELECT remotehost, iscsi_target FROM zvols WHERE zvol = ?'
                             , [zvol_name])
                 row = cur.fetchone()
-                if row == None:
-                    raise ActionError('ZVol %s not found in database'
-                            % zvol_name)
-                if row[0] != None:
-                    raise ActionError('Error deleting zvol %s: is mapped'
-                             % zvol_name)
+            if row == None:
+                raise ActionError('ZVol %s not found in database'
+                                  % zvol_name)
+            if row[0] != None:
+                raise ActionError('Error deleting zvol %s: is mapped'
+                                  % zvol_name)
 
-                self.logger.debug('Invoking zfs destroy %s/%s'
-                                  % (zpool_name, zvol_name))
-                yield runCommandBackground(['zfs', 'destroy', '%s/%s'
-                        % (zpool_name, zvol_name), '-r'])
-                self.logger.debug('zfs destroy success %s' % zvol_name)
+            self.logger.debug('Invoking zfs destroy %s/%s'
+                              % (zpool_name, zvol_name))
+            yield runCommandBackground(['zfs', 'destroy', '%s/%s'
+                    % (zpool_name, zvol_name), '-r'])
+            self.logger.debug('zfs destroy success %s' % zvol_name)
 
+            with self.state.connect() as con:
+                cur = con.cursor()
                 cur.execute('DELETE FROM zvols WHERE zvol = ?',
                             [zvol_name])
                 con.commit()
 
+            self.release_zvol(zvol_name)
+            self.queue_connector.publish_message(json.dumps({'action': 'zvol_deleted'
+                    , 'status': 'success'}), exchange='',
+                    routing_key=props.reply_to,
+                    correlation_id=props.message_id)
+        except ActionError, err:
+            if not isinstance(err, ZvolBusyActionError):
                 self.release_zvol(zvol_name)
-                self.queue_connector.publish_message(json.dumps({'action': 'zvol_deleted'
-                        , 'status': 'success'}), exchange='',
-                        routing_key=props.reply_to)
-            except ActionError, err:
-                if not isinstance(err, ZvolBusyActionError):
-                    self.release_zvol(zvol_name)
-                self.failAction(props.reply_to, 'zvol_deleted',
-                                str(err))
+            self.failAction(props.reply_to, 'zvol_deleted', str(err),
+                            props.message_id)
 
     def zvol_mapped(self, message, props):
         target = message['target']
 
         zvol = None
         reply_to = None
+        correlation_id = None
 
         self.logger.debug('Got zvol mapped message %s' % target)
-        with sqlite3.connect(self.SQLITE_DB) as con:
+        with self.state.connect() as con:
             try:
                 cur = con.cursor()
                 cur.execute('''SELECT zvol_calls.reply_to,
+                        zvol_calls.correlation_id,
                         zvol_calls.zvol, zvols.zpool FROM zvol_calls
                         JOIN zvols ON zvol_calls.zvol = zvols.zvol
                         WHERE zvols.iscsi_target = ?''',
                             [target])
-                (reply_to, zvol, zpool) = cur.fetchone()
+                (reply_to, correlation_id, zvol, zpool) = cur.fetchone()
 
                 if message['status'] != 'success':
                     raise ActionError('Error attaching iSCSI target to compute node: %s'
@@ -429,20 +776,27 @@ class NasDaemon:
                 else:
                     cur.execute('DELETE FROM sync_queue WHERE zvol = ?'
                                 , [zvol])
-                    cur.execute('''INSERT INTO sync_queue 
-                                    SELECT zvol,?,?,1,1,? 
+                    cur.execute('''INSERT INTO sync_queue(zvol, zpool,
+                                    remotehost, is_sending,
+                                    is_delete_remote, time, priority,
+                                    trace)
+                                    SELECT zvol,?,?,1,1,?,?,? 
                                     FROM zvols 
                                     WHERE iscsi_target = ? '''
                                 , [zpool, props.reply_to, time.time(),
+                                SYNC_UPLOAD, tracing.current_trace(),
                                 target])
                     con.commit()
+                    self.wake_sync()
 
-                self.queue_connector.publish_message(json.dumps({'action': 'zvol_mapped'
-                        , 'bdev': message['bdev'], 'status': 'success'
-                        }), exchange='', routing_key=reply_to)
+                self.reply_zvol(zvol, {'action': 'zvol_mapped',
+                                'bdev': message['bdev'],
+                                'status': 'success'}, reply_to,
+                                correlation_id)
             except ActionError, err:
                 self.release_zvol(zvol)
-                self.failAction(reply_to, 'zvol_mapped', str(err))
+                self.failAction(reply_to, 'zvol_mapped', str(err),
+                                correlation_id, zvol)
 
     def zvol_unmapped(self, message, props):
         target = message['target']
@@ -450,163 +804,288 @@ class NasDaemon:
         self.logger.debug('Got zvol %s unmapped message' % target)
 
         reply_to = None
+        correlation_id = None
 
         try:
-            with sqlite3.connect(self.SQLITE_DB) as con:
+            with self.state.connect() as con:
                 cur = con.cursor()
 
                 # get request destination
 
-                cur.execute('''SELECT reply_to, zpool 
+                cur.execute('''SELECT reply_to, correlation_id, zpool 
                                 FROM zvol_calls 
                                 JOIN zvols 
                                 ON zvol_calls.zvol = zvols.zvol 
                                 WHERE zvols.zvol = ?'''
                             , [zvol])
-                [reply_to, zpool] = cur.fetchone()
+                [reply_to, correlation_id, zpool] = cur.fetchone()
 
                 if message['status'] == 'error':
                     raise ActionError('Error detaching iSCSI target from compute node: %s'
                              % message.get('error'))
 
                 if not self.is_sync_node(props.reply_to):
-                    self.detach_target(target, True)
+                    self.defer_detach_target(target, True)
                     self.release_zvol(zvol)
                 else:
-                    self.detach_target(target, False)
-                    cur.execute('UPDATE sync_queue SET is_delete_remote = 1 WHERE zvol = ?'
-                                , [zvol])
+                    self.defer_detach_target(target, False)
+                    cur.execute('''UPDATE sync_queue SET is_delete_remote = 1,
+                                    priority = MIN(IFNULL(priority, ?), ?),
+                                    trace = ?
+                                    WHERE zvol = ?'''
+                                , [SYNC_UNMAP, SYNC_UNMAP,
+                                tracing.current_trace(), zvol])
                     if cur.rowcount == 0:
-                        cur.execute('INSERT INTO sync_queue VALUES(?,?,?,0,1,?)'
+                        cur.execute('''INSERT INTO sync_queue(zvol, zpool,
+                                    remotehost, is_sending,
+                                    is_delete_remote, time, priority,
+                                    trace)
+                                    VALUES(?,?,?,0,1,?,?,?)'''
                                     , [zvol, zpool, props.reply_to,
-                                    time.time()])
+                                    time.time(), SYNC_UNMAP,
+                                    tracing.current_trace()])
                     con.commit()
+                    self.wake_sync()
 
-                self.queue_connector.publish_message(json.dumps({'action': 'zvol_unmapped'
-                        , 'status': 'success'}), exchange='',
-                        routing_key=reply_to)
+                self.reply_zvol(zvol, {'action': 'zvol_unmapped',
+                                'status': 'success'}, reply_to,
+                                correlation_id)
         except ActionError, err:
 
             self.release_zvol(zvol)
-            self.failAction(reply_to, 'zvol_unmapped', str(err))
+            self.failAction(reply_to, 'zvol_unmapped', str(err),
+                            correlation_id, zvol)
 
     def zvol_synced(self, message, props):
         zvol = message['zvol']
-        with sqlite3.connect(self.SQLITE_DB) as con:
+        with self.state.connect() as con:
             cur = con.cursor()
             cur.execute('SELECT iscsi_target FROM zvols WHERE zvol = ?'
                         , [zvol])
             [target, ] = cur.fetchone()
-            self.detach_target(target, False)
+            self.defer_detach_target(target, False)
             self.release_zvol(zvol)
 
-    @coroutine
     def schedule_next_sync(self):
+        """periodic fallback, the sync queue is normally processed as soon
+        as a job is queued or a worker finishes"""
+
+        self.process_sync_queue()
+        self.queue_connector._connection.add_timeout(self.SYNC_CHECK_TIMEOUT,
+                self.schedule_next_sync)
+
+    def wake_sync(self, *args):
+        """process the sync queue on the next IOLoop iteration, safe to
+        call from the worker pool threads"""
+
+        IOLoop.instance().add_callback(self.process_sync_queue)
+
+    def sync_job(
+        self,
+        job,
+        *args,
+        **kwargs
+        ):
+        """run a sync job in the worker pool, the exception is returned
+        instead of raised so that the pool callback always fires. The
+        job is profiled and traced as a request named after the job, for
+        the zvol in args, within the trace given in kwargs"""
+
+        name = getattr(job, '__name__', 'sync_job')
+        request = profiler.PROFILER.request(name, args[1])
+        span = tracing.Span(name, kwargs.get('trace'), zvol=args[1])
         try:
-            with sqlite3.connect(self.SQLITE_DB) as con:
-                cur = con.cursor()
+            with request.context():
+                with span.context():
+                    job(*args)
+        except Exception, e:
+            span.finish(error=e)
+            return e
+        finally:
+            request.finish()
+        span.finish()
+
+    @coroutine
+    def process_sync_queue(self):
+        if self.sync_running:
+            self.sync_pending = True
+            return
+        self.sync_running = True
+        try:
+            while True:
+                self.sync_pending = False
+                yield self.sync_queue_pass()
+                if not self.sync_pending:
+                    break
+        finally:
+            self.sync_running = False
 
-                for (zvol, job_result) in self.results.items():
-                    if job_result.ready():
-                        del self.results[zvol]
+    @coroutine
+    def sync_queue_pass(self):
+
+        # the connection is shared by the coroutines of the IOLoop thread,
+        # no transaction is held across a yield
+
+        try:
+            for (zvol, job_result) in self.results.items():
+                if job_result.ready():
+                    del self.results[zvol]
+                    with self.state.connect() as con:
+                        cur = con.cursor()
                         cur.execute('''SELECT remotehost, is_sending, 
-                                        zvol, zpool, is_delete_remote 
+                                        zvol, zpool, is_delete_remote, trace 
                                         FROM sync_queue 
                                         WHERE zvol = ?'''
                                     , [zvol])
                         row = cur.fetchone()
 
-                        try:
-                            if not row:
-                                raise ActionError('Not found record for %s in sync_queue table'
-                                         % zvol)
+                    try:
+                        if not row:
+                            raise ActionError('Not found record for %s in sync_queue table'
+                                     % zvol)
 
-                            (remotehost, is_sending, zvol, zpool,
-                             is_delete_remote) = row
+                        (remotehost, is_sending, zvol, zpool,
+                         is_delete_remote, trace) = row
 
-                            self.logger.debug('Sync %s is ready' % zvol)
+                        self.logger.debug('Sync %s is ready' % zvol)
 
-                            job_result.get()  # will raise exception is there was one during job execution
-                            if is_sending:
+                        error = job_result.get()
+                        if isinstance(error, Exception):
+                            raise ActionError(str(error))
+                        if is_sending:
+                            with self.state.connect() as con:
+                                cur = con.cursor()
                                 cur.execute('SELECT iscsi_target FROM zvols WHERE zvol = ?'
                                         , [zvol])
                                 target = cur.fetchone()[0]
-                                self.queue_connector.publish_message(json.dumps({'action': 'sync_zvol'
-                                        , 'zvol': zvol,
-                                        'target': target}), remotehost,
-                                        self.NODE_NAME,
-                                        on_fail=lambda : \
-                                        self.logger.error('Compute node %s is unavailable to sync zvol %s'
-                                         % (remotehost, zvol)))  # reply back to compute node
-                            elif is_delete_remote:
-                                yield runCommandBackground(['su', self.imgUser 
-                                        , '-c',
-                                        '/usr/bin/ssh %s "/sbin/zfs destroy %s/%s -r"'
-                                         % (remotehost,
-                                        self.get_node_zpool(remotehost),
-                                        zvol)])
+                            self.queue_connector.publish_message(json.dumps({'action': 'sync_zvol'
+                                    , 'trace': trace, 'zvol': zvol,
+                                    'target': target}), remotehost,
+                                    self.NODE_NAME,
+                                    on_fail=lambda : \
+                                    self.logger.error('Compute node %s is unavailable to sync zvol %s'
+                                     % (remotehost, zvol)))  # reply back to compute node
+                        elif is_delete_remote:
+                            yield runCommandBackground(['su', self.imgUser,
+                                    '-c',
+                                    '/usr/bin/ssh %s "/sbin/zfs destroy %s/%s -r"'
+                                     % (remotehost,
+                                    self.get_node_zpool(remotehost),
+                                    zvol)])
+                            with self.state.connect() as con:
+                                cur = con.cursor()
                                 cur.execute('UPDATE zvols SET remotehost = NULL, zpool = NULL where zvol = ?'
                                         , [zvol])
                                 con.commit()
-                                self.release_zvol(zvol)
-                            else:
-                                (out, err) = \
-                                    (yield runCommandBackground(['su',
-                                        self.imgUser, '-c',
-                                        '/usr/bin/ssh %s "/sbin/zfs list -Hpr -t snapshot -o name -s creation  %s/%s"'
-                                         % (remotehost,
-                                        self.get_node_zpool(remotehost),
-                                        zvol)]))
-
-                                for snapshot in out[:-2]:
-                                    yield runCommandBackground(['su',
-        self.imgUser, '-c', '/usr/bin/ssh %s "/sbin/zfs destroy %s"'
-        % (remotehost, snapshot)])
-                        except ActionError, msg:
-
-                            self.logger.exception('Error performing sync for %s: %s'
-                                     % (zvol, str(msg)))
-                        finally:
+                            self.release_zvol(zvol)
+                        else:
+                            (out, err) = \
+                                (yield runCommandBackground(['su',
+                                    self.imgUser, '-c',
+                                    '/usr/bin/ssh %s "/sbin/zfs list -Hpr -t snapshot -o name -s creation  %s/%s"'
+                                     % (remotehost,
+                                    self.get_node_zpool(remotehost),
+                                    zvol)]))
+
+                            for snapshot in out[:-2]:
+                                yield runCommandBackground(['su',
+    self.imgUser, '-c', '/usr/bin/ssh %s "/sbin/zfs destroy %s"'
+    % (remotehost, snapshot)])
+                    except ActionError, msg:
+
+                        self.logger.exception('Error performing sync for %s: %s'
+                                 % (zvol, str(msg)))
+                    finally:
+                        with self.state.connect() as con:
+                            cur = con.cursor()
                             cur.execute('DELETE FROM sync_queue WHERE zvol = ?'
                                     , [zvol])
                             con.commit()
 
-                for row in \
-                    cur.execute('''SELECT remotehost, is_sending, zvol, 
-                                    zpool, is_delete_remote 
-                                    FROM sync_queue 
-                                    ORDER BY time ASC'''
-                                ):
-                    (remotehost, is_sending, zvol, zpool,
-                     is_delete_remote) = row
-                    self.logger.debug('Have sync job %s' % zvol)
-
-                    if self.ib_net:
-                        remotehost += '.%s' % self.ib_net
-
-                    if not self.results.get(zvol) and len(self.results) \
-                        < self.SYNC_WORKERS:
-                        self.logger.debug('Starting new sync %s' % zvol)
-                        if is_sending:
-                            self.results[zvol] = \
-                                self.pool.apply_async(self.upload_snapshot,
-                                    [zpool, zvol, remotehost])
-                        else:
-                            self.results[zvol] = \
-                                self.pool.apply_async(self.download_snapshot,
-                                    [zpool, zvol, remotehost])
+            # the order only matters when the jobs do not all fit in
+            # the workers
+
+            with self.state.connect() as con:
+                cur = con.cursor()
+                cur.execute('SELECT count(*) FROM sync_queue')
+                queued = cur.fetchone()[0]
+            if queued > self.SYNC_WORKERS:
+                yield self.estimate_sync_jobs()
 
-                self.queue_connector._connection.add_timeout(self.SYNC_CHECK_TIMEOUT,
-                        self.schedule_next_sync)
+            with self.state.connect() as con:
+                cur = con.cursor()
+                cur.execute('''SELECT remotehost, is_sending, zvol, 
+                                zpool, is_delete_remote, priority, trace 
+                                FROM sync_queue 
+                                ORDER BY IFNULL(priority, ?),
+                                time + IFNULL(estimate, 0) / ? ASC'''
+                            , [SYNC_PULL, float(self.SYNC_SORT_SPEED)])
+                rows = cur.fetchall()
+            pulls = len([row for row in rows if row[2] in self.results
+                        and row[5] == SYNC_PULL])
+            for row in rows:
+                (remotehost, is_sending, zvol, zpool, is_delete_remote,
+                 priority, trace) = row
+                self.logger.debug('Have sync job %s', zvol)
+
+                if self.ib_net:
+                    remotehost += '.%s' % self.ib_net
+
+                if self.results.get(zvol) or len(self.results) \
+                    >= self.SYNC_WORKERS:
+                    continue
+                if priority == SYNC_PULL and pulls \
+                    >= self.SYNC_PULL_WORKERS:
+                    continue
+                if priority == SYNC_PULL:
+                    pulls += 1
+                self.logger.debug('Starting new sync %s' % zvol)
+                if is_sending:
+                    job = self.upload_snapshot
+                else:
+                    job = self.download_snapshot
+                self.results[zvol] = self.pool.apply_async(self.sync_job,
+                        [job, zpool, zvol, remotehost], {'trace': trace},
+                        callback=self.wake_sync)
         except:
             self.logger.error('Exception in schedule_next_sync',
                               exc_info=True)
 
+    @coroutine
+    def estimate_sync_jobs(self):
+        """store the referenced size of the zvols queued without an
+        estimate, all the zvols are listed with a single zfs call"""
+
+        with self.state.connect() as con:
+            cur = con.cursor()
+            cur.execute('SELECT zvol, zpool FROM sync_queue WHERE estimate IS NULL'
+                        )
+            rows = cur.fetchall()
+        if not rows:
+            return
+        sizes = {}
+        try:
+            (out, err) = (yield runCommandBackground(['zfs', 'list', '-Hp'
+                          , '-o', 'name,referenced', '-t', 'volume']))
+            for line in out:
+                fields = line.split()
+                if len(fields) == 2 and fields[1].isdigit():
+                    sizes[fields[0]] = int(fields[1])
+        except ActionError, msg:
+            self.logger.error('Unable to list the zvol sizes: %s' % msg)
+        with self.state.connect() as con:
+            cur = con.cursor()
+            for (zvol, zpool) in rows:
+                cur.execute('UPDATE sync_queue SET estimate = ? WHERE zvol = ?'
+                            , [sizes.get('%s/%s' % (zpool, zvol), 0),
+                            zvol])
+            con.commit()
+
     def schedule_zvols_pull(self):
 
         # self.logger.debug("Scheduling new pull jobs")
 
-        with sqlite3.connect(self.SQLITE_DB) as con:
+        with self.state.connect() as con:
             try:
                 cur = con.cursor()
                 cur.execute('''SELECT zvol, zpool, remotehost 
@@ -618,10 +1097,15 @@ class NasDaemon:
                 rows = cur.fetchall()
                 for row in rows:
                     (zvol, zpool, remotehost) = row
-                    cur.execute('INSERT or IGNORE INTO sync_queue VALUES(?,?,?,0,0,?)'
+                    cur.execute('''INSERT or IGNORE INTO sync_queue(zvol,
+                                    zpool, remotehost, is_sending,
+                                    is_delete_remote, time, priority)
+                                    VALUES(?,?,?,0,0,?,?)'''
                                 , [zvol, zpool, remotehost,
-                                time.time()])
+                                time.time(), SYNC_PULL])
                     con.commit()
+                if rows:
+                    self.wake_sync()
             except Exception, ex:
                 self.logger.exception(ex)
 
@@ -631,30 +1115,88 @@ class NasDaemon:
     def snapname(self):
         return self.prefix + str(uuid.uuid4())
 
+    def transfer_limit(self, attr, hostname):
+        """bytes/sec limit set by the rate attribute of hostname, None if
+        the attribute is not set"""
+
+        rate = imgstorage.host_attributes.get(attr, hostname,
+                self.logger)
+        if not rate:
+            return None
+        try:
+            return parse_rate(rate)
+        except ValueError, e:
+            self.logger.error('%s of %s: %s' % (attr, hostname, str(e)))
+            return None
+
+    def update_bandwidth_limits(self):
+        """apply the changes of the rate attributes to the running
+        transfers, the attributes are cached so a change shows up after
+        the cache expires or the daemon is reloaded"""
+
+        try:
+            self.bandwidth.set_limit(self.transfer_limit('img_sync_bandwidth'
+                    , self.NODE_NAME))
+            for (remotehost, direction) in self.bandwidth.keys():
+                self.bandwidth.set_key_limit((remotehost, direction),
+                        self.transfer_limit('img_%s_speed' % direction,
+                        remotehost))
+        except ActionError, msg:
+            self.logger.error('Unable to update the transfer limits: %s'
+                              % msg)
+
+        self.queue_connector._connection.add_timeout(self.BANDWIDTH_UPDATE_TIMEOUT,
+                self.update_bandwidth_limits)
+
+    def transfer_progress(self, zvol):
+        """callback storing the progress of the zvol transfer in
+        sync_queue, called from the worker pool threads"""
+
+        def update(transferred, size, speed):
+            with self.state.connect() as con:
+                cur = con.cursor()
+                cur.execute('''UPDATE sync_queue SET transferred = ?,
+                                size = ?, speed = ? WHERE zvol = ?''',
+                            [transferred, size, speed, zvol])
+                con.commit()
+
+        return update
+
     def upload_snapshot(
         self,
         zpool,
         zvol,
         remotehost,
         ):
-        params = {
-            'user': self.imgUser,
-            'zpool': zpool,
-            'zvol': zvol,
-            'snap_name': self.snapname(),
-            'remotehost': remotehost,
-            'remotehost_zpool': self.get_node_zpool(remotehost),
-            }
-
-        upload_speed = imgstorage.get_attribute('img_upload_speed',
-                remotehost, self.logger)
-        params['throttle'] = (' | pv -L %s -q '
-                              % upload_speed if upload_speed else '')
-
-        runCommand(['zfs', 'snap', '%(zpool)s/%(zvol)s@%(snap_name)s'
-                   % params])
-        runCommand(['zfs send %(zpool)s/%(zvol)s@%(snap_name)s %(throttle)s | su %(user)s -c \'ssh %(remotehost)s "/sbin/zfs receive -F %(remotehost_zpool)s/%(zvol)s"\''
-                    % params], shell=True)
+        snapshot = '%s/%s@%s' % (zpool, zvol, self.snapname())
+        with self.bandwidth.open((remotehost, 'upload'),
+                                 self.transfer_limit('img_upload_speed',
+                                 remotehost)) as flow:
+            transfer = ZfsTransfer('%s/%s'
+                                   % (self.get_node_zpool(remotehost),
+                                   zvol), receiver=remotehost,
+                                   user=self.imgUser, flow=flow,
+                                   progress=self.transfer_progress(zvol))
+
+            # a full stream is sent, so the leftovers of an older upload
+            # are of no use
+
+            transfer.discard()
+            runCommand(['zfs', 'snap', snapshot])
+            start = time.time()
+            sent = transfer.send(snapshot)
+            self.track_sync('upload', start, sent)
+
+    def track_sync(
+        self,
+        direction,
+        start,
+        sent,
+        ):
+        metrics.SYNC_SECONDS.observe(time.time() - start,
+                                     direction=direction)
+        if sent is not None:
+            metrics.SYNC_BYTES.observe(sent, direction=direction)
 
     def download_snapshot(
         self,
@@ -662,28 +1204,31 @@ class NasDaemon:
         zvol,
         remotehost,
         ):
-        params = {
-            'user': self.imgUser,
-            'zpool': zpool,
-            'zvol': zvol,
-            'snap_name': self.snapname(),
-            'remotehost': remotehost,
-            'remotehost_zpool': self.get_node_zpool(remotehost),
-            'local_last_snapshot': self.find_last_snapshot(zpool,
-                    zvol),
-            }
-
-        download_speed = imgstorage.get_attribute('img_download_speed',
-                remotehost, self.logger)
-        params['throttle'] = (' | pv -L %s -q '
-                              % download_speed if download_speed else ''
-                              )
-
-        runCommand(['su', self.imgUser, '-c',
-                   '/usr/bin/ssh %(remotehost)s "/sbin/zfs snap %(remotehost_zpool)s/%(zvol)s@%(snap_name)s"'
-                    % params])
-        runCommand(['su %(user)s -c \'/usr/bin/ssh %(remotehost)s "/sbin/zfs send -i %(remotehost_zpool)s/%(zvol)s@%(local_last_snapshot)s %(remotehost_zpool)s/%(zvol)s@%(snap_name)s"\' %(throttle)s | zfs receive -F %(zpool)s/%(zvol)s'
-                    % params], shell=True)
+        remotehost_zpool = self.get_node_zpool(remotehost)
+        with self.bandwidth.open((remotehost, 'download'),
+                                 self.transfer_limit('img_download_speed',
+                                 remotehost)) as flow:
+            transfer = ZfsTransfer('%s/%s' % (zpool, zvol),
+                                   sender=remotehost, user=self.imgUser,
+                                   flow=flow,
+                                   progress=self.transfer_progress(zvol))
+
+            # finish the download interrupted last time before looking
+            # for the latest local snapshot
+
+            transfer.resume()
+            snap_name = self.snapname()
+            local_last_snapshot = self.find_last_snapshot(zpool, zvol)
+
+            runCommand(['su', self.imgUser, '-c',
+                       '/usr/bin/ssh %s "/sbin/zfs snap %s/%s@%s"'
+                       % (remotehost, remotehost_zpool, zvol, snap_name)])
+            start = time.time()
+            sent = transfer.send('%s/%s@%s' % (remotehost_zpool, zvol,
+                                 snap_name), '%s/%s@%s'
+                                 % (remotehost_zpool, zvol,
+                                 local_last_snapshot))
+            self.track_sync('download', start, sent)
 
         def destroy_local_snapshot(snapshot):
             runCommand(['/sbin/zfs', 'destroy', snapshot])
@@ -704,6 +1249,118 @@ class NasDaemon:
 	out = filter(lambda x : x.find(self.prefix) >= 0, out)
         map(destroy_local_snapshot, out[:-2])
 
+    def iscsi_target_name(self, zvol_name):
+        """same naming scheme used by tgt-setup-lun"""
+
+        return 'iqn.2001-04.com.%s-%s' % (self.NODE_NAME, zvol_name)
+
+    @coroutine
+    def create_iscsi_target(
+        self,
+        zvol_name,
+        device,
+        initiator,
+        ):
+        """
+        Export device as a new iSCSI target accessible only from the
+        initiator address and return the target name.
+
+        The TID is allocated by the daemon itself so, unlike
+        tgt-setup-lun, many targets can be created at the same time
+        without a host-wide lock.
+        """
+
+        target = self.iscsi_target_name(zvol_name)
+        while target in self.detached_targets:
+
+            # the previous export of the zvol has not been deleted yet
+
+            self.reclaim_iscsi_targets()
+            yield Task(IOLoop.instance().add_timeout, time.time() + 0.1)
+
+        def new_target(tid):
+            return runCommandBackground([
+                'tgtadm',
+                '--lld',
+                'iscsi',
+                '--op',
+                'new',
+                '--mode',
+                'target',
+                '--tid',
+                str(tid),
+                '-T',
+                target,
+                ])
+
+        tid = self.iscsi_targets.allocate_tid()
+        try:
+            try:
+                yield new_target(tid)
+            except ActionError:
+
+                # somebody else took the TID behind our back, try once
+                # more with a fresh view of tgtd
+
+                self.iscsi_targets.release_tid(tid)
+                self.iscsi_targets.reload()
+                tid = self.iscsi_targets.allocate_tid()
+                yield new_target(tid)
+            self.logger.debug('Created iSCSI target %s tid %s'
+                              % (target, tid))
+
+            try:
+                yield runCommandBackground([
+                    'tgtadm',
+                    '--lld',
+                    'iscsi',
+                    '--op',
+                    'new',
+                    '--mode',
+                    'logicalunit',
+                    '--tid',
+                    str(tid),
+                    '--lun',
+                    '1',
+                    '-b',
+                    device,
+                    ])
+                yield runCommandBackground([
+                    'tgtadm',
+                    '--lld',
+                    'iscsi',
+                    '--op',
+                    'bind',
+                    '--mode',
+                    'target',
+                    '--tid',
+                    str(tid),
+                    '-I',
+                    initiator,
+                    ])
+            except ActionError, err:
+                try:
+                    yield runCommandBackground([
+                        'tgtadm',
+                        '--lld',
+                        'iscsi',
+                        '--op',
+                        'delete',
+                        '--mode',
+                        'target',
+                        '--tid',
+                        str(tid),
+                        ])
+                except ActionError, msg:
+                    self.logger.error('Unable to remove target %s: %s'
+                            % (target, msg))
+                raise err
+            self.iscsi_targets.add(target, str(tid))
+        finally:
+            self.iscsi_targets.release_tid(tid)
+
+        raise Return(target)
+
     def detach_target(self, target, is_remove_host):
         if target:
             tgt_num = self.find_iscsi_target_num(target)
@@ -724,8 +1381,82 @@ class NasDaemon:
                     '--tid',
                     tgt_num,
                     ])
+                self.iscsi_targets.remove(target)
 
-        with sqlite3.connect(self.SQLITE_DB) as con:
+        self.forget_target(target, is_remove_host)
+
+    def defer_detach_target(self, target, is_remove_host):
+        """like detach_target but the iSCSI target is deleted later on by
+        reclaim_iscsi_targets together with the other released targets,
+        so the reply to the frontend does not wait for tgtadm"""
+
+        if target:
+            self.detached_targets.add(target)
+            if not self.reclaim_scheduled:
+                self.reclaim_scheduled = True
+                self.queue_connector._connection.add_timeout(self.TARGETS_RECLAIM_DELAY,
+                        self.reclaim_iscsi_targets)
+
+        self.forget_target(target, is_remove_host)
+
+    @coroutine
+    def reclaim_iscsi_targets(self):
+        """delete the detached targets in a batch, their TIDs are looked
+        up in a single tgtadm listing"""
+
+        self.reclaim_scheduled = False
+        if self.reclaim_running:
+            return
+        self.reclaim_running = True
+        try:
+            while self.detached_targets:
+                targets = list(self.detached_targets)
+
+                # the listing is only used to look up the TIDs of the
+                # detached targets, the table may have changed while
+                # tgtadm was running
+
+                try:
+                    (out, err) = (yield runCommandBackground(['tgtadm',
+                                  '--op', 'show', '--mode', 'target']))
+                    tids = parse_iscsi_targets(out)
+                except ActionError, msg:
+                    self.logger.error('Unable to list iSCSI targets: %s'
+                             % msg)
+                    tids = self.iscsi_targets.targets or {}
+                self.logger.debug('Reclaiming %s iSCSI targets'
+                                  % len(targets))
+                yield [self.delete_iscsi_target(target, tids.get(target))
+                       for target in targets]
+        finally:
+            self.reclaim_running = False
+
+    @coroutine
+    def delete_iscsi_target(self, target, tgt_num):
+        try:
+            if tgt_num:
+                yield runCommandBackground([
+                    'tgtadm',
+                    '--lld',
+                    'iscsi',
+                    '--op',
+                    'delete',
+                    '--mode',
+                    'target',
+                    '--tid',
+                    tgt_num,
+                    ])
+            self.iscsi_targets.remove(target)
+        except ActionError, msg:
+            self.logger.error('Unable to remove target %s: %s'
+                              % (target, msg))
+        finally:
+            self.detached_targets.discard(target)
+
+    def forget_target(self, target, is_remove_host):
+        """clear the target from the zvols table"""
+
+        with self.state.connect() as con:
             cur = con.cursor()
             if is_remove_host:
                 cur.execute('''UPDATE zvols 
@@ -742,7 +1473,7 @@ class NasDaemon:
             con.commit()
 
     def clear_zvols_table(self, zvol):
-        with sqlite3.connect(self.SQLITE_DB) as con:
+        with self.state.connect() as con:
             cur = con.cursor()
             cur.execute('''UPDATE zvols SET iscsi_target = NULL,
                     remotehost = NULL, zpool = NULL
@@ -751,19 +1482,60 @@ class NasDaemon:
             con.commit()
 
     def list_zvols(self, message, properties):
-        with sqlite3.connect(self.SQLITE_DB) as con:
-            cur = con.cursor()
-            cur.execute('''SELECT zvols.zvol, zvols.zpool, zvols.iscsi_target, 
+        """Reply with the zvols matching the optional zvol, remotehost and
+        state filters, sorted by name. If limit is given at most limit
+        zvols are returned starting after the zvol named by the after
+        cursor, and next holds the cursor of the following page (None on
+        the last page)"""
+
+        conditions = []
+        values = []
+        for key in ['zvol', 'remotehost']:
+            if message.get(key) is not None:
+                conditions.append('zvols.%s = ?' % key)
+                values.append(message[key])
+        if message.get('state') is not None:
+            if message['state'] not in ZVOL_STATES:
+                self.failAction(properties.reply_to, 'zvol_list',
+                                'Unknown state %s, valid states are %s'
+                                % (message['state'],
+                                ', '.join(sorted(ZVOL_STATES))),
+                                properties.message_id)
+                return
+            conditions.append(ZVOL_STATES[message['state']])
+        if message.get('after') is not None:
+            conditions.append('zvols.zvol > ?')
+            values.append(message['after'])
+
+        query = \
+            '''SELECT zvols.zvol, zvols.zpool, zvols.iscsi_target, 
                             zvols.remotehost, sync_queue.is_sending, 
-                            sync_queue.is_delete_remote, sync_queue.time 
+                            sync_queue.is_delete_remote, sync_queue.time,
+                            sync_queue.transferred, sync_queue.size,
+                            sync_queue.speed
                             from zvols 
-                            LEFT JOIN sync_queue ON zvols.zvol = sync_queue.zvol;'''
-                        )
+                            LEFT JOIN sync_queue ON zvols.zvol = sync_queue.zvol'''
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY zvols.zvol'
+        limit = message.get('limit')
+        if limit:
+            query += ' LIMIT ?'
+            values.append(int(limit))
+
+        with self.state.connect() as con:
+            cur = con.cursor()
+            cur.execute(query, values)
             r = [dict((cur.description[i][0], value) for (i, value) in
                  enumerate(row)) for row in cur.fetchall()]
+            next_cursor = None
+            if limit and len(r) == int(limit):
+                next_cursor = r[-1]['zvol']
             self.queue_connector.publish_message(json.dumps({'action': 'zvol_list'
-                    , 'status': 'success', 'body': r}), exchange='',
-                    routing_key=properties.reply_to)
+                    , 'status': 'success', 'body': r,
+                    'next': next_cursor}), exchange='',
+                    routing_key=properties.reply_to,
+                    correlation_id=properties.message_id)
 
     def process_message(self, properties, message_str, deliver):
 
@@ -772,61 +1544,90 @@ class NasDaemon:
         if message['action'] not in self.function_dict.keys():
             self.queue_connector.publish_message(json.dumps({'status': 'error',
                     'error': 'action_unsupported'}), exchange='',
-                    routing_key=properties.reply_to)
+                    routing_key=properties.reply_to,
+                    correlation_id=properties.message_id)
             return
 
+        start = time.time()
+        request = profiler.PROFILER.request(message['action'],
+                properties.message_id)
+        span = tracing.Span(message['action'], message.get('trace'),
+                            zvol=message.get('zvol'))
         try:
-            return self.function_dict[message['action']](message,
-                    properties)
+            with request.context():
+                with span.context():
+                    result = self.function_dict[message['action']](message,
+                            properties)
+            metrics.track_request(message['action'], start, result)
+            request.finish(result)
+            span.finish(result)
+            return result
         except:
+            metrics.track_request(message['action'], start, failed=True)
+            request.finish()
+            span.finish(error=sys.exc_info()[1])
             self.logger.exception('Unexpected error: %s %s'
                                   % (sys.exc_info()[0],
                                   sys.exc_info()[1]))
             if properties.reply_to:
                 self.queue_connector.publish_message(json.dumps({'status': 'error'
                         , 'error': sys.exc_info()[1].message}),
-                        exchange='', routing_key=properties.reply_to)
+                        exchange='', routing_key=properties.reply_to,
+                        correlation_id=properties.message_id)
 
     def stop(self):
         self.queue_connector.stop()
         self.logger.info('RabbitMQ connector stopping called')
 
-    def lock_zvol(self, zvol_name, reply_to):
-        with sqlite3.connect(self.SQLITE_DB) as con:
+    def lock_zvol(
+        self,
+        zvol_name,
+        reply_to,
+        correlation_id=None,
+        ):
+        with self.state.connect() as con:
             cur = con.cursor()
             try:
-                cur.execute('INSERT INTO zvol_calls VALUES (?,?,?)',
-                            (zvol_name, reply_to, time.time()))
+                cur.execute('''INSERT INTO zvol_calls(zvol, reply_to,
+                                time, correlation_id)
+                                VALUES (?,?,?,?)''',
+                            (zvol_name, reply_to, time.time(),
+                            correlation_id))
                 con.commit()
             except sqlite3.IntegrityError:
+                metrics.ZVOL_LOCKS.inc(result='busy')
                 raise ZvolBusyActionError('ZVol %s is busy' % zvol_name)
+            metrics.ZVOL_LOCKS.inc(result='acquired')
 
     def release_zvol(self, zvol):
-        with sqlite3.connect(self.SQLITE_DB) as con:
+        with self.state.connect() as con:
             cur = con.cursor()
             cur.execute('DELETE FROM zvol_calls WHERE zvol = ?', [zvol])
             con.commit()
 
     def find_iscsi_target_num(self, target):
-        out = runCommand(['tgtadm', '--op', 'show', '--mode', 'target'])
-        for line in out:
-            if line.startswith('Target ') and line.split()[2] == target:
-                return (line.split()[1])[:-1]
-        return None
+        tgt_num = self.iscsi_targets.get(target)
+        if tgt_num is None:
+
+            # the target might have been created outside of the daemon
+
+            self.iscsi_targets.reload()
+            tgt_num = self.iscsi_targets.get(target)
+        return tgt_num
 
     def is_sync_node(self, remotehost):
         """ Get information from attributes if image sync is enabled for the
         node"""
 
-        return rocks.util.str2bool(imgstorage.get_attribute('img_sync', remotehost,
+        return rocks.util.str2bool(imgstorage.host_attributes.get('img_sync', remotehost,
                 self.logger))
 
     def get_node_zpool(self, remotehost):
-        return imgstorage.get_attribute('vm_container_zpool',
+        return imgstorage.host_attributes.get('vm_container_zpool',
                 remotehost, self.logger)
 
     def is_remotehost_busy(self, remotehost):
-        with sqlite3.connect(self.SQLITE_DB) as con:
+        with self.state.connect() as con:
             cur = con.cursor()
             cur.execute('''SELECT zvols.remotehost 
                             FROM zvols JOIN zvol_calls 
@@ -66,34 +66,113 @@ import re
 import signal
 import sys
 import os
+import glob
 import traceback
 import rocks.db.helper
 import rocks.util
 
 from tornado.ioloop import IOLoop
-from tornado.gen import Task, coroutine
+from tornado.gen import Task, Return, coroutine
 
-from pysqlite2 import dbapi2 as sqlite3
+from imgstorage.statestore import StateStore
+from imgstorage import schema
+from imgstorage import metrics
+from imgstorage import profiler
+from imgstorage import tracing
+
+
+def parse_blk_dev_list(out):
+    """ Return mappings of isci targets from iscsiadm -m session -P3 """
+    mappings = {}
+    cur_target = None
+    for line in out:
+        if 'Target: ' in line:
+            cur_target = re.search(r'Target: ([\w\-\.]*)', line,
+                                   re.M).group(1)
+        if 'Attached scsi disk ' in line:
+            blockdev = re.search(r'Attached scsi disk (\w*)', line,
+                                 re.M)
+            mappings[cur_target] = blockdev.group(1)
+    return mappings
 
 
 def get_blk_dev_list():
     """ Return mappings of isci targets """
     try:
-        out = runCommand(['iscsiadm', '-m', 'session', '-P3'])
-        mappings = {}
-        cur_target = None
-        for line in out:
-            if 'Target: ' in line:
-                cur_target = re.search(r'Target: ([\w\-\.]*)', line,
-                                       re.M).group(1)
-            if 'Attached scsi disk ' in line:
-                blockdev = re.search(r'Attached scsi disk (\w*)', line,
-                                     re.M)
-                mappings[cur_target] = blockdev.group(1)
+        return parse_blk_dev_list(runCommand(['iscsiadm', '-m',
+                                  'session', '-P3']))
     except:
         return {}
 
-    return mappings
+
+def parse_dm_status(out):
+    """ Return mappings of device mapper devices to their status fields
+    from dmsetup status """
+    status = {}
+    for line in out:
+        if ':' not in line:
+            continue  # No devices found
+        (dev, fields) = line.split(':', 1)
+        status[dev.strip()] = fields.split()
+    return status
+
+
+class BlockDeviceIndex:
+
+    """
+    Index of the iSCSI sessions (target -> block device) read from sysfs.
+
+    Resolving a target costs a couple of file reads instead of forking
+    and parsing the full iscsiadm -m session -P3 output, and sessions
+    whose block device is already known are not resolved again. The
+    index is refreshed on every lookup, so a disk shows up as soon as
+    the kernel publishes it in sysfs.
+    """
+
+    def __init__(self, sysfs='/sys/class/iscsi_session'):
+        self.sysfs = sysfs
+        self.sessions = {}
+
+    def available(self):
+        return os.path.isdir(self.sysfs)
+
+    def resolve(self, session):
+        """return (target, block device, sysfs path of the device) for
+        the given session, block device is None if the kernel has not
+        attached the disk yet"""
+
+        session_dir = os.path.join(self.sysfs, session)
+        with open(os.path.join(session_dir, 'targetname')) as f:
+            target = f.read().strip()
+
+        # device/target<host>:<channel>:<id>/<h:c:i:lun>/block/<sdX>
+
+        for block in glob.glob(os.path.join(session_dir, 'device',
+                               'target*', '*', 'block', '*')):
+            return (target, os.path.basename(block), block)
+        return (target, None, None)
+
+    def refresh(self):
+        sessions = set(os.listdir(self.sysfs))
+        for session in self.sessions.keys():
+            if session not in sessions:
+                del self.sessions[session]
+        for session in sessions:
+            entry = self.sessions.get(session)
+            if entry and entry[2] and os.path.exists(entry[2]):
+                continue
+            try:
+                self.sessions[session] = self.resolve(session)
+            except (IOError, OSError):
+
+                # session went away while we were reading it
+
+                self.sessions.pop(session, None)
+
+    def mappings(self):
+        self.refresh()
+        return dict((target, bdev) for (target, bdev, path) in
+                    self.sessions.values() if bdev)
 
 
 def disconnect_iscsi(iscsi_target):
@@ -147,6 +226,37 @@ class VmDaemon:
         self.temp_size = 35
 
         self.SYNC_CHECK_TIMEOUT = 10
+        self.BLK_DEV_TIMEOUT = 3.5
+
+        # backoff while waiting for the VM to close its disk on unmap
+
+        self.RELEASE_MIN_INTERVAL = 0.05
+        self.RELEASE_MAX_INTERVAL = 2
+        self.RELEASE_TIMEOUT = 120
+
+        if NodeConfig.IMG_SYNC_WORKERS:
+            self.SYNC_WORKERS = int(NodeConfig.IMG_SYNC_WORKERS)
+        else:
+            self.SYNC_WORKERS = 5
+
+        # zvol -> merge progress of the running snapshot-merges
+
+        self.merges = {}
+
+        # zvol -> span of the queued and running merges, it holds the
+        # trace of the sync_zvol request
+
+        self.merge_spans = {}
+        self.sync_running = False
+
+        # /metrics is served on localhost once the daemon is connected,
+        # 0 disables it
+
+        self.METRICS_PORT = int(NodeConfig.IMG_METRICS_PORT or 9411)
+        self.metrics_started = False
+        self.sync_pending = False
+
+        self.blk_devs = BlockDeviceIndex()
 
         rocks.db.helper.DatabaseHelper().closeSession()  # to reopen after daemonization
 
@@ -162,55 +272,41 @@ class VmDaemon:
         self.logger.debug('Setting zvol %s' % message['target'])
         zvol = message.get('zvol')
         try:
-            self.connect_iscsi(message['target'], message['nas'])
+            yield self.connect_iscsi(message['target'], message['nas'])
 
-            # sometime get_blk_dev_list does not find the device because
-            # the kernel hasn't populated the entry in sysfs so we need
-            # this polling to make sure we avoid this latency
-
-            count = 0
-            while True:
-                mappings = get_blk_dev_list()
-                if message['target'] in mappings.keys():
-                    break
-                else:
-                    if count == 3:
-                        raise ActionError('Not found %s in targets'
-                                % message['target'])
-
-                    # asynchronous time.sleep(1)
-
-                    yield Task(IOLoop.instance().add_timeout,
-                               time.time() + 1)
-                    count += 1
-
-            bdev = '/dev/%s' % mappings[message['target']]
+            bdev = '/dev/%s' % (yield self.wait_blk_dev(message['target'
+                                ]))
 
             if self.sync_enabled:
                 temp_size_cur = min(self.temp_size, int(message['size'
                                     ]) - 1)
                 if zvol and len(zvol) > 0:  # don't want to destroy the zpool
                     try:
-                        runCommand(['zfs', 'destroy', '-r', '%s/%s'
-                                   % (self.ZPOOL, zvol)])
+                        yield runCommandBackground(['zfs', 'destroy',
+                                '-r', '%s/%s' % (self.ZPOOL, zvol)])
                     except:
                         pass
-                runCommand(zfs_create + ['-V', '%sgb'
-                           % message['size'], '%s/%s' % (self.ZPOOL,
-                           zvol)])
-                runCommand(zfs_create + ['-V', '%sgb'
-                           % temp_size_cur, '%s/%s-temp-write'
-                           % (self.ZPOOL, zvol)])
-                time.sleep(2)
-                runCommand(['dmsetup', 'create', '%s-snap' % zvol,
-                           '--table',
-                           '0 %s snapshot %s /dev/zvol/%s/%s-temp-write P 16'
-                            % (int(1024 ** 3 * temp_size_cur / 512),
-                           bdev, self.ZPOOL, zvol)])
+                yield runCommandBackground(zfs_create + ['-V', '%sgb'
+                        % message['size'], '%s/%s' % (self.ZPOOL,
+                        zvol)])
+                yield runCommandBackground(zfs_create + ['-V', '%sgb'
+                        % temp_size_cur, '%s/%s-temp-write'
+                        % (self.ZPOOL, zvol)])
+
+                # give udev the time to create the zvol device links
+
+                yield Task(IOLoop.instance().add_timeout, time.time()
+                           + 2)
+                yield runCommandBackground(['dmsetup', 'create',
+                        '%s-snap' % zvol, '--table',
+                        '0 %s snapshot %s /dev/zvol/%s/%s-temp-write P 16'
+                         % (int(1024 ** 3 * temp_size_cur / 512), bdev,
+                        self.ZPOOL, zvol)])
                 bdev = '/dev/mapper/%s-snap' % zvol
 
             self.queue_connector.publish_message(json.dumps({
                 'action': 'zvol_mapped',
+                'trace': tracing.current_trace(),
                 'target': message['target'],
                 'bdev': bdev,
                 'status': 'success',
@@ -222,6 +318,7 @@ class VmDaemon:
         except ActionError, msg:
             self.queue_connector.publish_message(json.dumps({
                 'action': 'zvol_mapped',
+                'trace': tracing.current_trace(),
                 'target': message['target'],
                 'status': 'error',
                 'error': str(msg),
@@ -234,6 +331,7 @@ class VmDaemon:
                               exc_info=True)
             self.queue_connector.publish_message(json.dumps({
                 'action': 'zvol_unmapped',
+                'trace': tracing.current_trace(),
                 'target': message['target'],
                 'zvol': zvol,
                 'status': 'error',
@@ -241,11 +339,49 @@ class VmDaemon:
                 }), props.reply_to, reply_to=self.NODE_NAME,
                     correlation_id=props.message_id)
 
+    @coroutine
+    def get_blk_dev_mappings(self):
+        """return the iscsi target -> block device mappings, from sysfs
+        when possible otherwise from iscsiadm"""
+
+        if self.blk_devs.available():
+            try:
+                raise Return(self.blk_devs.mappings())
+            except (IOError, OSError):
+                self.logger.exception('Unable to read iSCSI sessions from sysfs'
+                        )
+        try:
+            (out, err) = (yield runCommandBackground(['iscsiadm', '-m',
+                          'session', '-P3']))
+        except ActionError:
+            raise Return({})
+        raise Return(parse_blk_dev_list(out))
+
+    @coroutine
+    def wait_blk_dev(self, target):
+        """return the block device of target, waiting for the kernel to
+        attach the disk after the iscsi login"""
+
+        # sysfs is cheap to read so it can be checked often, iscsiadm
+        # forks and parses all the sessions
+
+        interval = (0.1 if self.blk_devs.available() else 1)
+        deadline = time.time() + self.BLK_DEV_TIMEOUT
+        while True:
+            mappings = (yield self.get_blk_dev_mappings())
+            if target in mappings:
+                raise Return(mappings[target])
+            if time.time() + interval > deadline:
+                raise ActionError('Not found %s in targets' % target)
+            yield Task(IOLoop.instance().add_timeout, time.time()
+                       + interval)
+
+    @coroutine
     def list_dev(self, message, props):
         if self.sync_enabled:
-            mappings = self.get_dev_list()
+            mappings = (yield self.get_dev_list())
         else:
-            mappings_map = get_blk_dev_list()
+            mappings_map = (yield self.get_blk_dev_mappings())
             mappings = []
             for target in mappings_map.keys():
                 mappings.append({'target': target,
@@ -256,17 +392,20 @@ class VmDaemon:
             'status': 'success',
             'node_type': ('sync' if self.sync_enabled else 'iscsi'),
             'body': mappings,
-            }), exchange='', routing_key=props.reply_to)
+            }), exchange='', routing_key=props.reply_to,
+                correlation_id=props.message_id)
 
+    @coroutine
     def get_dev_list(self):
         mappings = {}
-        bdev_mappings = get_blk_dev_list()
+        bdev_mappings = (yield self.get_blk_dev_mappings())
 
         try:
-            out = runCommand(['dmsetup', 'status'])
-        except:
+            (out, err) = (yield runCommandBackground(['dmsetup', 'status'
+                          ]))
+        except ActionError:
             out = []
-        if out[0] == 'No devices found':
+        if out and out[0] == 'No devices found':
             out = []
         for line in out:
             dev_ar = line.split()
@@ -285,18 +424,22 @@ class VmDaemon:
                     mappings[zvol_name]['target'] = target
                     mappings[zvol_name]['bdev'] = bdev_mappings[target]
 
-        with sqlite3.connect(self.SQLITE_DB) as con:
+        with self.state.connect() as con:
             cur = con.cursor()
-            cur.execute('SELECT zvol, started, time from sync_queue;')
+            cur.execute('SELECT zvol, started, time from merge_queue;')
             for row in cur.fetchall():
                 (zvol, started, time) = row
                 mappings[zvol]['started'] = started
                 mappings[zvol]['time'] = time
+                if zvol in self.merges:
+                    mappings[zvol]['progress'] = \
+                        self.merges[zvol]['progress']
 
-        return mappings
+        raise Return(mappings)
 
+    @coroutine
     def connect_iscsi(self, iscsi_target, node_name):
-        connect_out = runCommand([
+        (connect_out, err) = (yield runCommandBackground([
             'iscsiadm',
             '-m',
             'discovery',
@@ -304,13 +447,13 @@ class VmDaemon:
             'sendtargets',
             '-p',
             node_name,
-            ])
+            ]))
         self.logger.debug('Looking for target in iscsiadm output')
         for line in connect_out:
             if iscsi_target in line:  # has the target
                 self.logger.debug('Found iscsi target in iscsiadm output'
                                   )
-                return runCommand([
+                (out, err) = (yield runCommandBackground([
                     'iscsiadm',
                     '-m',
                     'node',
@@ -319,10 +462,36 @@ class VmDaemon:
                     '-p',
                     node_name,
                     '-l',
-                    ])
+                    ]))
+                raise Return(out)
         raise ActionError('Could not find iSCSI target %s on compute node %s'
                            % (iscsi_target, node_name))
 
+    @coroutine
+    def wait_released(self, device):
+        """wait until no process holds the device open, polling with
+        exponential backoff without blocking the other requests"""
+
+        try:
+            usage = FileUsage(device)
+        except OSError:
+            return
+
+        interval = self.RELEASE_MIN_INTERVAL
+        deadline = time.time() + self.RELEASE_TIMEOUT
+        while True:
+            holder = usage.holder()
+            if not holder:
+                return
+            if time.time() + interval > deadline:
+                raise ActionError('%s is still in use by %s after %s seconds'
+                                  % (device, holder, self.RELEASE_TIMEOUT))
+            self.logger.debug('%s is in use by %s' % (device, holder))
+            yield Task(IOLoop.instance().add_timeout, time.time()
+                       + interval)
+            interval = min(interval * 2, self.RELEASE_MAX_INTERVAL)
+
+    @coroutine
     def unmap_zvol(self, message, props):
         """ Received zvol unmap_zvol command from nas """
 
@@ -332,17 +501,12 @@ class VmDaemon:
             if self.sync_enabled:
                 self.logger.debug('Tearing down zvol %s'
                                   % message['zvol'])
-                while True:
-                    if isFileUsed('/dev/mapper/%s-snap' % zvol):
-                        time.sleep(0.1)
-                        self.logger.debug('/dev/mapper/%s-snap is in use'
-                                 % zvol)
-                    else:
-                        break
-                runCommand(['dmsetup', 'remove', '--retry', '%s-snap'
-                           % zvol])
+                yield self.wait_released('/dev/mapper/%s-snap' % zvol)
+                yield runCommandBackground(['dmsetup', 'remove',
+                        '--retry', '%s-snap' % zvol])
                 self.queue_connector.publish_message(json.dumps({
                     'action': 'zvol_unmapped',
+                    'trace': tracing.current_trace(),
                     'target': message['target'],
                     'zvol': zvol,
                     'status': 'success',
@@ -352,20 +516,22 @@ class VmDaemon:
 
                 self.logger.debug('Tearing down target %s'
                                   % message['target'])
-                mappings_map = get_blk_dev_list()
-                if message['target'] not in mappings_map.keys() \
-                    or disconnect_iscsi(message['target']):
-                    self.queue_connector.publish_message(json.dumps({
-                        'action': 'zvol_unmapped',
-                        'target': message['target'],
-                        'zvol': zvol,
-                        'status': 'success',
-                        }), props.reply_to, reply_to=self.NODE_NAME,
-                            correlation_id=props.message_id)
+                mappings_map = (yield self.get_blk_dev_mappings())
+                if message['target'] in mappings_map.keys():
+                    yield self.disconnect_iscsi(message['target'])
+                self.queue_connector.publish_message(json.dumps({
+                    'action': 'zvol_unmapped',
+                    'trace': tracing.current_trace(),
+                    'target': message['target'],
+                    'zvol': zvol,
+                    'status': 'success',
+                    }), props.reply_to, reply_to=self.NODE_NAME,
+                        correlation_id=props.message_id)
         except ActionError, msg:
 
             self.queue_connector.publish_message(json.dumps({
                 'action': 'zvol_unmapped',
+                'trace': tracing.current_trace(),
                 'target': message['target'],
                 'zvol': zvol,
                 'status': 'error',
@@ -375,21 +541,23 @@ class VmDaemon:
             self.logger.error('Error unmapping %s: %s'
                               % (message['target'], str(msg)))
 
+    @coroutine
     def sync_zvol(self, message, props):
         zvol = message.get('zvol')
         target = message.get('target')
 
-        mappings = get_blk_dev_list()
+        mappings = (yield self.get_blk_dev_mappings())
         try:
             if target not in mappings.keys():
                 raise ActionError('Not found %s in targets' % target)
 
-            devsize = runCommand(['blockdev', '--getsize', '/dev/%s'
-                                 % mappings[target]])[0]
+            (out, err) = (yield runCommandBackground(['blockdev',
+                          '--getsize', '/dev/%s' % mappings[target]]))
+            devsize = out[0]
 
-            with sqlite3.connect(self.SQLITE_DB) as con:
+            with self.state.connect() as con:
                 cur = con.cursor()
-                cur.execute('INSERT INTO sync_queue VALUES(?,?,?,?,?,0,?)'
+                cur.execute('INSERT INTO merge_queue VALUES(?,?,?,?,?,0,?)'
                             , [
                     zvol,
                     target,
@@ -401,9 +569,13 @@ class VmDaemon:
                 self.logger.debug('Updated the db for zvol %s : %s'
                                   % (zvol, devsize))
                 con.commit()
+            self.merge_spans[zvol] = tracing.Span('merge', zvol=zvol)
+            self.wake_sync()
         except ActionError, msg:
+            self.merge_spans.pop(zvol, None)
             self.queue_connector.publish_message(json.dumps({
                 'action': 'zvol_synced',
+                'trace': tracing.current_trace(),
                 'zvol': zvol,
                 'status': 'error',
                 'error': str(msg),
@@ -412,109 +584,240 @@ class VmDaemon:
             self.logger.exception('Error syncing %s: %s' % (zvol,
                                   str(msg)))
 
-    def run_sync(self):
-        with sqlite3.connect(self.SQLITE_DB) as con:
-            cur = con.cursor()
-            cur.execute('''SELECT zvol, iscsi_target, 
-                            devsize, reply_to,
-                            correlation_id, started 
-                            FROM sync_queue ORDER BY time ASC LIMIT 1'''
-                        )
-            row = cur.fetchone()
-            if row:
-                (
-                    zvol,
-                    target,
-                    devsize,
-                    reply_to,
-                    correlation_id,
-                    started,
-                    ) = row
-
-                try:
-                    start = time.time()
-                    if not started:
-                        self.logger.debug('Starting new sync %s' % zvol)
-                        runCommand(['dmsetup', 'suspend',
-                                   '/dev/mapper/%s-snap' % zvol])
-                        runCommand(['dmsetup', 'reload',
-                                   '/dev/mapper/%s-snap' % zvol,
-                                   '--table',
-                                   '0 %s snapshot-merge /dev/zvol/%s/%s /dev/zvol/%s/%s-temp-write P 16'
-                                    % (devsize, self.ZPOOL, zvol,
-                                   self.ZPOOL, zvol)])
-                        runCommand(['dmsetup', 'resume',
-                                   '/dev/mapper/%s-snap' % zvol])
-                        cur.execute('UPDATE sync_queue SET started = 1 WHERE zvol = ?'
-                                    , [zvol])
-                        con.commit()
-                        self.logger.debug('Initial sync finished in %s'
-                                % (time.time() - start))
-
-                    sync_status = runCommand(['dmsetup', 'status',
-                            '%s-snap' % zvol])
-                    stats = re.findall(r"[\w-]+", sync_status[0])
-                    if not stats[3] == stats[5]:
-                        self.logger.debug("Waiting for sync '%s' %s %s"
-                                % (sync_status[0], stats[3], stats[5]))
-                    else:
-                        cur.execute('DELETE FROM sync_queue WHERE zvol = ?'
-                                    , [zvol])
-                        con.commit()
-
-                        self.logger.debug('Reloaded local storage to zvol and temp %s in %s'
-                                 % (runCommand(['dmsetup', 'status',
-                                '%s-snap' % zvol])[0], time.time()
-                                - start))
-                        runCommand(['dmsetup', 'suspend',
+    @coroutine
+    def reload_dm_table(self, zvol, table):
+        """replace the device mapper table of the zvol snapshot device"""
+
+        yield runCommandBackground(['dmsetup', 'suspend',
                                    '/dev/mapper/%s-snap' % zvol])
-                        runCommand(['dmsetup', 'reload',
+        yield runCommandBackground(['dmsetup', 'reload',
                                    '/dev/mapper/%s-snap' % zvol,
-                                   '--table',
-                                   '0 %s linear /dev/zvol/%s/%s 0'
-                                   % (devsize, self.ZPOOL, zvol)])
-                        runCommand(['dmsetup', 'resume',
+                                   '--table', table])
+        yield runCommandBackground(['dmsetup', 'resume',
                                    '/dev/mapper/%s-snap' % zvol])
-                        self.logger.debug('Synced local storage to local in %s'
-                                 % (time.time() - start))
-                        runCommand(['zfs', 'destroy', '%s/%s-temp-write'
-                                    % (self.ZPOOL, zvol)])
-                        disconnect_iscsi(target)
-
-                        self.queue_connector.publish_message(json.dumps({'action': 'zvol_synced'
-                                , 'zvol': zvol, 'status': 'success'}),
-                                reply_to, correlation_id=correlation_id)
-                        self.logger.debug('Sync time: %s'
-                                % (time.time() - start))
-                except ActionError, msg:
-                    cur.execute('DELETE FROM sync_queue WHERE zvol = ?'
-                                , [zvol])
-                    con.commit()
-
-                    self.logger.exception('Error syncing %s: %s'
-                            % (zvol, str(msg)))
-                    self.queue_connector.publish_message(json.dumps({
-                        'action': 'zvol_synced',
-                        'zvol': zvol,
-                        'status': 'error',
-                        'error': str(msg),
-                        }), reply_to, correlation_id=correlation_id)
 
+    @coroutine
+    def disconnect_iscsi(self, iscsi_target):
+        yield runCommandBackground([
+            'iscsiadm',
+            '-m',
+            'node',
+            '-T',
+            iscsi_target,
+            '-u',
+            ])
+
+    def run_sync(self):
+        """periodic fallback, the sync queue is normally processed as soon
+        as a zvol is queued or device mapper reports a merge event"""
+
+        self.process_sync_queue()
         self.queue_connector._connection.add_timeout(self.SYNC_CHECK_TIMEOUT,
                 self.run_sync)
 
+    def wake_sync(self):
+        IOLoop.instance().add_callback(self.process_sync_queue)
+
+    @coroutine
+    def process_sync_queue(self):
+        if self.sync_running:
+            self.sync_pending = True
+            return
+        self.sync_running = True
+        try:
+            while True:
+                self.sync_pending = False
+                yield self.sync_queue_pass()
+                if not self.sync_pending:
+                    break
+        finally:
+            self.sync_running = False
+
+    @coroutine
+    def sync_queue_pass(self):
+        """start the snapshot-merges of the queued zvols, up to
+        SYNC_WORKERS at a time, and finish the ones which are merged"""
+
+        try:
+            with self.state.connect() as con:
+                cur = con.cursor()
+                cur.execute('''SELECT zvol, iscsi_target, 
+                                devsize, reply_to,
+                                correlation_id, started 
+                                FROM merge_queue ORDER BY time ASC''')
+                rows = cur.fetchall()
+
+            running = [row for row in rows if row[5]]
+            waiting = [row for row in rows if not row[5]]
+            waiting = waiting[:max(self.SYNC_WORKERS - len(running), 0)]
+            if waiting:
+                started = (yield [self.start_merge(*row[:5])
+                           for row in waiting])
+                running += [row for (row, ok) in zip(waiting, started)
+                            if ok]
+
+            if running:
+                (out, err) = (yield runCommandBackground(['dmsetup',
+                              'status']))
+                status = parse_dm_status(out)
+                yield [self.check_merge(row[:5], status.get('%s-snap'
+                       % row[0])) for row in running]
+        except:
+            self.logger.exception('Error running the sync queue')
+
+    @coroutine
+    def wait_merge(self, zvol):
+        """wait for the next device mapper event on the merging device,
+        raised when the merge completes, and process the sync queue"""
+
+        dev = '%s-snap' % zvol
+        try:
+            (out, err) = (yield runCommandBackground(['dmsetup', 'info',
+                          '-c', '--noheadings', '-o', 'events', dev]))
+            yield runCommandBackground(['dmsetup', 'wait', dev,
+                    out[0].strip()])
+        except ActionError, msg:
+
+            # leave the merge to the periodic check
+
+            self.logger.debug('Stopped waiting for %s events: %s'
+                              % (dev, str(msg)))
+            return
+        if zvol in self.merges:
+            self.merges[zvol]['waiting'] = False
+        self.wake_sync()
+
+    @coroutine
+    def start_merge(self, zvol, target, devsize, reply_to,
+                    correlation_id):
+        """merge the temp-write volume back into the local zvol,
+        return False if the merge could not be started"""
+
+        try:
+            self.logger.debug('Starting new sync %s' % zvol)
+            start = time.time()
+            yield self.reload_dm_table(zvol,
+                    '0 %s snapshot-merge /dev/zvol/%s/%s /dev/zvol/%s/%s-temp-write P 16'
+                     % (devsize, self.ZPOOL, zvol, self.ZPOOL, zvol))
+            with self.state.connect() as con:
+                cur = con.cursor()
+                cur.execute('UPDATE merge_queue SET started = 1 WHERE zvol = ?'
+                            , [zvol])
+                con.commit()
+            self.logger.debug('Initial sync finished in %s'
+                              % (time.time() - start))
+        except ActionError, msg:
+            self.fail_sync(zvol, reply_to, correlation_id, msg)
+            raise Return(False)
+        raise Return(True)
+
+    @coroutine
+    def check_merge(self, row, stats):
+        """record the progress of a running snapshot-merge given its
+        dmsetup status fields, and switch the zvol to the local
+        volume once the merge is complete"""
+
+        (zvol, target, devsize, reply_to, correlation_id) = row
+        try:
+            if not stats or stats[2] != 'snapshot-merge':
+                raise ActionError('Snapshot merge device of %s not found: %s'
+                                   % (zvol, stats))
+
+            # <allocated sectors>/<total sectors> <metadata sectors>
+
+            allocated = int(stats[3].split('/')[0])
+            metadata = int(stats[4])
+            merge = self.merges.setdefault(zvol, {'start': time.time(),
+                    'allocated': allocated})
+            if merge['allocated'] > metadata:
+                merge['progress'] = 100 * (merge['allocated']
+                        - allocated) / (merge['allocated'] - metadata)
+            else:
+                merge['progress'] = 100
+
+            if allocated != metadata:
+                self.logger.debug('Waiting for sync %s: %s%% merged'
+                                  % (zvol, merge['progress']))
+                if not merge.get('waiting'):
+                    merge['waiting'] = True
+                    self.wait_merge(zvol)
+                return
+
+            with self.state.connect() as con:
+                cur = con.cursor()
+                cur.execute('DELETE FROM merge_queue WHERE zvol = ?',
+                            [zvol])
+                con.commit()
+            del self.merges[zvol]
+
+            start = time.time()
+            yield self.reload_dm_table(zvol, '0 %s linear /dev/zvol/%s/%s 0'
+                     % (devsize, self.ZPOOL, zvol))
+            self.logger.debug('Synced local storage to local in %s'
+                              % (time.time() - start))
+            yield runCommandBackground(['zfs', 'destroy',
+                    '%s/%s-temp-write' % (self.ZPOOL, zvol)])
+            yield self.disconnect_iscsi(target)
+
+            span = self.merge_spans.pop(zvol, None)
+            self.queue_connector.publish_message(json.dumps({'action': 'zvol_synced'
+                    , 'trace': (span.trace if span else None),
+                    'zvol': zvol, 'status': 'success'}), reply_to,
+                    correlation_id=correlation_id)
+            if span:
+                span.finish()
+            self.logger.debug('Sync time: %s' % (time.time()
+                              - merge['start']))
+            metrics.MERGE_SECONDS.observe(time.time() - merge['start'])
+        except ActionError, msg:
+            self.fail_sync(zvol, reply_to, correlation_id, msg)
+
+    def fail_sync(self, zvol, reply_to, correlation_id, msg):
+        with self.state.connect() as con:
+            cur = con.cursor()
+            cur.execute('DELETE FROM merge_queue WHERE zvol = ?', [zvol])
+            con.commit()
+        self.merges.pop(zvol, None)
+
+        self.logger.error('Error syncing %s: %s' % (zvol, str(msg)))
+        span = self.merge_spans.pop(zvol, None)
+        if span:
+            span.finish(error=msg)
+        self.queue_connector.publish_message(json.dumps({
+            'action': 'zvol_synced',
+            'trace': (span.trace if span else None),
+            'zvol': zvol,
+            'status': 'error',
+            'error': str(msg),
+            }), reply_to, correlation_id=correlation_id)
+
     def process_message(self, props, message_str, deliver):
         message = json.loads(message_str)
-        self.logger.debug('Received message %s' % message)
+        self.logger.debug('Received message %s', message)
         if message['action'] not in self.function_dict.keys():
             self.queue_connector.publish_message(json.dumps({'status': 'error',
                     'error': 'action_unsupported'}), exchange='',
-                    routing_key=props.reply_to)
+                    routing_key=props.reply_to,
+                    correlation_id=props.message_id)
             return
 
+        start = time.time()
+        request = profiler.PROFILER.request(message['action'],
+                props.message_id)
+        span = tracing.Span(message['action'], message.get('trace'),
+                            zvol=message.get('zvol'))
         try:
-            self.function_dict[message['action']](message, props)
+            with request.context():
+                with span.context():
+                    result = self.function_dict[message['action']](message,
+                            props)
+            metrics.track_request(message['action'], start, result)
+            request.finish(result)
+            span.finish(result)
         except:
+            metrics.track_request(message['action'], start, failed=True)
+            request.finish()
+            span.finish(error=sys.exc_info()[1])
             self.logger.exception('Unexpected error: %s %s'
                                   % (sys.exc_info()[0],
                                   sys.exc_info()[1]))
@@ -526,24 +829,42 @@ class VmDaemon:
 
     def run(self):
         self.logger.debug('imgstoragevm starting')
-        with sqlite3.connect(self.SQLITE_DB) as con:
-            cur = con.cursor()
-            cur.execute('''CREATE TABLE IF NOT EXISTS sync_queue(
-                                zvol TEXT PRIMARY KEY NOT NULL, 
-                                iscsi_target TEXT UNIQUE, 
-                                devsize INT, reply_to TEXT, 
-                                correlation_id TEXT, 
-                                started BOOLEAN default 0, time INT)'''
-                        )
-            con.commit()
+        self.state = StateStore(self.SQLITE_DB)
+        schema.upgrade(self.state.connect())
+        if NodeConfig.IMG_PROFILE:
+            profiler.PROFILER.enable(NodeConfig.IMG_PROFILE)
 
         self.queue_connector = RabbitMQCommonClient('rocks.vm-manage',
                 'direct', "img-storage", "img-storage",
                 self.process_message, lambda a: \
-                self.run_sync(),
+                self.startup(),
                 routing_key=NodeConfig.NODE_NAME)
         self.queue_connector.run()
 
+    def startup(self):
+        self.run_sync()
+        if not self.metrics_started:
+            self.metrics_started = True
+            self.register_metrics()
+            metrics.serve(self.METRICS_PORT, self.logger)
+
+    def register_metrics(self):
+
+        def queued():
+            cur = self.state.connect().cursor()
+            cur.execute('SELECT count(*) FROM merge_queue')
+            return cur.fetchone()[0]
+
+        metrics.REGISTRY.gauge('imgstorage_merge_queue_jobs',
+                               'Zvols waiting for or running a snapshot merge'
+                               , (), queued)
+        metrics.REGISTRY.gauge('imgstorage_merges_running',
+                               'Snapshot merges in progress', (),
+                               lambda : len(self.merges))
+        metrics.REGISTRY.gauge('imgstorage_merge_workers',
+                               'Snapshot merges allowed in parallel', (),
+                               lambda : self.SYNC_WORKERS)
+
     def stop(self):
         self.queue_connector.stop()
         self.logger.info('RabbitMQ connector stopped')
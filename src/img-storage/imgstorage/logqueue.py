@@ -0,0 +1,286 @@
+#!/opt/rocks/bin/python
+# @Copyright@
+#
+#                               Rocks(r)
+#                        www.rocksclusters.org
+#                        version 5.6 (Emerald Boa)
+#                        version 6.1 (Emerald Boa)
+#
+# Copyright (c) 2000 - 2013 The Regents of the University of California.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement:
+#
+#       "This product includes software developed by the Rocks(r)
+#       Cluster Group at the San Diego Supercomputer Center at the
+#       University of California, San Diego and its contributors."
+#
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of
+# the associated name, interested parties should contact Technology
+# Transfer & Intellectual Property Services, University of California,
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910,
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# @Copyright@
+#
+"""
+Logging of the daemons off the IOLoop thread.
+
+QueueHandler merges the arguments into the message of each record on
+the calling thread (QueueHandler.prepare), puts the record in a queue
+and returns. A writer thread formats the records as JSON lines
+(JsonFormatter) and writes them to the file handler, so a busy disk
+does not stall the handling of the requests. The writer thread is
+started by the first record logged by a process, so the handler can be
+set up before the daemon forks. When the queue is full the records are
+dropped and counted rather than blocking the caller.
+
+RateLimitFilter keeps the repetitive messages, as the ones logged for
+every queued job on every pass of the sync queue, from flooding the
+log, and set_levels sets the level of each subsystem from the
+img_log_levels attribute.
+"""
+
+import atexit
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+
+class JsonFormatter(logging.Formatter):
+
+    """one JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            'time': '%s.%03d' % (time.strftime('%Y-%m-%dT%H:%M:%S',
+                                 time.localtime(record.created)),
+                                 record.msecs),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'line': record.lineno,
+            'pid': record.process,
+            'message': record.getMessage(),
+            }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if getattr(record, 'trace', None):
+            entry['trace'] = record.trace
+        return json.dumps(entry)
+
+
+class QueueHandler(logging.Handler):
+
+    """hand the records over to a writer thread which passes them to
+    target"""
+
+    QUEUE_SIZE = 10000
+
+    def __init__(self, target, trace=None):
+        """trace is a callable returning the trace to record with the
+        messages, it is called by the thread logging them"""
+
+        logging.Handler.__init__(self)
+        self.target = target
+        self.trace = trace
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.dropped = 0
+        self.start_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    @property
+    def stream(self):
+        """stream of the target, to be kept open by the daemon"""
+
+        return self.target.stream
+
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+
+            # after a fork the queue and the thread of the parent are of
+            # no use
+
+            self.queue = Queue.Queue(self.QUEUE_SIZE)
+            self.thread = threading.Thread(target=self.write,
+                    name='log writer')
+            self.thread.daemon = True
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def prepare(self, record):
+        """make the record independent of the caller: format the
+        message and the exception now, as the arguments could change
+        before the record is written"""
+
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if self.trace:
+            record.trace = self.trace()
+        return record
+
+    def emit(self, record):
+        try:
+            if self.pid != os.getpid():
+                self.start()
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def write(self):
+        queue = self.queue
+        while True:
+            record = queue.get()
+            try:
+                if record is None:
+                    return
+                if self.dropped:
+                    (dropped, self.dropped) = (self.dropped, 0)
+                    self.target.handle(logging.makeLogRecord({
+                        'name': 'imgstorage.logqueue',
+                        'levelno': logging.WARNING,
+                        'levelname': 'WARNING',
+                        'msg': 'Log queue full, %s records dropped'
+                            % dropped,
+                        }))
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+            finally:
+                queue.task_done()
+
+    def flush(self):
+        """wait until the records already logged are written"""
+
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class RateLimitFilter(logging.Filter):
+
+    """
+    Let at most burst records of a level below level through per period
+    seconds from the same line of code. The first record let through
+    after a period with suppressed records tells how many were, its
+    message is rewritten: add the filter to the loggers which need it
+    rather than to a handler shared with imgstorage.trace.
+    """
+
+    def __init__(
+        self,
+        burst=10,
+        period=60,
+        level=logging.WARNING,
+        ):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.period = period
+        self.level = level
+        self.lock = threading.Lock()
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno >= self.level:
+            return True
+
+        key = (record.pathname, record.lineno)
+        with self.lock:
+
+            # [start of the period, records let through, suppressed]
+
+            window = self.windows.get(key)
+            if window is None or record.created - window[0] \
+                >= self.period:
+                suppressed = (window[2] if window else 0)
+                self.windows[key] = [record.created, 1, 0]
+                if suppressed:
+                    record.msg = '%s (%s similar messages suppressed)' \
+                        % (record.getMessage(), suppressed)
+                    record.args = None
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def parse_levels(spec):
+    """parse "LEVEL logger=LEVEL ..." (or comma separated), a level
+    without a logger name is the default level. Returns the default
+    level and a dictionary logger -> level"""
+
+    default = None
+    levels = {}
+    for item in (spec or '').replace(',', ' ').split():
+        (name, sep, level) = item.rpartition('=')
+        value = logging.getLevelName(level.upper())
+        if not isinstance(value, int):
+            raise ValueError('Unknown log level %s' % level)
+        if name:
+            levels[name] = value
+        else:
+            default = value
+    return (default, levels)
+
+
+def set_levels(spec, loggers, default=logging.DEBUG):
+    """set the level of loggers, and of the loggers named in spec"""
+
+    (spec_default, levels) = parse_levels(spec)
+    for name in loggers:
+        logging.getLogger(name).setLevel(spec_default or default)
+    for (name, level) in levels.items():
+        logging.getLogger(name).setLevel(level)
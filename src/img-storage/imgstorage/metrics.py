@@ -0,0 +1,398 @@
+#!/opt/rocks/bin/python
+# @Copyright@
+#
+#                               Rocks(r)
+#                        www.rocksclusters.org
+#                        version 5.6 (Emerald Boa)
+#                        version 6.1 (Emerald Boa)
+#
+# Copyright (c) 2000 - 2013 The Regents of the University of California.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement:
+#
+#       "This product includes software developed by the Rocks(r)
+#       Cluster Group at the San Diego Supercomputer Center at the
+#       University of California, San Diego and its contributors."
+#
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of
+# the associated name, interested parties should contact Technology
+# Transfer & Intellectual Property Services, University of California,
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910,
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# @Copyright@
+#
+"""
+Metrics of the img-storage daemons in the Prometheus text format.
+
+The metrics live in REGISTRY and are updated in place by the code they
+measure. Every daemon serves them on http://127.0.0.1:<port>/metrics
+from its IOLoop (see serve), the port is the img_metrics_port attribute
+of the node. Gauges can be given a function, evaluated when the metrics
+are scraped, for the values which are cheaper to read than to track,
+like the length of the queues in the database.
+"""
+
+import bisect
+import logging
+import os
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a tgtadm call to a full image upload
+
+TIME_BUCKETS = (
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    5,
+    10,
+    30,
+    60,
+    300,
+    1800,
+    3600,
+    4 * 3600,
+    )
+
+# bytes, from a small incremental snapshot to a full image
+
+SIZE_BUCKETS = tuple(1024 ** 2 * 4 ** i for i in range(11))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\'
+                             , '\\\\').replace('"', '\\"').replace('\n',
+                             '\\n')) for (name, value) in zip(names,
+                             values))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+
+    TYPE = 'untyped'
+
+    def __init__(
+        self,
+        name,
+        help,
+        labels=(),
+        ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self):
+        """list of (name, label names, label values, value)"""
+
+        with self.lock:
+            return [(self.name, self.labels, key, value) for (key,
+                    value) in sorted(self.values.items())]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s'
+                  % (self.name, self.TYPE)]
+        for (name, names, values, value) in self.samples():
+            lines.append('%s%s %s' % (name, format_labels(names,
+                         values), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    TYPE = 'gauge'
+
+    def __init__(
+        self,
+        name,
+        help,
+        labels=(),
+        function=None,
+        ):
+        Metric.__init__(self, name, help, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if not self.function:
+            return Metric.samples(self)
+
+        # the function returns the value, or a dictionary label values
+        # tuple -> value for a gauge with labels
+
+        value = self.function()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [(self.name, self.labels, key, value[key]) for key in
+                sorted(value)]
+
+
+class Histogram(Metric):
+
+    TYPE = 'histogram'
+
+    def __init__(
+        self,
+        name,
+        help,
+        labels=(),
+        buckets=TIME_BUCKETS,
+        ):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0]
+            entry = self.values[key]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        names = self.labels + ('le', )
+        with self.lock:
+            for (key, (counts, total, count)) in \
+                sorted(self.values.items()):
+                cumulative = 0
+                for (bound, bucket_count) in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((self.name + '_bucket', names, key
+                                   + (format_value(bound), ),
+                                   cumulative))
+                samples.append((self.name + '_bucket', names, key
+                               + ('+Inf', ), count))
+                samples.append((self.name + '_sum', self.labels, key,
+                               total))
+                samples.append((self.name + '_count', self.labels, key,
+                               count))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        """add metric, or return the metric already registered with the
+        same name"""
+
+        with self.lock:
+            for existing in self.metrics:
+                if existing.name == metric.name:
+                    return existing
+            self.metrics.append(metric)
+            return metric
+
+    def counter(
+        self,
+        name,
+        help,
+        labels=(),
+        ):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(
+        self,
+        name,
+        help,
+        labels=(),
+        function=None,
+        ):
+        gauge = self.register(Gauge(name, help, labels))
+        if function:
+            gauge.function = function
+        return gauge
+
+    def histogram(
+        self,
+        name,
+        help,
+        labels=(),
+        buckets=TIME_BUCKETS,
+        ):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logging.getLogger('imgstorage.metrics').exception('Unable to collect %s'
+                         % metric.name)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter('imgstorage_requests_total',
+                            'Messages handled, per action',
+                            ['action', 'status'])
+REQUEST_SECONDS = REGISTRY.histogram('imgstorage_request_seconds',
+        'Time to handle a message, per action', ['action'])
+COMMAND_SECONDS = REGISTRY.histogram('imgstorage_command_seconds',
+        'Run time of the external commands, per command', ['command'])
+COMMAND_FAILURES = REGISTRY.counter('imgstorage_command_failures_total'
+                                    , 'External commands which failed'
+                                    , ['command'])
+ZVOL_LOCKS = REGISTRY.counter('imgstorage_zvol_lock_attempts_total',
+                              'Attempts to lock a zvol in zvol_calls, by result (acquired or busy)'
+                              , ['result'])
+SYNC_BYTES = REGISTRY.histogram('imgstorage_sync_bytes',
+                                'Bytes transferred per sync, by direction'
+                                , ['direction'], SIZE_BUCKETS)
+SYNC_SECONDS = REGISTRY.histogram('imgstorage_sync_seconds',
+                                  'Duration of the syncs, by direction'
+                                  , ['direction'])
+MERGE_SECONDS = REGISTRY.histogram('imgstorage_merge_seconds',
+                                   'Duration of the snapshot merges on the vm container'
+                                   )
+
+
+def command_name(params):
+    """name of the program run by a runCommand argument list, the one
+    run over ssh for the commands run as another user"""
+
+    if isinstance(params, basestring):
+        params = params.split()
+    if not params:
+        return ''
+    if len(params) > 3 and params[0] == 'su' and params[2] == '-c':
+        return command_name(params[3])
+
+    # ssh <host> "<command>"
+
+    name = os.path.basename(params[0])
+    if name == 'ssh' and len(params) > 2:
+        return os.path.basename(params[2].strip('"\''))
+    return name
+
+
+def track_command(params, start, failed=False):
+    name = command_name(params)
+    COMMAND_SECONDS.observe(time.time() - start, command=name)
+    if failed:
+        COMMAND_FAILURES.inc(command=name)
+
+
+def track_request(
+    action,
+    start,
+    result=None,
+    failed=False,
+    ):
+    """record a message handled by the daemon, result is the value
+    returned by the handler: when it is a future the request is over
+    when the future is done"""
+
+    def done(future=None):
+        status = 'ok'
+        if failed or future is not None and future.exception() \
+            is not None:
+            status = 'exception'
+        REQUESTS.inc(action=action, status=status)
+        REQUEST_SECONDS.observe(time.time() - start, action=action)
+
+    if hasattr(result, 'add_done_callback'):
+        result.add_done_callback(done)
+    else:
+        done()
+
+
+def serve(port, logger=None, address='127.0.0.1', registry=REGISTRY):
+    """serve the metrics over http from the IOLoop, must be called
+    before the IOLoop starts. A port of 0 disables the endpoint"""
+
+    if not port:
+        return None
+
+    import tornado.web
+
+    class MetricsHandler(tornado.web.RequestHandler):
+
+        def get(self):
+            self.set_header('Content-Type', CONTENT_TYPE)
+            self.write(registry.render())
+
+    try:
+        application = tornado.web.Application([(r'/metrics',
+                MetricsHandler)])
+        return application.listen(port, address)
+    except Exception, e:
+
+        # the daemon is more important than its metrics
+
+        (logger or logging.getLogger('imgstorage.metrics')).error('Unable to serve the metrics on port %s: %s'
+                 % (port, str(e)))
+        return None
@@ -0,0 +1,313 @@
+#!/opt/rocks/bin/python
+# @Copyright@
+#
+#                               Rocks(r)
+#                        www.rocksclusters.org
+#                        version 5.6 (Emerald Boa)
+#                        version 6.1 (Emerald Boa)
+#
+# Copyright (c) 2000 - 2013 The Regents of the University of California.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement:
+#
+#       "This product includes software developed by the Rocks(r)
+#       Cluster Group at the San Diego Supercomputer Center at the
+#       University of California, San Diego and its contributors."
+#
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of
+# the associated name, interested parties should contact Technology
+# Transfer & Intellectual Property Services, University of California,
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910,
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# @Copyright@
+#
+"""
+Opt-in profiler of the external commands run by the daemons.
+
+Nearly all the time of a request is spent in zfs, tgtadm, iscsiadm,
+dmsetup or ssh. When the img_profile attribute of the node is set to a
+file name, every command run by runCommand, runCommandBackground or a
+ZfsTransfer is appended to that file as a JSON line with its program,
+wall time, exit code and output size, tagged with the request it was
+run for. The request itself is written when it is over, with its total
+time. The commands are attributed to the message being processed: the
+request context is carried by a tornado StackContext, so it follows the
+callbacks and coroutines started by the handler, and the sync jobs of
+the worker pool open their own request.
+
+To see where the time went:
+
+    python -m imgstorage.profiler /var/log/rocks/img-storage-profile.log
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+from tornado.stack_context import StackContext
+
+from imgstorage.metrics import command_name
+
+_local = threading.local()
+
+
+def current_request():
+    return getattr(_local, 'request', None)
+
+
+class RequestContext:
+
+    """make request the current request of the thread"""
+
+    def __init__(self, request):
+        self.request = request
+
+    def __enter__(self):
+        self.previous = current_request()
+        _local.request = self.request
+
+    def __exit__(
+        self,
+        type,
+        value,
+        traceback,
+        ):
+        _local.request = self.previous
+
+
+class NullContext:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(
+        self,
+        type,
+        value,
+        traceback,
+        ):
+        pass
+
+
+class Request:
+
+    def __init__(
+        self,
+        profiler,
+        action,
+        request_id=None,
+        ):
+        self.profiler = profiler
+        self.action = action
+        self.id = request_id
+        self.start = time.time()
+
+    def context(self):
+        """context manager running the enclosed code, and everything it
+        schedules on the IOLoop, as part of this request"""
+
+        if not self.profiler.enabled:
+            return NullContext()
+        return StackContext(lambda : RequestContext(self))
+
+    def finish(self, result=None):
+        """record the request, once the result is done if it is a
+        future"""
+
+        if not self.profiler.enabled:
+            return
+        if hasattr(result, 'add_done_callback'):
+            result.add_done_callback(lambda future: self.finish())
+            return
+        self.profiler.write({
+            'type': 'request',
+            'action': self.action,
+            'request': self.id,
+            'start': self.start,
+            'seconds': time.time() - self.start,
+            })
+
+
+class Profiler:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trace = None
+
+    @property
+    def enabled(self):
+        return self.trace is not None
+
+    def enable(self, path):
+        with self.lock:
+            if self.trace:
+                self.trace.close()
+            self.trace = open(path, 'a')
+
+    def disable(self):
+        with self.lock:
+            if self.trace:
+                self.trace.close()
+            self.trace = None
+
+    def request(self, action, request_id=None):
+        return Request(self, action, request_id)
+
+    def write(self, entry):
+        entry['pid'] = os.getpid()
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            if self.trace:
+                self.trace.write(line)
+                self.trace.flush()
+
+    def command(
+        self,
+        params,
+        start,
+        returncode=None,
+        output=0,
+        ):
+        """record a command which ran from start to now, a returncode of
+        None means it could not be started"""
+
+        if not self.enabled:
+            return
+        request = current_request()
+        self.write({
+            'type': 'command',
+            'action': (request.action if request else None),
+            'request': (request.id if request else None),
+            'command': command_name(params),
+            'argv': (params if isinstance(params, list) else [params]),
+            'start': start,
+            'seconds': time.time() - start,
+            'returncode': returncode,
+            'output': output,
+            })
+
+
+PROFILER = Profiler()
+
+
+def read_trace(lines):
+    """group the entries of a trace by request, returns the list of
+    requests with their commands"""
+
+    requests = {}
+    order = []
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        key = (entry.get('pid'), entry.get('action'), entry.get('request'
+               ))
+        if key not in requests:
+            requests[key] = {
+                'action': entry.get('action'),
+                'request': entry.get('request'),
+                'start': None,
+                'seconds': None,
+                'commands': [],
+                }
+            order.append(key)
+        if entry.get('type') == 'request':
+            requests[key]['start'] = entry['start']
+            requests[key]['seconds'] = entry['seconds']
+        else:
+            requests[key]['commands'].append(entry)
+    return [requests[key] for key in order]
+
+
+def report(lines, out=sys.stdout, slowest=5):
+    """print the time spent per action and per command, and the
+    commands of the slowest requests of every action"""
+
+    actions = {}
+    for request in read_trace(lines):
+        actions.setdefault(request['action'] or '-', []).append(request)
+
+    out.write('%-20s %6s %10s %10s %10s\n' % ('action', 'count',
+              'mean s', 'max s', 'commands s'))
+    for (action, requests) in sorted(actions.items()):
+        times = [r['seconds'] for r in requests if r['seconds']
+                 is not None]
+        commands = sum(c['seconds'] for r in requests for c in
+                       r['commands'])
+        out.write('%-20s %6d %10.3f %10.3f %10.3f\n' % (action,
+                  len(requests), (sum(times) / len(times) if times else
+                  0), max(times or [0]), commands / len(requests)))
+
+    for (action, requests) in sorted(actions.items()):
+        per_command = {}
+        for request in requests:
+            for command in request['commands']:
+                stats = per_command.setdefault(command['command'], [0,
+                        0, 0])
+                stats[0] += 1
+                stats[1] += command['seconds']
+                if command['returncode'] != 0:
+                    stats[2] += 1
+        out.write('\n%s\n' % action)
+        for (name, (count, total, failed)) in sorted(per_command.items(),
+                key=lambda item: -item[1][1]):
+            out.write('    %-16s %6d calls %10.3f s %4d failed\n'
+                      % (name, count, total, failed))
+
+        requests = sorted(requests, key=lambda r: -(r['seconds']
+                          or 0))[:slowest]
+        for request in requests:
+            out.write('    request %s: %.3f s\n' % (request['request'],
+                      request['seconds'] or 0))
+            start = request['start']
+            for command in request['commands']:
+                if start is None:
+                    start = command['start']
+                out.write('        +%7.3f %8.3f s  %s\n'
+                          % (command['start'] - start,
+                          command['seconds'], ' '.join(command['argv'
+                          ])[:100]))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.stderr.write('usage: python -m imgstorage.profiler <trace file>\n'
+                         )
+        sys.exit(1)
+    with open(sys.argv[1]) as trace:
+        report(trace)
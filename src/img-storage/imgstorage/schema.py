@@ -0,0 +1,186 @@
+#!/opt/rocks/bin/python
+# @Copyright@
+#
+#                               Rocks(r)
+#                        www.rocksclusters.org
+#                        version 5.6 (Emerald Boa)
+#                        version 6.1 (Emerald Boa)
+#
+# Copyright (c) 2000 - 2013 The Regents of the University of California.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement:
+#
+#       "This product includes software developed by the Rocks(r)
+#       Cluster Group at the San Diego Supercomputer Center at the
+#       University of California, San Diego and its contributors."
+#
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of
+# the associated name, interested parties should contact Technology
+# Transfer & Intellectual Property Services, University of California,
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910,
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# @Copyright@
+#
+"""
+Schema of /opt/rocks/var/img_storage.db, shared by the NAS and the VM
+daemons.
+
+The version of the schema is kept in PRAGMA user_version and every entry
+of MIGRATIONS brings the database one version forward, so a daemon
+starting on an up to date database only reads the version. pysqlite
+commits before DDL statements, so a migration is not atomic: it has to
+leave the database usable if it is interrupted, and to succeed if it is
+run again.
+
+Databases older than the versioning are version 0, they can be in any
+of the layouts created by the older daemons.
+"""
+
+import logging
+
+logger = logging.getLogger('imgstorage.schema')
+
+
+def columns(cur, table):
+    cur.execute('PRAGMA table_info(%s)' % table)
+    return [row[1] for row in cur.fetchall()]
+
+
+def add_column(cur, table, column, definition):
+    if column not in columns(cur, table):
+        cur.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column,
+                    definition))
+
+
+def create_tables(cur):
+    """tables of the unversioned daemons, the VM daemon kept its merge
+    queue in a sync_queue table of its own layout, now merge_queue"""
+
+    if 'iscsi_target' in columns(cur, 'sync_queue'):
+        cur.execute('ALTER TABLE sync_queue RENAME TO merge_queue')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS zvol_calls(
+                  zvol TEXT PRIMARY KEY NOT NULL,
+                  reply_to TEXT NOT NULL,
+                  time INT NOT NULL)''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS zvols(
+                  zvol TEXT PRIMARY KEY NOT NULL,
+                  zpool TEXT,
+                  iscsi_target TEXT UNIQUE,
+                  remotehost TEXT)''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS sync_queue(
+                  zvol TEXT PRIMARY KEY NOT NULL,
+                  zpool TEXT NOT NULL,
+                  remotehost TEXT,
+                  is_sending BOOLEAN,
+                  is_delete_remote BOOLEAN,
+                  time INT)''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS merge_queue(
+                  zvol TEXT PRIMARY KEY NOT NULL,
+                  iscsi_target TEXT UNIQUE,
+                  devsize INT,
+                  reply_to TEXT,
+                  correlation_id TEXT,
+                  started BOOLEAN default 0,
+                  time INT)''')
+
+
+def add_reply_correlation(cur):
+    add_column(cur, 'zvol_calls', 'correlation_id', 'TEXT')
+
+
+def add_transfer_progress(cur):
+    for column in ('transferred', 'size', 'speed'):
+        add_column(cur, 'sync_queue', column, 'INT')
+
+
+def add_indexes(cur):
+
+    # zvols.iscsi_target is UNIQUE and so already indexed
+
+    cur.execute('CREATE INDEX IF NOT EXISTS zvols_remotehost ON zvols(remotehost)'
+                )
+
+    # the VM daemon created sync_queue_time on what is now merge_queue
+
+    cur.execute('DROP INDEX IF EXISTS sync_queue_time')
+    cur.execute('CREATE INDEX IF NOT EXISTS sync_queue_time ON sync_queue(time)'
+                )
+    cur.execute('CREATE INDEX IF NOT EXISTS merge_queue_time ON merge_queue(time)'
+                )
+
+
+def add_sync_priority(cur):
+    """priority class of the sync jobs and the estimated size used to
+    order them, the classes of the queued jobs are derived from their
+    direction: 0 upload, 1 unmap, 2 periodic pull"""
+
+    add_column(cur, 'sync_queue', 'priority', 'INT')
+    add_column(cur, 'sync_queue', 'estimate', 'INT')
+    cur.execute('''UPDATE sync_queue SET priority = CASE
+                  WHEN is_sending THEN 0
+                  WHEN is_delete_remote THEN 1
+                  ELSE 2 END
+                  WHERE priority IS NULL''')
+
+
+def add_sync_trace(cur):
+    """trace of the request which queued the sync job"""
+
+    add_column(cur, 'sync_queue', 'trace', 'TEXT')
+
+
+MIGRATIONS = [create_tables, add_reply_correlation,
+              add_transfer_progress, add_indexes, add_sync_priority,
+              add_sync_trace]
+
+VERSION = len(MIGRATIONS)
+
+
+def upgrade(con):
+    """bring the database to VERSION, return the version found"""
+
+    version = con.execute('PRAGMA user_version').fetchone()[0]
+    if version > VERSION:
+        raise Exception('Database schema version %s is newer than %s'
+                        % (version, VERSION))
+    for (number, migration) in enumerate(MIGRATIONS[version:], version
+            + 1):
+        logger.info('Upgrading the database schema to version %s: %s'
+                    % (number, migration.__name__))
+        with con:
+            migration(con.cursor())
+            con.execute('PRAGMA user_version = %d' % number)
+    return version
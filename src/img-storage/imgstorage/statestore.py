@@ -1,5 +1,4 @@
-#!/bin/bash
-#
+#!/opt/rocks/bin/python
 # @Copyright@
 #
 #                               Rocks(r)
@@ -54,23 +53,59 @@
 #
 # @Copyright@
 #
-# we need this non-sense because tgt-setup-lun can not be run concurrently
-# so need this crap to make sure only one tgt-setup-lun will run concurrently
-#
-# http://www.spinics.net/lists/linux-stgt/msg03353.html
+import logging
+import threading
+
+from pysqlite2 import dbapi2 as sqlite3
+
+
+class StateStore:
+
+    """
+    Access to the sqlite database holding the daemon state.
+
+    Every thread keeps its own connection open for the life of the
+    daemon, instead of connecting for each query, so the statement cache
+    of the connection is reused across messages. The database runs in
+    WAL mode with synchronous=NORMAL: readers do not block the writer
+    and a commit does not wait for a full fsync, while a crash can only
+    lose the last transactions, never corrupt the database.
+
+        with self.state.connect() as con:
+            con.execute(...)
+
+    commits on success and rolls back on error, like a new connection
+    used to, but the connection stays open.
+    """
 
+    TIMEOUT = 30
+    CACHED_STATEMENTS = 200
 
-(
-  # Wait for lock on /var/lock/.tgt-setup-lun-lock.exclusivelock
-  flock 200 || exit 1
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.logger = \
+            logging.getLogger('imgstorage.statestore.StateStore')
 
-  # lock acquired
-  echo "lock acquired" >> /tmp/locklog
-  echo "running: ${@}" >> /tmp/locklog
-  tgt-setup-lun "${@}"
-  
+    def connect(self):
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=self.TIMEOUT,
+                                  cached_statements=self.CACHED_STATEMENTS)
 
-) 200>/var/lock/.tgt-setup-lun-lock.exclusivelock
+            # sqlite before 3.7 does not know WAL and keeps the old mode
 
+            mode = con.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            con.execute('PRAGMA synchronous=NORMAL')
+            self.logger.debug('Opened %s, journal mode %s' % (self.path,
+                              mode))
+            self.local.con = con
+        return con
 
+    def close(self):
+        """close the connection of the calling thread"""
 
+        con = getattr(self.local, 'con', None)
+        if con is not None:
+            con.close()
+            self.local.con = None
@@ -0,0 +1,236 @@
+#!/opt/rocks/bin/python
+# @Copyright@
+#
+#                               Rocks(r)
+#                        www.rocksclusters.org
+#                        version 5.6 (Emerald Boa)
+#                        version 6.1 (Emerald Boa)
+#
+# Copyright (c) 2000 - 2013 The Regents of the University of California.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement:
+#
+#       "This product includes software developed by the Rocks(r)
+#       Cluster Group at the San Diego Supercomputer Center at the
+#       University of California, San Diego and its contributors."
+#
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of
+# the associated name, interested parties should contact Technology
+# Transfer & Intellectual Property Services, University of California,
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910,
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# @Copyright@
+#
+"""
+Tracing of the requests across the frontend, the NAS and the vm
+containers.
+
+CommandLauncher.callCommand starts a trace: a random id sent in the
+'trace' field of the message. The daemons keep the trace current while
+they handle a message, copy it in the messages they send for the same
+request (map_zvol, unmap_zvol and sync_zvol to the vm container,
+zvol_mapped, zvol_unmapped and zvol_synced back to the NAS) and store it
+with the queued sync jobs and merges. The trace field is in the message
+body because the daemons publish through RabbitMQCommonClient, which has
+no way to set the message headers.
+
+Every step logs a span, the time one host spent on one action, to the
+imgstorage.trace logger; the daemons write it to their log and the rocks
+commands to /var/log/rocks/img-storage-frontend.log. The timeline of a
+request is assembled from the logs of all the hosts it went through:
+
+    python -m imgstorage.tracing [-t trace] <log file> ...
+
+The clocks of the hosts are assumed in sync.
+"""
+
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger('imgstorage.trace')
+
+# spans are logged as MARKER followed by the span in JSON
+
+MARKER = 'span '
+
+_local = threading.local()
+
+
+def new_trace():
+    return uuid.uuid4().hex
+
+
+def current_trace():
+    """trace of the request being handled, None outside of a request"""
+
+    return getattr(_local, 'trace', None)
+
+
+class TraceContext:
+
+    """make trace the current trace of the thread"""
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = current_trace()
+        _local.trace = self.trace
+
+    def __exit__(
+        self,
+        type,
+        value,
+        traceback,
+        ):
+        _local.trace = self.previous
+
+
+class Span:
+
+    """
+    One step of a request on this host. The trace is the one of the
+    message being handled, when there is none (a periodic job, a message
+    from an older frontend) a new trace is started.
+    """
+
+    host = socket.gethostname().split('.')[0]
+
+    def __init__(
+        self,
+        name,
+        trace=None,
+        **fields
+        ):
+        self.name = name
+        self.trace = trace or current_trace() or new_trace()
+        self.fields = fields
+        self.start = time.time()
+
+    def context(self):
+        """context manager running the enclosed code, and everything it
+        schedules on the IOLoop, within the trace"""
+
+        # only the daemons run on an IOLoop, the rocks commands which
+        # import this module do not load tornado
+
+        from tornado.stack_context import StackContext
+        return StackContext(lambda : TraceContext(self.trace))
+
+    def finish(self, result=None, error=None):
+        """log the span, once the result is done if it is a future"""
+
+        if hasattr(result, 'add_done_callback'):
+            result.add_done_callback(lambda future: \
+                    self.finish(error=future.exception()))
+            return
+        span = {
+            'trace': self.trace,
+            'name': self.name,
+            'host': self.host,
+            'start': self.start,
+            'seconds': time.time() - self.start,
+            }
+        span.update((key, value) for (key, value) in
+                    self.fields.items() if value is not None)
+        if error is not None:
+            span['error'] = str(error)
+        LOGGER.info(MARKER + json.dumps(span))
+
+
+def read_spans(lines):
+    """the spans logged in lines, grouped by trace"""
+
+    traces = {}
+    for line in lines:
+
+        # the daemons log JSON records, older logs are text lines
+
+        if line.startswith('{'):
+            try:
+                line = json.loads(line).get('message', '')
+            except ValueError:
+                continue
+        position = line.find(MARKER + '{')
+        if position < 0:
+            continue
+        try:
+            span = json.loads(line[position + len(MARKER):].strip().rstrip("'"
+                              ))
+        except ValueError:
+            continue
+        traces.setdefault(span['trace'], []).append(span)
+    for spans in traces.values():
+        spans.sort(key=lambda span: span['start'])
+    return traces
+
+
+def timeline(spans, out=sys.stdout):
+    """print the spans of one trace relative to its first span"""
+
+    start = spans[0]['start']
+    end = max(span['start'] + span['seconds'] for span in spans)
+    out.write('trace %s: %.3f s\n' % (spans[0]['trace'], end - start))
+    for span in spans:
+        out.write('    +%8.3f %8.3f s  %-14s %-16s %s%s\n' % (span['start'
+                  ] - start, span['seconds'], span['host'], span['name'
+                  ], span.get('zvol', ''), (' error: %s' % span['error'
+                  ] if 'error' in span else '')))
+
+
+if __name__ == '__main__':
+    import getopt
+
+    (opts, args) = getopt.getopt(sys.argv[1:], 't:')
+    if not args:
+        sys.stderr.write('usage: python -m imgstorage.tracing [-t trace] <log file> ...\n'
+                         )
+        sys.exit(1)
+
+    lines = []
+    for name in args:
+        with open(name) as log:
+            lines.extend(log)
+    traces = read_spans(lines)
+    wanted = [value for (opt, value) in opts if opt == '-t']
+    for (trace, spans) in sorted(traces.items(), key=lambda item: \
+                                 item[1][0]['start']):
+        if not wanted or trace in wanted:
+            timeline(spans)
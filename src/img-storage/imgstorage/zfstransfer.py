@@ -0,0 +1,265 @@
+#!/opt/rocks/bin/python
+# @Copyright@
+#
+#                               Rocks(r)
+#                        www.rocksclusters.org
+#                        version 5.6 (Emerald Boa)
+#                        version 6.1 (Emerald Boa)
+#
+# Copyright (c) 2000 - 2013 The Regents of the University of California.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice unmodified and in its entirety, this list of conditions and the
+# following disclaimer in the documentation and/or other materials provided
+# with the distribution.
+#
+# 3. All advertising and press materials, printed or electronic, mentioning
+# features or use of this software must display the following acknowledgement:
+#
+#       "This product includes software developed by the Rocks(r)
+#       Cluster Group at the San Diego Supercomputer Center at the
+#       University of California, San Diego and its contributors."
+#
+# 4. Except as permitted for the purposes of acknowledgment in paragraph 3,
+# neither the name or logo of this software nor the names of its
+# authors may be used to endorse or promote products derived from this
+# software without specific prior written permission.  The name of the
+# software includes the following terms, and any derivatives thereof:
+# "Rocks", "Rocks Clusters", and "Avalanche Installer".  For licensing of
+# the associated name, interested parties should contact Technology
+# Transfer & Intellectual Property Services, University of California,
+# San Diego, 9500 Gilman Drive, Mail Code 0910, La Jolla, CA 92093-0910,
+# Ph: (858) 534-5815, FAX: (858) 534-7345, E-MAIL:invent@ucsd.edu
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS''
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# @Copyright@
+#
+from imgstorage import runCommand, ActionError
+from imgstorage.imgstoragedaemon import trackCommand
+
+import logging
+import re
+import subprocess
+import tempfile
+import time
+
+
+def parse_rate(rate):
+    """bytes per second from a pv style rate limit like 500k or 10M"""
+
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$', str(rate),
+                     re.I)
+    if not match:
+        raise ValueError('Invalid transfer rate %s' % rate)
+    return int(float(match.group(1)) * 1024 ** ' kmgt'.index(
+               match.group(2).lower() or ' '))
+
+
+class ZfsTransfer:
+
+    """
+    Stream a zfs send into a zfs receive, either side possibly running on
+    a remote host over ssh, with the data pumped through this process.
+
+    Counting the bytes on the way gives the progress and the speed of the
+    transfer, which are passed to the progress callback. The receiving
+    side keeps the state of a partial stream (zfs receive -s), so a
+    transfer interrupted by a dropped connection continues from its
+    resume token instead of starting over. The pump is paced by the
+    bandwidth scheduler flow given to the transfer, if any.
+    """
+
+    BLOCK_SIZE = 128 * 1024
+    PROGRESS_INTERVAL = 5
+    RETRIES = 3
+
+    def __init__(
+        self,
+        dataset,
+        sender=None,
+        receiver=None,
+        user=None,
+        flow=None,
+        progress=None,
+        ):
+        """dataset is the receiving dataset, sender and receiver the hosts
+        running zfs send and zfs receive (None is this host), flow a
+        bandwidth.Flow, progress a callable(transferred bytes, total
+        bytes, bytes/sec)"""
+
+        self.dataset = dataset
+        self.sender = sender
+        self.receiver = receiver
+        self.user = user
+        self.flow = flow
+        self.progress = progress
+        self.logger = \
+            logging.getLogger('imgstorage.zfstransfer.ZfsTransfer')
+
+    def zfs(self, host, args):
+        if not host:
+            return ['zfs'] + args
+        return ['su', self.user, '-c', '/usr/bin/ssh %s "/sbin/zfs %s"'
+                % (host, ' '.join(args))]
+
+    def resume_token(self):
+        """token of the partially received stream, None if there is none"""
+
+        try:
+            out = runCommand(self.zfs(self.receiver, [
+                'get',
+                '-H',
+                '-o',
+                'value',
+                'receive_resume_token',
+                self.dataset,
+                ]))
+        except ActionError:
+
+            # the dataset does not exist yet
+
+            return None
+        if not out or out[0].strip() in ('', '-'):
+            return None
+        return out[0].strip()
+
+    def discard(self):
+        """drop the state of a partially received stream"""
+
+        if self.resume_token():
+            runCommand(self.zfs(self.receiver, ['receive', '-A',
+                       self.dataset]))
+
+    def resume(self):
+        """finish the stream interrupted in a previous run, if any"""
+
+        token = self.resume_token()
+        if not token:
+            return False
+        self.logger.info('Resuming interrupted transfer to %s'
+                         % self.dataset)
+        try:
+            self.stream(['-t', token])
+        except ActionError, err:
+            self.logger.error('Can not resume the transfer to %s, discarding it: %s'
+                               % (self.dataset, str(err)))
+            self.discard()
+        return True
+
+    def send(self, snapshot, base=None):
+        """send the snapshot, incremental from the base snapshot if given,
+        resuming the stream up to RETRIES times when it breaks. Returns
+        the bytes sent by the last, complete, stream"""
+
+        args = (['-i', base, snapshot] if base else [snapshot])
+        for attempt in range(self.RETRIES + 1):
+            try:
+                return self.stream(args)
+            except ActionError, err:
+                token = self.resume_token()
+                if not token or attempt == self.RETRIES:
+                    raise err
+                self.logger.warning('Transfer to %s interrupted, resuming: %s'
+                                     % (self.dataset, str(err)))
+                args = ['-t', token]
+
+    def estimate(self, args):
+        """size in bytes of the stream zfs send would produce"""
+
+        try:
+            out = runCommand(self.zfs(self.sender, ['send', '-nP']
+                             + args))
+        except ActionError:
+            return None
+        for line in out:
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == 'size':
+                return int(fields[1])
+        return None
+
+    def stream(self, args):
+        size = self.estimate(args)
+        errors = tempfile.TemporaryFile()
+        try:
+            sender = subprocess.Popen(self.zfs(self.sender, ['send']
+                    + args), stdout=subprocess.PIPE, stderr=errors,
+                    close_fds=True)
+        except OSError, e:
+            raise ActionError('Error running zfs send: %s' % str(e))
+        try:
+            receiver = subprocess.Popen(self.zfs(self.receiver,
+                    ['receive', '-s', '-F', self.dataset]),
+                    stdin=subprocess.PIPE, stderr=errors,
+                    close_fds=True)
+        except OSError, e:
+            sender.kill()
+            sender.wait()
+            raise ActionError('Error running zfs receive: %s' % str(e))
+
+        transferred = 0
+        start = last_report = time.time()
+        try:
+            while True:
+                data = sender.stdout.read(self.BLOCK_SIZE)
+                if not data:
+                    break
+                receiver.stdin.write(data)
+                transferred += len(data)
+
+                if self.flow:
+                    self.flow.throttle(len(data))
+                now = time.time()
+                if self.progress and now - last_report \
+                    >= self.PROGRESS_INTERVAL:
+                    self.progress(transferred, size, int(transferred
+                                  / (now - start)))
+                    last_report = now
+        except IOError:
+
+            # zfs receive went away, its exit code tells why
+
+            sender.kill()
+        finally:
+            sender.stdout.close()
+            try:
+                receiver.stdin.close()
+            except IOError:
+                pass
+
+        send_code = sender.wait()
+        receive_code = receiver.wait()
+        trackCommand(self.zfs(self.sender, ['send'] + args), start,
+                     send_code, transferred)
+        trackCommand(self.zfs(self.receiver, ['receive', '-s', '-F',
+                     self.dataset]), start, receive_code)
+        elapsed = max(time.time() - start, 0.001)
+        if self.progress:
+            self.progress(transferred, size, int(transferred / elapsed))
+
+        if send_code or receive_code:
+            errors.seek(0)
+            raise ActionError('Transfer to %s failed after %s bytes: %s'
+                              % (self.dataset, transferred,
+                              errors.read().strip()))
+        self.logger.debug('Transferred %s bytes to %s in %.1fs'
+                          % (transferred, self.dataset, elapsed))
+        return transferred
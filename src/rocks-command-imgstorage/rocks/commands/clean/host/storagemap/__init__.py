@@ -86,8 +86,8 @@ class Command(rocks.commands.HostArgumentProcessor, rocks.commands.Command):
 
 		else:
 			#no nodetype specified so we need to query the nas
-			list = CommandLauncher().callListHostStoragemap(nas)
-			entry = [ d for d in list if d['zvol'] == volume]
+			entry = list(CommandLauncher().callListHostStoragemap(nas,
+					zvol=volume))
 			if len(entry) == 0:
 				self.abort('Unable to find volume %s on nas %s'
 						% (volume, nas))
@@ -100,7 +100,7 @@ class Command(rocks.commands.HostArgumentProcessor, rocks.commands.Command):
 			if entry['remotehost'] == None:
 				self.abort('Volume %s is unmapped' % volume)
 
-			if entry['is_sending'] == 1 or (entry['is_sending'] == 0 and d['is_delete_remote'] != 0):
+			if entry['is_sending'] == 1 or (entry['is_sending'] == 0 and entry['is_delete_remote'] != 0):
 				self.abort('Volume %s is currently getting transfered, please wait' % volume)
 
 
@@ -108,8 +108,8 @@ class Command(rocks.commands.HostArgumentProcessor, rocks.commands.Command):
 			# all possible error situation have been cleared
 			# clear the remote host first
 			cmdline = 'rocks clean host storagemap %s %s nodetype=' % (nas, volume)
-			print "cleaning ", d['remotehost']
-			self.command('run.host', [str(d['remotehost']), cmdline + 'vmc'])
+			print "cleaning ", entry['remotehost']
+			self.command('run.host', [str(entry['remotehost']), cmdline + 'vmc'])
 
 			# then clean the nas
 			print "cleaning ", nas
@@ -5,6 +5,7 @@
 import sys
 import string
 import rocks.commands
+import rocks.util
 import pika
 
 import json
@@ -12,7 +13,7 @@ import uuid
 import logging
 logging.basicConfig()
 
-from imgstorage.commandlauncher import CommandLauncher
+from imgstorage.commandlauncher import CommandLauncher, BROADCAST_TIMEOUT
 import time
 import datetime
 
@@ -20,46 +21,93 @@ import datetime
 class Command(rocks.commands.HostArgumentProcessor, rocks.commands.list.command):
     """
     Lists the VM container node status
+    Without a compute name, or with several, all the VM containers (or
+    the given ones) are queried at once and their devices are merged in
+    one table. The nodes which do not answer in time are reported on
+    stderr.
     
-    <arg type='string' name='compute' optional='0'>
-    The COMPUTE name which we want to interrogate
+    <arg type='string' name='compute' optional='1' repeat='1'>
+    The COMPUTE name which we want to interrogate. If not given all
+    the hosts with the img_storage_vm attribute are interrogated
     </arg>
 
+    <param type='int' name='timeout'>
+    Seconds to wait for the nodes to answer when several are queried.
+    Default: 10
+    </param>
+
     <example cmd='list host storagemap compute-0-0'>
     It will display the list of mappings on compute-0-0
     </example>
+
+    <example cmd='list host storagedev'>
+    It will display the devices of all the VM containers
+    </example>
     """
 
+    def get_vm_hosts(self):
+        return [host for host in self.getHostnames() if
+            rocks.util.str2bool(self.db.getHostAttr(host, 'img_storage_vm'))]
+
+    def add_sync_devs(self, compute, map, with_target=False):
+        for d in map.keys():
+            row = [d,
+                    map[d].get('dev'),
+                    map[d].get('status'), 
+                    map[d].get('size')]
+            if with_target:
+                row.append(map[d].get('target'))
+            row.extend([map[d].get('bdev'),
+                    map[d].get('started'),
+                    map[d].get('synced'),
+                    '%s%%' % map[d]['progress'] if 'progress' in map[d] else None,
+                    str(datetime.timedelta(seconds=(int(time.time()-map[d].get('time'))))) if map[d].get('time') else None
+                ])
+            self.addOutput(compute, row)
+
     def run(self, params, args):
         (args, compute) = self.fillPositionalArgs(('compute'))
+        (timeout, ) = self.fillParams([('timeout', BROADCAST_TIMEOUT)])
+
+        if compute and not args:
+            response = CommandLauncher().callListHostStoragedev(compute)
+            if(response['node_type'] == 'iscsi'):
+                self.beginOutput()
+                for d in response['body']:
+                    self.addOutput(compute, d.values())
+                headers=['compute','target', 'device']
+                self.endOutput(headers)
+            elif(response['node_type'] == 'sync'):
+                self.beginOutput()
+                self.add_sync_devs(compute, response['body'])
+                headers=['compute','zvol','lvm','status','size (GB)','block dev','is started','synced','merged','time']
+                self.endOutput(headers)
+            return
 
-        if not compute:
-            self.abort("you must enter the compute name")
-
-        response = CommandLauncher().callListHostStoragedev(compute)
-        if(response['node_type'] == 'iscsi'):
-            self.beginOutput()
-            for d in response['body']:
-                self.addOutput(compute, d.values())
-            headers=['compute','target', 'device']
-            self.endOutput(headers)
-        elif(response['node_type'] == 'sync'):
-            self.beginOutput()
-            map = response['body']
-            for d in map.keys():
-                self.addOutput(compute, (d, 
-                        map[d].get('dev'),
-                        map[d].get('status'), 
-                        map[d].get('size'), 
-                        #map[d].get('target'),
-                        map[d].get('bdev'),
-                        map[d].get('started'),
-                        map[d].get('synced'),
-                        str(datetime.timedelta(seconds=(int(time.time()-map[d].get('time'))))) if map[d].get('time') else None
-                    )
-                )
-            headers=['compute','zvol','lvm','status','size (GB)','block dev','is started','synced','time']
-            self.endOutput(headers)
+        if compute:
+            computes = self.getHostnames([compute] + args)
+        else:
+            computes = self.get_vm_hosts()
+        if not computes:
+            self.abort("no VM container found")
+        (replies, failed) = CommandLauncher().callListAllStoragedevs(
+                computes, timeout=float(timeout))
+        self.beginOutput()
+        for compute in computes:
+            response = replies.get(compute)
+            if not response:
+                continue
+            if(response['node_type'] == 'iscsi'):
+                for d in response['body']:
+                    self.addOutput(compute, (None, None, None, None,
+                            d.get('target'), d.get('device'), None, None,
+                            None, None))
+            elif(response['node_type'] == 'sync'):
+                self.add_sync_devs(compute, response['body'], True)
+        for compute in sorted(failed):
+            sys.stderr.write('%s did not answer: %s\n' % (compute, failed[compute]))
+        headers=['compute','zvol','lvm','status','size (GB)','target','block dev','is started','synced','merged','time']
+        self.endOutput(headers)
 
 
 
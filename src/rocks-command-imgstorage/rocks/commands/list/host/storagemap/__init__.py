@@ -5,6 +5,7 @@
 import sys
 import string
 import rocks.commands
+import rocks.util
 import pika
 
 import json
@@ -12,7 +13,7 @@ import uuid
 import logging
 logging.basicConfig()
 
-from imgstorage.commandlauncher import CommandLauncher
+from imgstorage.commandlauncher import CommandLauncher, BROADCAST_TIMEOUT
 
 import time
 import datetime
@@ -20,14 +21,44 @@ import datetime
 class Command(rocks.commands.HostArgumentProcessor, rocks.commands.list.command):
     """
     List the status on a NAS (or virtual machine images repository).
+    Without a NAS name, or with several, all the NAS (or the given ones)
+    are queried at once and their volumes are merged in one table. The
+    NAS which do not answer in time are reported on stderr.
     
-    <arg type='string' name='nas' optional='0'>
-    The NAS name which we want to interrogate
+    <arg type='string' name='nas' optional='1' repeat='1'>
+    The NAS name which we want to interrogate. If not given all the
+    hosts with the img_storage_nas attribute are interrogated
     </arg>
 
+    <param type='string' name='zvol'>
+    Only list the given volume
+    </param>
+
+    <param type='string' name='host'>
+    Only list the volumes mapped to the given host
+    </param>
+
+    <param type='string' name='state'>
+    Only list the volumes in the given state: mapped, unmapped,
+    upload (NAS->VM) or download (NAS<-VM)
+    </param>
+
+    <param type='int' name='timeout'>
+    Seconds to wait for the NAS to answer when several are queried.
+    Default: 10
+    </param>
+
     <example cmd='list host storagemap nas-0-0'>
     It will display the list of mappings on nas-0-0
     </example>
+
+    <example cmd='list host storagemap nas-0-0 host=compute-0-0'>
+    It will display the volumes of nas-0-0 mapped to compute-0-0
+    </example>
+
+    <example cmd='list host storagemap host=compute-0-0'>
+    It will display the volumes of all the NAS mapped to compute-0-0
+    </example>
     """
 
     #def list(self, nas):
@@ -38,15 +69,11 @@ class Command(rocks.commands.HostArgumentProcessor, rocks.commands.list.command)
         #return [("zpool/vm-sdsc125-2","compute-0-0","/dev/sdc"), 
         #   ("zpool/vm-sdsc125-3","compute-0-1","/dev/sdc")]
 
+    def get_nas_hosts(self):
+        return [host for host in self.getHostnames() if
+            rocks.util.str2bool(self.db.getHostAttr(host, 'img_storage_nas'))]
 
-    def run(self, params, args):
-        (args, nas) = self.fillPositionalArgs(('nas'))
-
-        if not nas:
-            self.abort("you must enter the nas name")
-        # debugging output
-        list = CommandLauncher().callListHostStoragemap(nas)
-        self.beginOutput()
+    def add_zvols(self, nas, list):
         for d in list:
             state = 'mapped'
             if(d['remotehost'] == None):
@@ -58,15 +85,53 @@ class Command(rocks.commands.HostArgumentProcessor, rocks.commands.list.command)
                 if(d['is_delete_remote'] == 0):
                     state += ' sched'
 
+            transfer = None
+            if(d.get('transferred') is not None):
+                transfer = '%.1f MB/s' % (d['speed'] / 1024.0 ** 2)
+                if(d.get('size')):
+                    transfer = '%d%% %s' % (
+                        min(100 * d['transferred'] / d['size'], 100),
+                        transfer)
+
             self.addOutput(nas, (
                 d['zvol'],
                 d['remotehost'],
                 d['zpool'],
                 d['iscsi_target'],
                 state,
+                transfer,
                 str(datetime.timedelta(seconds=(int(time.time()-d.get('time'))))) if d.get('time') else None
                 ))
-        headers=['nas', 'zvol', 'host', 'zpool', 'target', 'state', 'time']
+
+    def run(self, params, args):
+        (args, nas) = self.fillPositionalArgs(('nas'))
+        (zvol, host, state, timeout) = self.fillParams([('zvol', None),
+                ('host', None), ('state', None),
+                ('timeout', BROADCAST_TIMEOUT)])
+
+        if nas and not args:
+            # debugging output
+            list = CommandLauncher().callListHostStoragemap(nas, zvol=zvol,
+                    remotehost=host, state=state)
+            self.beginOutput()
+            self.add_zvols(nas, list)
+        else:
+            if nas:
+                nases = self.getHostnames([nas] + args)
+            else:
+                nases = self.get_nas_hosts()
+            if not nases:
+                self.abort("no NAS found")
+            (replies, failed) = CommandLauncher().callListAllStoragemaps(
+                    nases, zvol=zvol, remotehost=host, state=state,
+                    timeout=float(timeout))
+            self.beginOutput()
+            for nas in nases:
+                if nas in replies:
+                    self.add_zvols(nas, replies[nas])
+            for nas in sorted(failed):
+                sys.stderr.write('%s did not answer: %s\n' % (nas, failed[nas]))
+        headers=['nas', 'zvol', 'host', 'zpool', 'target', 'state', 'transfer', 'time']
         self.endOutput(headers)
 
 
@@ -62,27 +62,124 @@ from imgstorage.commandlauncher import CommandLauncher
 
 
 class Plugin(rocks.commands.Plugin):
+	"""
+	Map the VM disk image on the physical host before the VM starts.
+
+	When the frontend attribute img_allocate_parallel is bigger than 1
+	the storage of all the hosts passed to "rocks start host vm" is
+	allocated concurrently the first time the plugin runs, at most
+	img_allocate_parallel hosts at a time, and each following call
+	only picks up its own device. When a host fails no VM is started:
+	the volumes of the batch are released and all the failures are
+	reported in a single error.
+	"""
 
 	def provides(self):
 		return 'plugin_allocate'
 
-	def run(self, node):
-		# here you can relocate your VM in rocks DB
-		# node is of type rocks.db.mappings.base.Node
+	def get_storage_request(self, node):
+		"""return the (nas, zpool, volume, physhost, size) tuple
+		needed to map the node disk or None if the node does not use
+		the img-storage system"""
 		if not node.vm_defs.physNode or len(node.vm_defs.disks) <= 0:
 			raise rocks.util.CommandError("Unable to allocate " + \
 				"storage for " + node.name)
 		disk = node.vm_defs.disks[0]
-		phys = node.vm_defs.physNode.name
-		size = str(disk.size)
-		volume = node.name + '-vol'
 		if not (disk.img_nas_server and disk.img_nas_server.server_name):
 			# the node does not use img-storage system
+			return None
+		return (disk.img_nas_server.server_name,
+			disk.img_nas_server.zpool_name, node.name + '-vol',
+			node.vm_defs.physNode.name, str(disk.size))
+
+	def get_parallel(self):
+		try:
+			parallel = self.owner.db.getHostAttr('localhost',
+				'img_allocate_parallel')
+			return int(parallel) if parallel else 1
+		except (ValueError, TypeError):
+			return 1
+
+	def get_batch_requests(self):
+		"""return a dictionary host -> storage request of the hosts
+		passed to the command which use the img-storage system"""
+		(args, names) = self.owner.fillPositionalArgs([])
+		nodes = self.owner.newdb.getNodesfromNames(
+			self.owner.getHostnames(args),
+			preload=['vm_defs', 'vm_defs.disks'])
+
+		requests = {}
+		for node in nodes:
+			try:
+				request = self.get_storage_request(node)
+			except rocks.util.CommandError:
+				# reported by run when it gets to the host
+				continue
+			if request:
+				requests[node.name] = request
+		return requests
+
+	def release(self, requests, devices):
+		"""unmap the volumes mapped by a batch which failed, return the
+		volumes which could not be unmapped"""
+		volumes = {}
+		for (host, device) in devices.items():
+			if not isinstance(device, Exception):
+				(nas_name, zpool_name, volume, phys, size) = \
+					requests[host]
+				volumes.setdefault(nas_name, []).append(volume)
+		failed = []
+		for (nas_name, names) in volumes.items():
+			try:
+				results = CommandLauncher().callDelHostStoragemaps(
+					nas_name, names)
+			except rocks.util.CommandError, e:
+				failed.extend("%s (%s)" % (volume, e) for volume in names)
+				continue
+			failed.extend("%s (%s)" % (result['zvol'], result.get('error'))
+				for result in results if result['status'] != 'success')
+		return failed
+
+	def allocate_all(self):
+		"""map the storage of all the hosts of this command at once, if
+		any host fails the volumes already mapped are released and the
+		failures are raised together before any VM starts"""
+		self.devices = {}
+		parallel = self.get_parallel()
+		if parallel <= 1:
+			return
+		requests = self.get_batch_requests()
+		if len(requests) <= 1:
 			return
-		nas_name = disk.img_nas_server.server_name
-		zpool_name = disk.img_nas_server.zpool_name
-		device = CommandLauncher().callAddHostStoragemap(nas_name, zpool_name,
-				volume, phys, size)
+
+		devices = CommandLauncher().callAddHostStoragemapParallel(
+				requests, parallel)
+		failed = ["%s (%s)" % (host, device) for (host, device) in
+			sorted(devices.items()) if isinstance(device, Exception)]
+		if failed:
+			message = "Unable to allocate storage for " + ", ".join(failed)
+			left = self.release(requests, devices)
+			if left:
+				message += "; unable to release " + ", ".join(left)
+			raise rocks.util.CommandError(message)
+		self.devices = devices
+
+	def run(self, node):
+		# here you can relocate your VM in rocks DB
+		# node is of type rocks.db.mappings.base.Node
+		request = self.get_storage_request(node)
+		if not request:
+			return
+		(nas_name, zpool_name, volume, phys, size) = request
+
+		if getattr(self, 'devices', None) is None:
+			self.allocate_all()
+		device = self.devices.pop(node.name, None)
+		if device is None:
+			device = CommandLauncher().callAddHostStoragemap(nas_name,
+					zpool_name, volume, phys, size)
+
+		disk = node.vm_defs.disks[0]
 		disk.vbd_type = "phy"
 		disk.prefix = os.path.dirname(device)
 		disk.name = os.path.basename(device)
@@ -60,25 +60,42 @@ import rocks.db.mappings.img_manager
 from imgstorage.commandlauncher import CommandLauncher
 
 class Plugin(rocks.commands.Plugin):
+	"""
+	Unmap the VM disk image once the VM is stopped.
+
+	The volume is released as soon as its VM is down: "rocks stop host
+	vm" gives its plugins no call at the end of the command, so nothing
+	is left pending for a later host. The NAS answers as soon as the
+	compute node has released the volume and deletes the iSCSI target
+	in the background.
+	"""
 
 	def provides(self):
 		return 'plugin_disallocate'
 
-	def run(self, node):
-		# here you can disallocate the resource used by your VM
-		# in rocks DB
-		# node is of type rocks.db.mappings.base.Node
+	def get_storage_request(self, node):
+		"""return the (nas, volume) tuple needed to unmap the node disk
+		or None if the node does not use the img-storage system"""
 		if not node.vm_defs.physNode or len(node.vm_defs.disks) <= 0:
 			raise rocks.util.CommandError("Unable to release " + \
 				"storage for " + node.name)
 		disk = node.vm_defs.disks[0]
-		volume = node.name + '-vol'
 		if not (disk.img_nas_server and disk.img_nas_server.server_name):
 			# the node does not use img-storage system
+			return None
+		return (disk.img_nas_server.server_name, node.name + '-vol')
+
+	def run(self, node):
+		# here you can disallocate the resource used by your VM
+		# in rocks DB
+		# node is of type rocks.db.mappings.base.Node
+		request = self.get_storage_request(node)
+		if not request:
 			return
-		nas_name = disk.img_nas_server.server_name
+		(nas_name, volume) = request
+
 		CommandLauncher().callDelHostStoragemap(nas_name, volume)
-		return 
+		return
 
 
 RollName = "img-storage"
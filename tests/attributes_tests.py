@@ -0,0 +1,157 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+from mock import MagicMock
+import mock
+from imgstorage import AttributeCache, ActionError, LazyNodeConfig
+
+import json
+import tempfile
+import time
+
+
+class TestAttributeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = AttributeCache(ttl=60)
+        self.attrs = {
+            'compute-0-1': {'img_sync': 'true', 'vm_container_zpool': 'tank'},
+            'compute-0-2': {'img_upload_speed': '10m'},
+        }
+
+    def db(self, mockDb):
+        db = mockDb.return_value
+        db.getHostname.side_effect = lambda name: (name or 'nas-0-0').replace('.ibnet', '')
+        db.getHostAttrs.side_effect = lambda name: dict(self.attrs[name])
+        return db
+
+    @mock.patch('imgstorage.time.time', return_value=1000)
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_get_cached(self, mockDb, mockTime):
+        db = self.db(mockDb)
+        self.assertEqual(self.cache.get('img_sync', 'compute-0-1'), 'true')
+        self.assertEqual(self.cache.get('vm_container_zpool', 'compute-0-1'), 'tank')
+        self.assertEqual(self.cache.get('img_upload_speed', 'compute-0-1'), None)
+        self.assertEqual(db.getHostAttrs.call_count, 1)
+        self.assertEqual(mockDb.call_count, 1)
+
+    @mock.patch('imgstorage.time.time', return_value=1000)
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_expired_hosts_reloaded_together(self, mockDb, mockTime):
+        db = self.db(mockDb)
+        self.cache.get('img_sync', 'compute-0-1.ibnet')
+        self.cache.get('img_upload_speed', 'compute-0-2')
+        self.attrs['compute-0-1']['img_sync'] = 'false'
+
+        mockTime.return_value = 1000 + 61
+        self.assertEqual(self.cache.get('img_upload_speed', 'compute-0-2'), '10m')
+        self.assertEqual(mockDb.call_count, 3)
+        self.assertEqual(db.getHostAttrs.call_count, 4)
+        self.assertEqual(self.cache.get('img_sync', 'compute-0-1.ibnet'), 'false')
+        self.assertEqual(mockDb.call_count, 3)
+
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_invalidate(self, mockDb):
+        db = self.db(mockDb)
+        self.cache.get('img_sync', 'compute-0-1')
+        self.attrs['compute-0-1']['img_sync'] = 'false'
+        self.cache.invalidate('compute-0-1')
+        self.assertEqual(self.cache.get('img_sync', 'compute-0-1'), 'false')
+        self.assertEqual(db.getHostAttrs.call_count, 2)
+
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_lookup_while_loading(self, mockDb):
+        db = self.db(mockDb)
+        self.cache.get('img_upload_speed', 'compute-0-2')
+        def getHostAttrs(name):
+            # the cached hosts are read while the database is queried
+            self.assertEqual(self.cache.get('img_upload_speed', 'compute-0-2'), '10m')
+            return dict(self.attrs[name])
+        db.getHostAttrs.side_effect = getHostAttrs
+        self.assertEqual(self.cache.get('img_sync', 'compute-0-1'), 'true')
+        self.assertEqual(self.cache.loading, set())
+
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_unknown_host(self, mockDb):
+        self.db(mockDb)
+        self.assertRaises(ActionError, self.cache.get, 'img_sync', 'compute-9-9')
+
+
+class TestLazyNodeConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_file = tempfile.mktemp()
+        self.config = LazyNodeConfig(self.cache_file, max_age=60)
+
+    def tearDown(self):
+        if os.path.exists(self.cache_file):
+            os.remove(self.cache_file)
+
+    def db(self, mockDb):
+        db = mockDb.return_value
+        db.getHostname.return_value = 'nas-0-0'
+        db.getHostAttr.side_effect = lambda host, attr: {'IB_net': 'ibnet'}.get(attr)
+        return db
+
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_lazy(self, mockDb):
+        self.db(mockDb)
+        self.assertFalse(mockDb.called)
+        self.assertEqual(self.config.NODE_NAME, 'nas-0-0')
+        self.assertEqual(self.config.IB_NET, 'ibnet')
+        self.assertEqual(self.config.IMG_SYNC_WORKERS, None)
+        self.assertEqual(mockDb.call_count, 1)
+        with open(self.cache_file) as f:
+            self.assertEqual(json.load(f)['NODE_NAME'], 'nas-0-0')
+        self.assertRaises(AttributeError, getattr, self.config, 'OTHER')
+
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_cache_file(self, mockDb):
+        values = dict((name, None) for name in LazyNodeConfig.ATTRIBUTES)
+        values['NODE_NAME'] = 'nas-0-1'
+        with open(self.cache_file, 'w') as f:
+            json.dump(values, f)
+        self.assertEqual(self.config.NODE_NAME, 'nas-0-1')
+        self.assertFalse(mockDb.called)
+
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_cache_file_missing_attribute(self, mockDb):
+        self.db(mockDb)
+        with open(self.cache_file, 'w') as f:
+            json.dump({'NODE_NAME': 'nas-0-1', 'IB_NET': None}, f)
+        self.assertEqual(self.config.NODE_NAME, 'nas-0-0')
+
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_stale_cache_file(self, mockDb):
+        self.db(mockDb)
+        with open(self.cache_file, 'w') as f:
+            json.dump({'NODE_NAME': 'nas-0-1', 'IB_NET': None}, f)
+        os.utime(self.cache_file, (time.time() - 120, time.time() - 120))
+        self.assertEqual(self.config.NODE_NAME, 'nas-0-0')
+
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_db_unavailable(self, mockDb):
+        mockDb.return_value.connect.side_effect = Exception('mysql is down')
+        with open(self.cache_file, 'w') as f:
+            json.dump({'NODE_NAME': 'nas-0-1', 'IB_NET': None}, f)
+        os.utime(self.cache_file, (time.time() - 120, time.time() - 120))
+        self.assertEqual(self.config.NODE_NAME, 'nas-0-1')
+
+    @mock.patch('imgstorage.rocks.db.helper.DatabaseHelper')
+    def test_refresh_skips_cache_file(self, mockDb):
+        self.db(mockDb)
+        values = dict((name, None) for name in LazyNodeConfig.ATTRIBUTES)
+        values['NODE_NAME'] = 'nas-0-1'
+        with open(self.cache_file, 'w') as f:
+            json.dump(values, f)
+        self.config.refresh()
+        self.assertEqual(self.config.NODE_NAME, 'nas-0-0')
+        with open(self.cache_file) as f:
+            self.assertEqual(json.load(f)['NODE_NAME'], 'nas-0-0')
+
+if __name__ == '__main__':
+    unittest.main()
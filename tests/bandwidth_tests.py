@@ -0,0 +1,57 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+import mock
+from imgstorage.bandwidth import BandwidthScheduler
+
+
+class TestBandwidthScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = BandwidthScheduler(100)
+
+    def test_fair_share(self):
+        slow = self.scheduler.open(('compute-0-1', 'upload'), 10)
+        fast1 = self.scheduler.open(('compute-0-2', 'upload'))
+        fast2 = self.scheduler.open(('compute-0-2', 'upload'))
+        self.assertEqual([slow.rate, fast1.rate, fast2.rate], [10, 45, 45])
+
+        # the key limit is split between the flows of the key
+        self.scheduler.set_key_limit(('compute-0-2', 'upload'), 40)
+        self.assertEqual([slow.rate, fast1.rate, fast2.rate], [10, 20, 20])
+
+        self.scheduler.set_limit(30)
+        self.assertEqual([slow.rate, fast1.rate, fast2.rate], [10, 10, 10])
+
+        fast1.close()
+        self.assertEqual([slow.rate, fast2.rate], [10, 20])
+
+    def test_unlimited(self):
+        self.scheduler.set_limit(None)
+        flow = self.scheduler.open(('compute-0-1', 'download'))
+        self.assertEqual(flow.rate, None)
+        with mock.patch('imgstorage.bandwidth.time.sleep') as mockSleep:
+            flow.throttle(1024 ** 3)
+            self.assertFalse(mockSleep.called)
+
+    def test_close_forgets_key(self):
+        with self.scheduler.open(('compute-0-1', 'upload'), 10):
+            self.assertEqual(self.scheduler.keys(), [('compute-0-1', 'upload')])
+        self.assertEqual(self.scheduler.keys(), [])
+        self.assertEqual(self.scheduler.key_limits, {})
+
+    @mock.patch('imgstorage.bandwidth.time.sleep')
+    @mock.patch('imgstorage.bandwidth.time.time', return_value=1000)
+    def test_throttle(self, mockTime, mockSleep):
+        flow = self.scheduler.open(('compute-0-1', 'upload'))
+        flow.throttle(50)
+        mockSleep.assert_called_with(0.5)
+        flow.throttle(50)
+        mockSleep.assert_called_with(1.0)
+
+if __name__ == '__main__':
+    unittest.main()
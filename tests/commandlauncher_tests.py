@@ -0,0 +1,70 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+import mock
+from mock import MagicMock
+from imgstorage.commandlauncher import RPCConnection, CommandLauncher
+
+import json
+
+
+class TestRPCConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.rpc = RPCConnection('img-storage', 'password', 'localhost')
+
+    def reply(self, correlation_id, body):
+        header = MagicMock()
+        header.correlation_id = correlation_id
+        self.rpc.on_message(MagicMock(), MagicMock(), header,
+                            json.dumps(body))
+
+    def test_reply_routed_by_correlation_id(self):
+        self.rpc.pending = {'id1': True, 'id2': True}
+        self.reply('id2', {'status': 'success'})
+        self.assertEqual(self.rpc.replies, {'id2': {'status': 'success'}})
+
+    def test_reply_without_correlation_id(self):
+        self.rpc.pending = {'id1': True}
+        self.reply(None, {'status': 'success'})
+        self.assertEqual(self.rpc.replies, {'id1': {'status': 'success'}})
+
+    def test_late_reply_dropped(self):
+        # id1 timed out, its reply must not answer id2
+
+        self.rpc.pending = {'id2': True}
+        self.reply('id1', {'status': 'success'})
+        self.assertEqual(self.rpc.replies, {})
+
+
+class TestListAllStoragemaps(unittest.TestCase):
+
+    @mock.patch('imgstorage.commandlauncher.RPCConnection.instance')
+    @mock.patch('imgstorage.commandlauncher.RabbitMQLocator')
+    def test_pages(self, mockLocator, mockInstance):
+        pages = {
+            ('nas-0-0', None): {'status': 'success', 'body': [{'zvol': 'a'}], 'next': 'a'},
+            ('nas-0-0', 'a'): {'status': 'success', 'body': [{'zvol': 'b'}], 'next': None},
+            ('nas-0-1', None): {'status': 'success', 'body': [{'zvol': 'c'}]},
+            ('nas-0-2', None): {'status': 'success', 'body': [{'zvol': 'd'}], 'next': 'd'},
+            ('nas-0-2', 'd'): {'status': 'error', 'error': 'Database is locked'},
+            }
+        rpc = mockInstance.return_value
+        rpc.send.side_effect = lambda message, host: (host, message.get('after'))
+        rpc.gather.side_effect = lambda ids, timeout: dict((id, pages[id]) for id in ids)
+
+        (replies, failed) = CommandLauncher().callListAllStoragemaps(
+            ['nas-0-0', 'nas-0-1', 'nas-0-2'], page_size=1)
+        self.assertEqual(replies, {'nas-0-0': [{'zvol': 'a'}, {'zvol': 'b'}],
+                                   'nas-0-1': [{'zvol': 'c'}]})
+        self.assertEqual(failed, {'nas-0-2': 'Database is locked'})
+        self.assertEqual(rpc.send.call_args_list[0][0][0],
+                         {'action': 'list_zvols', 'limit': 1})
+        self.assertEqual(rpc.gather.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
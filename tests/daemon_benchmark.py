@@ -0,0 +1,852 @@
+#!/opt/rocks/bin/python
+#
+# Measure the throughput and the latency of the NAS and vm container
+# daemons as the number of zvols and of concurrent requests grows.
+#
+# A NasDaemon and a VmDaemon run in this process on simulated nodes:
+# zfs, tgtadm, iscsiadm, dmsetup, blockdev and ssh are replaced by fakes
+# which keep the state of the zvols, targets, sessions and device mapper
+# devices and sleep for a configurable latency, and the AMQP exchange by
+# an in-process broker. Before every run the NAS gets the given number
+# of zvols, every other one exported to some other vm container, so the
+# database, the tgtadm listing and the target table are as big as on a
+# busy NAS. The frontend then sends the requests keeping at most
+# "conc" of them in flight:
+#
+#   map       map_zvol until the frontend gets the reply
+#   list      a list_zvols page starting at a random zvol
+#   unmap     unmap_zvol until the frontend gets the reply
+#   upload    (sync mode) map_zvol until the zvol is merged on the vm
+#             container and released by the NAS
+#   download  (sync mode) unmap_zvol until the zvol is copied back to
+#             the NAS and released
+#
+# In sync mode every map waits the 2 second udev settle of the vm
+# container, so a full run takes a while; -m, -n, -c and -r run a part
+# of it. It needs the imgstorage dependencies (rocks, tornado, pika and
+# mock) but no NAS, vm container, broker or database.
+#
+# usage: python tests/daemon_benchmark.py [-m iscsi,sync] [-n zvols,...]
+#            [-c concurrency,...] [-r requests] [-l command=seconds,...]
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import getopt
+import glob
+import json
+import logging
+import math
+import mock
+import random
+import re
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+import imgstorage
+from imgstorage import ActionError, LazyNodeConfig
+from imgstorage.imgstoragedaemon import trackCommand
+from imgstorage.imgstoragenas import NasDaemon
+from imgstorage.imgstoragevm import VmDaemon, BlockDeviceIndex
+from imgstorage.zfstransfer import ZfsTransfer
+
+from pika.spec import BasicProperties
+
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from tornado.gen import Task, Return, coroutine
+from tornado.stack_context import NullContext
+
+# seconds taken by the fake commands. ssh is added to the commands run on
+# another node, send is a full zfs stream (an incremental one takes a
+# tenth of it) and merge a device mapper snapshot-merge
+
+LATENCY = {
+    'zfs': 0.01,
+    'tgtadm': 0.02,
+    'iscsiadm': 0.05,
+    'dmsetup': 0.01,
+    'blockdev': 0.005,
+    'ssh': 0.05,
+    'send': 0.5,
+    'merge': 0.5,
+    }
+
+MODES = ['iscsi', 'sync']
+ZVOLS = [10, 100, 1000, 10000]
+CONCURRENCY = [1, 8, 64]
+REQUESTS = 100
+
+NAS = 'nas-0-0'
+COMPUTE = 'compute-0-0'
+ZPOOL = 'tank'
+SIZE = 36
+LIST_LIMIT = 100
+SYNC_TIMEOUT = 600
+
+
+@coroutine
+def sleep(seconds):
+    yield Task(IOLoop.instance().add_timeout, time.time() + seconds)
+
+
+def options(args):
+    """flag -> value of the '-f value' pairs of a command line"""
+
+    return dict(zip(args[::2], args[1::2]))
+
+
+def disk_name(index):
+    """sdb, sdc, ..., sdz, sdaa, ... for index 1, 2, ..."""
+
+    name = ''
+    while index >= 0:
+        name = chr(ord('a') + index % 26) + name
+        index = index / 26 - 1
+    return 'sd' + name
+
+
+def percentile(values, fraction):
+    """nearest-rank percentile of the sorted values"""
+
+    if not values:
+        return 0
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+
+class FakeHost:
+
+    """
+    The zfs volumes, tgtd targets, iSCSI sessions and device mapper
+    devices of a simulated node, changed by the commands it runs.
+    """
+
+    def __init__(self, cluster, name, ip):
+        self.cluster = cluster
+        self.name = name
+        self.ip = ip
+        self.volumes = {}
+        self.snapshots = {}
+        self.targets = {}
+        self.sessions = {}
+        self.devices = {}
+        self.disks = 0
+
+    def error(self, argv, message):
+        return ActionError('Error executing %s: %s' % (argv, message))
+
+    def resolve(self, argv):
+        """the host and the command line of a command, run over ssh when
+        it is wrapped in su -c '/usr/bin/ssh host "..."'"""
+
+        if argv[0] != 'su':
+            return (self, argv)
+        match = re.match(r'/usr/bin/ssh (\S+) "(.*)"$', argv[3])
+        return (self.cluster.host(match.group(1)), match.group(2).split())
+
+    def latency(self, argv):
+        (host, argv) = self.resolve(argv)
+        name = os.path.basename(argv[0])
+        seconds = LATENCY.get(name, 0)
+        if host is not self:
+            seconds += LATENCY['ssh']
+        if name == 'dmsetup' and argv[1] == 'wait':
+            device = host.devices.get(argv[2])
+            if device and device['merged']:
+                seconds += max(device['merged'] - time.time(), 0)
+        return seconds
+
+    def execute(self, argv):
+        with self.cluster.lock:
+            (host, argv) = self.resolve(argv)
+            command = getattr(host, os.path.basename(argv[0]), None)
+            if command is None:
+                raise ActionError('Command %s failed: [Errno 2] No such file or directory'
+                                  % argv[0])
+            try:
+                return command(argv[1:])
+            except (ActionError, KeyError, IndexError, ValueError), e:
+                raise self.error(argv, str(e))
+
+    @coroutine
+    def background(self, cmdlist, shell=False):
+        """runCommandBackground of this node"""
+
+        start = time.time()
+        yield sleep(self.latency(cmdlist))
+        try:
+            out = self.execute(cmdlist)
+        except ActionError:
+            trackCommand(cmdlist, start, 1)
+            raise
+        trackCommand(cmdlist, start, 0, sum(len(line) for line in
+                     out))
+        raise Return((out, ''))
+
+    def command(
+        self,
+        params,
+        params2=None,
+        shell=False,
+        ):
+        """runCommand of this node"""
+
+        start = time.time()
+        time.sleep(self.latency(params))
+        try:
+            out = self.execute(params)
+        except ActionError:
+            trackCommand(params, start, 1)
+            raise
+        trackCommand(params, start, 0, sum(len(line) for line in
+                     out))
+        return out
+
+    def volume(self, name):
+        if name not in self.volumes:
+            raise ActionError("cannot open '%s': dataset does not exist"
+                              % name)
+        return self.volumes[name]
+
+    def zfs(self, args):
+        if args[0] == 'list':
+            if '-t' in args and args[args.index('-t') + 1] \
+                == 'snapshot':
+                self.volume(args[-1])
+                return list(self.snapshots[args[-1]])
+            if '-t' in args or args[-1] == '-H':
+                return ['%s\t%s' % (name, volume['referenced'])
+                        for (name, volume) in
+                        sorted(self.volumes.items())]
+            self.volume(args[-1])
+            return ['%s\t%s' % (args[-1], self.volumes[args[-1]]['referenced'
+                    ])]
+        if args[0] == 'create':
+            if args[-1] in self.volumes:
+                raise ActionError('cannot create %s: dataset already exists'
+                                  % args[-1])
+            size = int(args[args.index('-V') + 1][:-2]) * 1024 ** 3
+            self.volumes[args[-1]] = {'size': size, 'referenced': 0}
+            self.snapshots[args[-1]] = []
+            return []
+        if args[0] == 'destroy':
+            name = [arg for arg in args[1:] if arg != '-r'][0]
+            if '@' in name:
+                snapshots = self.snapshots.get(name.split('@')[0], [])
+                if name not in snapshots:
+                    raise ActionError("could not find any snapshots to destroy; check snapshot names."
+                            )
+                snapshots.remove(name)
+            else:
+                self.volume(name)
+                del self.volumes[name]
+                del self.snapshots[name]
+            return []
+        if args[0] == 'snap':
+            self.volume(args[1].split('@')[0])
+            self.snapshots[args[1].split('@')[0]].append(args[1])
+            return []
+        if args[0] == 'get':
+            self.volume(args[-1])
+            return ['-']
+        if args[0] == 'send':
+            volume = self.volume(args[-1].split('@')[0])
+            if args[-1] not in self.snapshots[args[-1].split('@')[0]]:
+                raise ActionError("could not find snapshot '%s'"
+                                  % args[-1])
+            size = volume['referenced']
+            if '-i' in args:
+                size /= 10
+            return ['full\t%s\t%d' % (args[-1], size), 'size\t%d'
+                    % size]
+        if args[0] == 'receive':
+            return []
+        raise ActionError('unrecognized command %s' % args[0])
+
+    def tgtadm(self, args):
+        opts = options(args)
+        if opts['--op'] == 'show':
+            out = []
+            for (tid, target) in sorted(self.targets.items()):
+                out += [
+                    'Target %d: %s' % (tid, target['name']),
+                    '    System information:',
+                    '        Driver: iscsi',
+                    '        State: ready',
+                    '    LUN information:',
+                    '        LUN: 1',
+                    '            Backing store path: %s'
+                        % target['device'],
+                    '    ACL information:',
+                    ] + ['        %s' % ip for ip in
+                         target['initiators']]
+            return out
+
+        tid = int(opts['--tid'])
+        if opts['--op'] == 'new' and opts['--mode'] == 'target':
+            if tid in self.targets or opts['-T'] in [target['name']
+                    for target in self.targets.values()]:
+                raise ActionError('tgtadm: this target already exists')
+            self.targets[tid] = {'name': opts['-T'], 'device': None,
+                                 'initiators': []}
+            return []
+        if tid not in self.targets:
+            raise ActionError("tgtadm: can't find the target")
+        if opts['--op'] == 'new':
+            self.volume(opts['-b'][len('/dev/'):])
+            self.targets[tid]['device'] = opts['-b']
+        elif opts['--op'] == 'bind':
+            self.targets[tid]['initiators'].append(opts['-I'])
+        elif opts['--op'] == 'delete':
+            del self.targets[tid]
+        return []
+
+    def iscsiadm(self, args):
+        opts = options(args)
+        if opts['-m'] == 'discovery':
+            nas = self.cluster.host(opts['-p'])
+            return ['%s:3260,1 %s' % (nas.ip, target['name'])
+                    for (tid, target) in sorted(nas.targets.items())
+                    if self.ip in target['initiators']]
+        if opts['-m'] == 'session':
+            if not self.sessions:
+                raise ActionError('iscsiadm: No active sessions.')
+            out = []
+            for (name, session) in sorted(self.sessions.items()):
+                out += ['Target: %s (non-flash)' % name,
+                        '\tCurrent Portal: %s:3260,1' % session['portal'],
+                        '\t\tiSCSI Session State: LOGGED_IN',
+                        '\t\t\tAttached scsi disk %s\t\tState: running'
+                        % session['disk']]
+            return out
+
+        name = opts['-T']
+        if '-l' in args:
+            nas = self.cluster.host(opts['-p'])
+            targets = [target for target in nas.targets.values()
+                       if target['name'] == name and self.ip
+                       in target['initiators']]
+            if not targets:
+                raise ActionError('iscsiadm: No records found')
+            self.disks += 1
+            self.sessions[name] = {'portal': nas.ip,
+                                   'disk': disk_name(self.disks),
+                                   'sectors': nas.volume(targets[0]['device'
+                                   ][len('/dev/'):])['size'] / 512}
+            return ['Login to [iface: default, target: %s, portal: %s,3260] successful.'
+                     % (name, nas.ip)]
+        if name not in self.sessions:
+            raise ActionError('iscsiadm: No matching sessions found')
+        del self.sessions[name]
+        return ['Logout of [sid: 1, target: %s] successful.' % name]
+
+    def blockdev(self, args):
+        for session in self.sessions.values():
+            if session['disk'] == os.path.basename(args[-1]):
+                return [str(session['sectors'])]
+        raise ActionError('blockdev: cannot open %s' % args[-1])
+
+    def dmsetup(self, args):
+        if args[0] == 'status':
+            if not self.devices:
+                return ['No devices found']
+            return ['%s: %s' % (name, self.device_status(device))
+                    for (name, device) in sorted(self.devices.items())]
+
+        if args[0] == 'create':
+            if args[1] in self.devices:
+                raise ActionError('device-mapper: create ioctl on %s failed: Device or resource busy'
+                                   % args[1])
+            self.devices[args[1]] = {'table': args[3].split(),
+                    'merged': None}
+            return []
+
+        if args[0] == 'info':
+            name = args[-1]
+        else:
+            name = os.path.basename([arg for arg in args[1:]
+                                    if not arg.startswith('-')][0])
+        if name not in self.devices:
+            raise ActionError('Device %s not found' % name)
+        if args[0] == 'remove':
+            del self.devices[name]
+        elif args[0] == 'reload':
+            table = args[args.index('--table') + 1].split()
+            self.devices[name]['table'] = table
+            if table[2] == 'snapshot-merge':
+                self.devices[name]['merged'] = time.time() \
+                    + LATENCY['merge']
+        elif args[0] == 'info':
+            return ['0']
+        return []
+
+    def device_status(self, device):
+        """<start> <sectors> <type> [<allocated>/<total> <metadata>],
+        the allocated sectors drop to the metadata ones when a merge is
+        over"""
+
+        (start, sectors, kind) = device['table'][:3]
+        if kind == 'linear':
+            return '%s %s linear' % (start, sectors)
+        allocated = 16
+        if device['merged'] and time.time() < device['merged']:
+            allocated = 1040
+        return '%s %s %s %d/%s 16' % (start, sectors, kind, allocated,
+                sectors)
+
+
+class FakeCluster:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def add(self, name, ip):
+        self.hosts[name] = FakeHost(self, name, ip)
+        return self.hosts[name]
+
+    def host(self, name):
+        if name.split('.')[0] not in self.hosts:
+            raise ActionError('ssh: Could not resolve hostname %s'
+                              % name)
+        return self.hosts[name.split('.')[0]]
+
+    def address(self, name):
+        """socket.gethostbyname of the simulated nodes"""
+
+        if name.split('.')[0] not in self.hosts:
+            raise socket.gaierror(-2, 'Name or service not known')
+        return self.hosts[name.split('.')[0]].ip
+
+    def stream(self, transfer, args):
+        """ZfsTransfer.stream: take as long as the stream would and
+        create the snapshot on the receiving node"""
+
+        start = time.time()
+        size = transfer.estimate(args)
+        time.sleep(LATENCY['send'] / (10.0 if '-i' in args else 1))
+        with self.lock:
+            sender = self.host(transfer.sender or NAS)
+            receiver = self.host(transfer.receiver or NAS)
+            (dataset, snapshot) = args[-1].split('@')
+            if transfer.dataset not in receiver.volumes:
+                receiver.volumes[transfer.dataset] = \
+                    dict(sender.volume(dataset))
+                receiver.snapshots[transfer.dataset] = []
+            receiver.snapshots[transfer.dataset].append('%s@%s'
+                    % (transfer.dataset, snapshot))
+        trackCommand(['zfs', 'send'] + args, start, 0, size or 0)
+        return size
+
+
+class FakeConnector:
+
+    """stands in for the RabbitMQCommonClient of a daemon"""
+
+    def __init__(self, broker, on_open):
+        self.broker = broker
+        self.on_open = on_open
+        self.timeouts = []
+        self._connection = self
+
+    def run(self):
+        IOLoop.instance().add_callback(self.on_open, self)
+
+    def stop(self):
+        for timeout in self.timeouts:
+            IOLoop.instance().remove_timeout(timeout)
+        self.timeouts = []
+
+    def add_timeout(self, seconds, callback):
+        with NullContext():
+            self.timeouts.append(IOLoop.instance().add_timeout(time.time()
+                                 + seconds, callback))
+
+    def publish_message(
+        self,
+        message,
+        routing_key=None,
+        reply_to=None,
+        exchange=None,
+        correlation_id=None,
+        on_fail=None,
+        ):
+        self.broker.publish(message, routing_key, reply_to,
+                            correlation_id, on_fail)
+
+
+class FakeBroker:
+
+    """
+    In-process stand-in of the rocks.vm-manage exchange. A message is
+    delivered on the next IOLoop iteration to the handler bound to its
+    routing key, outside of the stack context of the sender, or given
+    to on_fail when nobody is bound to it.
+    """
+
+    def __init__(self):
+        self.queues = {}
+
+    def bind(self, routing_key, handler):
+        self.queues[routing_key] = handler
+
+    def client(
+        self,
+        exchange,
+        exchange_type,
+        username,
+        password,
+        on_message,
+        on_open,
+        routing_key=None,
+        ):
+        """RabbitMQCommonClient constructor"""
+
+        self.bind(routing_key, on_message)
+        return FakeConnector(self, on_open)
+
+    def publish(
+        self,
+        message,
+        routing_key,
+        reply_to=None,
+        correlation_id=None,
+        on_fail=None,
+        message_id=None,
+        ):
+        handler = self.queues.get(routing_key)
+        with NullContext():
+            if handler is None:
+                if on_fail:
+                    IOLoop.instance().add_callback(on_fail)
+                return
+            props = BasicProperties(reply_to=reply_to,
+                                    message_id=message_id
+                                    or str(uuid.uuid4()),
+                                    correlation_id=correlation_id)
+            IOLoop.instance().add_callback(handler, props, message, None)
+
+
+class Frontend:
+
+    """the rocks commands, sending requests to the NAS"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.waiting = {}
+        broker.bind('frontend', self.reply)
+
+    def reply(self, props, message, deliver):
+        future = self.waiting.pop(props.correlation_id, None)
+        if future:
+            future.set_result(json.loads(message))
+
+    def call(self, message):
+        request_id = str(uuid.uuid4())
+        self.waiting[request_id] = Future()
+        self.broker.publish(json.dumps(message), NAS, 'frontend',
+                            message_id=request_id)
+        return self.waiting[request_id]
+
+
+def node_config(name, **values):
+    """make NodeConfig the configuration of the node name"""
+
+    config = dict((key, None) for key in LazyNodeConfig.ATTRIBUTES)
+    config.update(values)
+    config['NODE_NAME'] = name
+    imgstorage.NodeConfig.values = config
+
+
+class Run:
+
+    """a NAS with zvols zvols and a vm container on simulated nodes"""
+
+    def __init__(
+        self,
+        mode,
+        zvols,
+        concurrency,
+        ):
+        self.mode = mode
+        self.zvols = zvols
+        self.concurrency = concurrency
+        self.cluster = FakeCluster()
+        self.broker = FakeBroker()
+        self.frontend = Frontend(self.broker)
+        self.attributes = {}
+        if mode == 'sync':
+            self.attributes[COMPUTE] = {'img_sync': 'true',
+                    'vm_container_zpool': ZPOOL}
+        self.releases = {}
+
+    def attribute(
+        self,
+        attr_name,
+        hostname=None,
+        logger=None,
+        ):
+        """host_attributes.get and get_attribute of the simulated nodes"""
+
+        return self.attributes.get(hostname
+                                   or imgstorage.NodeConfig.NODE_NAME,
+                                   {}).get(attr_name)
+
+    def start(self):
+        nas = self.cluster.add(NAS, '10.1.0.1')
+        vm = self.cluster.add(COMPUTE, '10.1.0.2')
+
+        def stream(transfer, args):
+            return self.cluster.stream(transfer, args)
+
+        self.patchers = [
+            mock.patch('imgstorage.rocks.db.helper.DatabaseHelper'),
+            mock.patch('imgstorage.get_attribute', self.attribute),
+            mock.patch('imgstorage.host_attributes.get', self.attribute),
+            mock.patch('socket.gethostbyname', self.cluster.address),
+            mock.patch('imgstorage.imgstoragenas.RabbitMQCommonClient',
+                       self.broker.client),
+            mock.patch('imgstorage.imgstoragevm.RabbitMQCommonClient',
+                       self.broker.client),
+            mock.patch('imgstorage.imgstoragenas.runCommand',
+                       nas.command),
+            mock.patch('imgstorage.imgstoragenas.runCommandBackground',
+                       nas.background),
+            mock.patch('imgstorage.zfstransfer.runCommand', nas.command),
+            mock.patch('imgstorage.imgstoragevm.runCommand', vm.command),
+            mock.patch('imgstorage.imgstoragevm.runCommandBackground',
+                       vm.background),
+            mock.patch.object(ZfsTransfer, 'stream', stream),
+            ]
+        for patcher in self.patchers:
+            patcher.start()
+        self.config = imgstorage.NodeConfig.values
+
+        node_config(NAS)
+        self.nas = NasDaemon()
+        self.nas.SQLITE_DB = tempfile.mktemp(prefix='bench_nas_')
+        self.nas.metrics_started = True
+        self.nas.run()
+        self.populate()
+
+        # the NAS releases the lock of a synced zvol when the vm
+        # container or the download is done with it
+
+        release = self.nas.release_zvol
+
+        def release_zvol(zvol):
+            release(zvol)
+            if zvol in self.releases:
+                IOLoop.instance().add_callback(self.releases.pop(zvol),
+                        time.time())
+
+        self.nas.release_zvol = release_zvol
+
+        node_config(COMPUTE, VM_CONTAINER_ZPOOL=ZPOOL)
+        self.vm = VmDaemon()
+        self.vm.SQLITE_DB = tempfile.mktemp(prefix='bench_vm_')
+        self.vm.blk_devs = BlockDeviceIndex('/nonexistent')
+        self.vm.metrics_started = True
+        self.vm.run()
+
+        # let the startup jobs of the daemons finish
+
+        IOLoop.instance().run_sync(lambda : sleep(0.5))
+
+    def populate(self):
+        """the zvols already on the NAS, every other one is exported to
+        a vm container which is not part of the benchmark"""
+
+        nas = self.cluster.hosts[NAS]
+        rows = []
+        for i in range(self.zvols):
+            zvol = 'vol-%05d' % i
+            volume = '%s/%s' % (ZPOOL, zvol)
+            nas.volumes[volume] = {'size': SIZE * 1024 ** 3,
+                                   'referenced': 1024 ** 3}
+            nas.snapshots[volume] = []
+            if i % 2:
+                target = self.nas.iscsi_target_name(zvol)
+                nas.targets[i] = {'name': target, 'device': '/dev/%s'
+                                  % volume, 'initiators': ['10.2.%d.%d'
+                                  % (i / 250 % 250, i % 250 + 1)]}
+                rows.append((zvol, ZPOOL, target, 'compute-1-%d' % (i
+                            % 32)))
+            else:
+                rows.append((zvol, None, None, None))
+        with self.nas.state.connect() as con:
+            con.executemany('INSERT INTO zvols VALUES (?,?,?,?)', rows)
+
+    def stop(self):
+        IOLoop.instance().run_sync(self.nas.reclaim_iscsi_targets)
+        self.nas.stop()
+        self.vm.stop()
+        self.nas.pool.terminate()
+        self.nas.state.close()
+        self.vm.state.close()
+        imgstorage.NodeConfig.values = self.config
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+        for path in glob.glob(self.nas.SQLITE_DB + '*') \
+            + glob.glob(self.vm.SQLITE_DB + '*'):
+            os.remove(path)
+
+    @coroutine
+    def send(self, messages):
+        """send the messages keeping at most concurrency requests in
+        flight, return (message, start, end, reply) for each"""
+
+        results = []
+        pending = iter(messages)
+
+        @coroutine
+        def sender():
+            for message in pending:
+                start = time.time()
+                reply = (yield self.frontend.call(message))
+                results.append((message, start, time.time(), reply))
+
+        yield [sender() for i in range(self.concurrency)]
+        raise Return(results)
+
+    @coroutine
+    def released(
+        self,
+        name,
+        start,
+        results,
+        releases,
+        ):
+        """wait for the NAS to release the zvols of the successful
+        requests and report the time from the requests to the release"""
+
+        started = dict((message['zvol'], request_start) for (message,
+                       request_start, end, reply) in results
+                       if reply['status'] == 'success')
+        deadline = time.time() + SYNC_TIMEOUT
+        while time.time() < deadline and [zvol for zvol in started
+                if not releases[zvol].done()]:
+            yield sleep(0.1)
+        for zvol in releases:
+            self.releases.pop(zvol, None)
+
+        released = dict((zvol, releases[zvol].result()) for zvol in
+                        started if releases[zvol].done())
+        self.report(name, max(released.values() or [start]) - start,
+                    [released[zvol] - started[zvol] for zvol in
+                    released], len(results) - len(released))
+
+    def report(
+        self,
+        name,
+        elapsed,
+        latencies,
+        errors,
+        ):
+        latencies = sorted(latencies)
+        print '%-6s %-9s %6d %5d %9.1f %9.1f %9.1f %6d' % (
+            self.mode,
+            name,
+            self.zvols,
+            self.concurrency,
+            len(latencies) / max(elapsed, 0.001),
+            1000 * percentile(latencies, 0.5),
+            1000 * percentile(latencies, 0.99),
+            errors,
+            )
+        sys.stdout.flush()
+
+    @coroutine
+    def phase(
+        self,
+        name,
+        messages,
+        sync=None,
+        ):
+        """send the messages and report the time to the replies, with
+        sync the time to the release of the zvols as well"""
+
+        releases = {}
+        if sync:
+            for message in messages:
+                releases[message['zvol']] = Future()
+                self.releases[message['zvol']] = \
+                    releases[message['zvol']].set_result
+        start = time.time()
+        results = (yield self.send(messages))
+        self.report(name, time.time() - start, [end - request_start
+                    for (message, request_start, end, reply) in
+                    results], len([result for result in results
+                    if result[3]['status'] != 'success']))
+        if sync:
+            yield self.released(sync, start, results, releases)
+
+    @coroutine
+    def measure(self):
+        zvols = ['bench-%05d' % i for i in range(REQUESTS)]
+        sync = self.mode == 'sync'
+        yield self.phase('map', [{
+            'action': 'map_zvol',
+            'zpool': ZPOOL,
+            'zvol': zvol,
+            'remotehost': COMPUTE,
+            'size': SIZE,
+            } for zvol in zvols], sync and 'upload')
+        yield self.phase('list', [{'action': 'list_zvols',
+                         'limit': LIST_LIMIT, 'after': 'vol-%05d'
+                         % random.randrange(max(self.zvols, 1))} for
+                         zvol in zvols])
+        yield self.phase('unmap', [{'action': 'unmap_zvol',
+                         'zvol': zvol} for zvol in zvols], sync
+                         and 'download')
+
+
+def bench(mode, zvols, concurrency):
+    run = Run(mode, zvols, concurrency)
+    run.start()
+    try:
+        IOLoop.instance().run_sync(run.measure)
+    finally:
+        run.stop()
+
+
+if __name__ == '__main__':
+    (opts, args) = getopt.getopt(sys.argv[1:], 'm:n:c:r:l:')
+    for (opt, value) in opts:
+        if opt == '-m':
+            MODES = value.split(',')
+        elif opt == '-n':
+            ZVOLS = [int(count) for count in value.split(',')]
+        elif opt == '-c':
+            CONCURRENCY = [int(count) for count in value.split(',')]
+        elif opt == '-r':
+            REQUESTS = int(value)
+        elif opt == '-l':
+            for item in value.split(','):
+                (name, seconds) = item.split('=')
+                LATENCY[name] = float(seconds)
+
+    # the errors of the daemons show up on stderr
+
+    logging.basicConfig(level=logging.WARNING)
+
+    print 'latency: ' + ', '.join('%s %ss' % item for item in
+                                  sorted(LATENCY.items()))
+    print '%-6s %-9s %6s %5s %9s %9s %9s %6s' % (
+        'mode',
+        'request',
+        'zvols',
+        'conc',
+        'req/s',
+        'p50 ms',
+        'p99 ms',
+        'errors',
+        )
+    for mode in MODES:
+        for zvols in ZVOLS:
+            for concurrency in CONCURRENCY:
+                bench(mode, zvols, concurrency)
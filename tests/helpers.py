@@ -0,0 +1,17 @@
+#!/opt/rocks/bin/python
+#
+# Helpers shared by the test modules
+
+from tornado.concurrent import Future
+
+
+def background(side_effect):
+    """turn a runCommand side effect into a runCommandBackground one"""
+    def background_side_effect(*args, **kwargs):
+        future = Future()
+        try:
+            future.set_result((side_effect(*args, **kwargs), ''))
+        except Exception, e:
+            future.set_exception(e)
+        return future
+    return background_side_effect
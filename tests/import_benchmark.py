@@ -0,0 +1,87 @@
+#!/opt/rocks/bin/python
+#
+# Measure what importing imgstorage costs a rocks command.
+#
+# Every case runs in a fresh interpreter. "baseline" is the import of
+# the baseline revision, where NodeConfig queried the database at class
+# definition. "import" is what a command which never looks at NodeConfig
+# pays now, "import + db" is the first NodeConfig use when the cached
+# config file is missing and "import + cache" when it is fresh. The
+# modules column counts the modules loaded by the import.
+#
+# It needs the Rocks database, run it on a frontend or a NAS from a git
+# checkout. The baseline defaults to the first commit of the repository:
+# usage: python tests/import_benchmark.py [-b revision] [runs]
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+
+import getopt
+import shutil
+import subprocess
+import tempfile
+
+RUNS = 10
+
+SETUP = """
+import sys, time
+sys.path.insert(1, %r)
+start = time.time()
+import imgstorage.commandlauncher
+import imgstorage
+"""
+
+CACHE = """
+imgstorage.NodeConfig.cache_file = %r
+"""
+
+CASES = [
+    ('import', ''),
+    ('import + db', 'imgstorage.NodeConfig.reload()\n'
+                    'imgstorage.NodeConfig.NODE_NAME\n'),
+    ('import + cache', 'imgstorage.NodeConfig.NODE_NAME\n'),
+    ]
+
+
+def run(code):
+    out = subprocess.check_output([sys.executable, '-c', code
+                                   + 'print time.time() - start, len(sys.modules)'])
+    (seconds, modules) = out.splitlines()[-1].split()
+    return (float(seconds), int(modules))
+
+
+def checkout(revision, path):
+    """extract src/img-storage of revision in path"""
+
+    archive = subprocess.Popen(['git', 'archive', revision,
+                               'src/img-storage'], stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', path], stdin=archive.stdout)
+    archive.stdout.close()
+    if archive.wait():
+        raise SystemExit('git archive %s failed' % revision)
+    return os.path.join(path, 'src', 'img-storage')
+
+
+def report(name, code):
+    results = [run(code) for i in range(RUNS)]
+    times = [seconds for (seconds, modules) in results]
+    print '%-16s %10.1f %10.1f %8d' % (name, 1000 * sum(times)
+            / len(times), 1000 * min(times), results[-1][1])
+
+
+if __name__ == '__main__':
+    (opts, args) = getopt.getopt(sys.argv[1:], 'b:')
+    baseline = dict(opts).get('-b') or subprocess.check_output(['git',
+            'rev-list', '--max-parents=0', 'HEAD']).split()[-1]
+    if args:
+        RUNS = int(args[0])
+
+    tmp_dir = tempfile.mkdtemp()
+    cache_file = os.path.join(tmp_dir, 'img_storage_node.json')
+    print '%-16s %10s %10s %8s' % ('case', 'mean ms', 'min ms', 'modules')
+    try:
+        report('baseline', SETUP % checkout(baseline, tmp_dir))
+        for (name, code) in CASES:
+            report(name, SETUP % lib_path + CACHE % cache_file + code)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,85 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+from imgstorage.logqueue import QueueHandler, JsonFormatter, RateLimitFilter, parse_levels, set_levels
+
+import json
+import logging
+import tempfile
+import time
+
+
+class TestLogQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mktemp()
+        target = logging.FileHandler(self.path)
+        target.setFormatter(JsonFormatter())
+        self.handler = QueueHandler(target, lambda: 'trace1')
+        self.logger = logging.getLogger('imgstorage.test_logqueue')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        os.remove(self.path)
+
+    def records(self):
+        self.handler.flush()
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_json_records(self):
+        zvols = ['vol1']
+        self.logger.info('Have sync job %s', zvols)
+        zvols.append('vol2')
+        [record] = self.records()
+        self.assertEqual(record['message'], "Have sync job ['vol1']")
+        self.assertEqual((record['level'], record['logger'], record['trace']),
+            ('INFO', 'imgstorage.test_logqueue', 'trace1'))
+
+    def test_exception(self):
+        try:
+            raise ValueError('no such zvol')
+        except ValueError:
+            self.logger.exception('Failed')
+        self.assertTrue('no such zvol' in self.records()[0]['exception'])
+
+    def test_written_by_thread(self):
+        self.logger.info('first')
+        self.assertTrue(self.handler.thread.is_alive())
+        self.assertEqual(self.handler.stream, self.handler.target.stream)
+
+    def test_rate_limit(self):
+        self.handler.addFilter(RateLimitFilter(burst=2, period=60))
+        for i in range(5):
+            self.logger.debug('Have sync job %s', i)
+        self.logger.error('Error syncing')
+        self.logger.error('Error syncing')
+        self.logger.error('Error syncing')
+        self.assertEqual([r['message'] for r in self.records()],
+            ['Have sync job 0', 'Have sync job 1'] + ['Error syncing'] * 3)
+
+    def test_rate_limit_reports_suppressed(self):
+        limit = RateLimitFilter(burst=1, period=10)
+        records = [logging.makeLogRecord({'msg': 'Have sync job', 'levelno': logging.DEBUG,
+            'pathname': 'nas.py', 'lineno': 1, 'created': created}) for created in (0, 1, 2, 11)]
+        self.assertEqual([limit.filter(r) for r in records], [True, False, False, True])
+        self.assertEqual(records[3].getMessage(), 'Have sync job (2 similar messages suppressed)')
+
+    def test_levels(self):
+        self.assertEqual(parse_levels('INFO, imgstorage.commands=warning'),
+            (logging.INFO, {'imgstorage.commands': logging.WARNING}))
+        self.assertRaises(ValueError, parse_levels, 'imgstorage.commands=LOUD')
+
+        set_levels('imgstorage.test_logqueue.sub=ERROR', ['imgstorage.test_logqueue'])
+        self.assertEqual(self.logger.level, logging.DEBUG)
+        self.assertEqual(logging.getLogger('imgstorage.test_logqueue.sub').level, logging.ERROR)
+
+if __name__ == '__main__':
+    unittest.main()
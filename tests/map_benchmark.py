@@ -0,0 +1,126 @@
+#!/opt/rocks/bin/python
+#
+# Measure how many map_zvol requests per second the NAS daemon can set up
+# with 1, 8 and 64 requests in flight.
+#
+# zfs and tgtadm are replaced by fake commands which only sleep, so the
+# numbers show the effect of the daemon's concurrency and not the speed
+# of the disks. The "flock" rows emulate the old tgt-setup-lun-lock
+# behaviour, where the whole target creation was serialised host-wide.
+#
+# usage: python tests/map_benchmark.py [tgtadm latency in seconds]
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import mock
+import time
+import uuid
+
+from imgstorage.imgstoragenas import NasDaemon
+import imgstorage.imgstoragenas
+
+from pika.spec import BasicProperties
+
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from tornado.gen import Task, Return, coroutine
+
+TGTADM_LATENCY = 0.02
+ZFS_LATENCY = 0.01
+CONCURRENCY = [1, 8, 64]
+
+
+@coroutine
+def sleep(seconds):
+    yield Task(IOLoop.instance().add_timeout, time.time() + seconds)
+
+
+@coroutine
+def fake_command(cmdlist, shell=False):
+    if cmdlist[0] == 'tgtadm':
+        yield sleep(TGTADM_LATENCY)
+    else:
+        yield sleep(ZFS_LATENCY)
+    raise Return(([], ''))
+
+
+class FakeFlock:
+    """FIFO lock emulating flock on /var/lock/.tgt-setup-lun-lock"""
+
+    def __init__(self):
+        self.tail = None
+
+    @coroutine
+    def acquire(self):
+        previous = self.tail
+        done = Future()
+        self.tail = done
+        if previous:
+            yield previous
+        raise Return(lambda : done.set_result(None))
+
+
+def create_daemon():
+    with mock.patch('imgstorage.imgstoragenas.RabbitMQCommonClient'):
+        nas = NasDaemon()
+        nas.SQLITE_DB = '/tmp/bench_db_%s' % uuid.uuid4()
+        nas.ib_net = None
+        nas.run()
+    nas.iscsi_targets.reload([])
+    return nas
+
+
+@coroutine
+def map_volumes(nas, count):
+    props = BasicProperties(reply_to='reply_to', message_id='message_id')
+    yield [nas.setup_zvol_mapping('tank', 'vol-%s' % uuid.uuid4(),
+           'compute-0-0', '10', props) for i in range(count)]
+
+
+def bench(count, serialize):
+    nas = create_daemon()
+    if serialize:
+        flock = FakeFlock()
+        create_target = nas.create_iscsi_target
+
+        @coroutine
+        def locked_create_target(*args):
+            release = yield flock.acquire()
+            try:
+                target = yield create_target(*args)
+            finally:
+                release()
+            raise Return(target)
+
+        nas.create_iscsi_target = locked_create_target
+
+    try:
+        start = time.time()
+        IOLoop.instance().run_sync(lambda : map_volumes(nas, count))
+        elapsed = time.time() - start
+        mapped = len([c for c in nas.queue_connector.publish_message.mock_calls
+                      if '"map_zvol"' in c[1][0]])
+        assert mapped == count, 'mapped %s of %s' % (mapped, count)
+    finally:
+        os.remove(nas.SQLITE_DB)
+    return elapsed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        TGTADM_LATENCY = float(sys.argv[1])
+
+    print 'tgtadm latency %ss, zfs latency %ss' % (TGTADM_LATENCY,
+            ZFS_LATENCY)
+    print '%-12s %-8s %10s %10s' % ('concurrency', 'mode', 'seconds',
+            'maps/s')
+    with mock.patch('imgstorage.imgstoragenas.runCommandBackground',
+                    fake_command), \
+        mock.patch('socket.gethostbyname', return_value='10.1.1.1'):
+        for count in CONCURRENCY:
+            for (mode, serialize) in (('flock', True), ('native', False)):
+                elapsed = bench(count, serialize)
+                print '%-12s %-8s %10.3f %10.1f' % (count, mode, elapsed,
+                        count / elapsed)
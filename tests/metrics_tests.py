@@ -0,0 +1,72 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+from imgstorage import metrics
+
+from tornado.concurrent import Future
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('requests_total', 'Requests', ['action'])
+        counter.inc(action='map_zvol')
+        counter.inc(2, action='map_zvol')
+        counter.inc(action='say "hi"')
+        self.assertEqual(self.registry.render(),
+            '# HELP requests_total Requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{action="map_zvol"} 3.0\n'
+            'requests_total{action="say \\"hi\\""} 1.0\n')
+
+    def test_registered_once(self):
+        counter = self.registry.counter('requests_total', 'Requests')
+        self.assertTrue(self.registry.counter('requests_total', 'Requests') is counter)
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('sync_seconds', 'Syncs', ['direction'], buckets=(1, 10))
+        for value in (0.5, 5, 50):
+            histogram.observe(value, direction='upload')
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'sync_seconds_bucket{direction="upload",le="1.0"} 1.0',
+            'sync_seconds_bucket{direction="upload",le="10.0"} 2.0',
+            'sync_seconds_bucket{direction="upload",le="+Inf"} 3.0',
+            'sync_seconds_sum{direction="upload"} 55.5',
+            'sync_seconds_count{direction="upload"} 3.0'])
+
+    def test_gauge_function(self):
+        depth = {('pull',): 3, ('upload',): 1}
+        self.registry.gauge('queue_jobs', 'Jobs', ['priority'], lambda: depth)
+        self.registry.gauge('workers', 'Workers', (), lambda: 5)
+        depth[('pull',)] = 2
+        self.assertEqual([line for line in self.registry.render().splitlines() if not line.startswith('#')], [
+            'queue_jobs{priority="pull"} 2.0',
+            'queue_jobs{priority="upload"} 1.0',
+            'workers 5.0'])
+
+    def test_failing_gauge(self):
+        self.registry.gauge('broken', 'Broken', (), lambda: 1 / 0)
+        self.registry.gauge('workers', 'Workers', (), lambda: 5)
+        self.assertTrue('workers 5.0' in self.registry.render())
+
+    def test_track_request_future(self):
+        future = Future()
+        metrics.track_request('test_future', 0, future)
+        self.assertFalse(('test_future', 'exception') in metrics.REQUESTS.values)
+        future.set_exception(Exception('failed'))
+        self.assertEqual(metrics.REQUESTS.values[('test_future', 'exception')], 1)
+
+    def test_command_name(self):
+        self.assertEqual(metrics.command_name(['/sbin/zfs', 'list']), 'zfs')
+        self.assertEqual(metrics.command_name(['su', 'img-storage', '-c',
+            '/usr/bin/ssh compute-0-1 "/sbin/zfs snap tank/vol1@snap"']), 'zfs')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@ lib_path = os.path.abspath('src/img-storage')
 sys.path.insert(1, lib_path)
 
 import unittest
+from helpers import background
 from mock import MagicMock, ANY
 import mock
 from imgstorage.imgstoragenas import NasDaemon
@@ -12,6 +13,7 @@ from imgstorage.rabbitmqclient import RabbitMQCommonClient
 
 import uuid
 import time
+import json
 
 from pysqlite2 import dbapi2 as sqlite3
 
@@ -20,6 +22,8 @@ from StringIO import StringIO
 
 from tornado.gen import Task, Return, coroutine                                                                                                               
 import tornado.process
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 
 
 class TestNasFunctions(unittest.TestCase):
@@ -45,9 +49,9 @@ class TestNasFunctions(unittest.TestCase):
             cur.execute('INSERT INTO zvols VALUES (?,?,?,?) ',('vol1',None, None, None))
             cur.execute('INSERT INTO zvols VALUES (?,?,?,?) ',('vol2', 'my_tank', 'iqn.2001-04.com.nas-0-1-vol2', 'compute-0-3'))
             cur.execute('INSERT INTO zvols VALUES (?,?,?,?) ',('vol3_busy', 'my_tank', 'iqn.2001-04.com.nas-0-1-vol3_busy', 'compute-0-3'))
-            cur.execute('INSERT INTO zvol_calls VALUES (?,?,?)',('vol3_busy', 'reply_to', time.time()))
+            cur.execute('INSERT INTO zvol_calls(zvol, reply_to, time) VALUES (?,?,?)',('vol3_busy', 'reply_to', time.time()))
             cur.execute('INSERT INTO zvols VALUES (?,?,?,?) ',('vol4_busy', 'my_tank', 'iqn.2001-04.com.nas-0-1-vol4_busy', 'compute-0-3'))
-            cur.execute('INSERT INTO zvol_calls VALUES (?,?,?)',('vol4_busy', 'reply_to', time.time()))
+            cur.execute('INSERT INTO zvol_calls(zvol, reply_to, time) VALUES (?,?,?)',('vol4_busy', 'reply_to', time.time()))
             con.commit()
 
     def tearDown(self):
@@ -108,7 +112,7 @@ class TestNasFunctions(unittest.TestCase):
             {'action': 'map_zvol', 'zpool':'mytank', 'zvol': zvol, 'remotehost': 'compute-0-1', 'size': '10'},
             BasicProperties(reply_to='reply_to'))
         self.client.queue_connector.publish_message.assert_called_with(
-            {'action': 'zvol_mapped', 'status': 'error', 'error': 'ZVol %s is busy'%zvol}, routing_key='reply_to', exchange='')
+            {'action': 'zvol_mapped', 'status': 'error', 'error': 'ZVol %s is busy'%zvol}, routing_key='reply_to', exchange='', correlation_id=None)
         self.assertTrue(self.check_zvol_busy(zvol))
 
 
@@ -117,10 +121,10 @@ class TestNasFunctions(unittest.TestCase):
         self.client.queue_connector.publish_message.assert_called_with(
                 {'action': 'action', 'status': 'error', 'error': 'error_message'},
                 routing_key='routing_key',
-                exchange='')
+                exchange='', correlation_id=None)
 
     @mock.patch('imgstorage.imgstoragenas.runCommand')
-    @mock.patch('imgstorage.imgstoragenas.rocks.db.helper.DatabaseHelper.getHostAttr', return_value=False)
+    @mock.patch('imgstorage.host_attributes.get', return_value=False)
     def test_teardown_success(self, mockHostSyncAttr, mockRunCommand):
         zvol = 'vol2'
         mockRunCommand.return_value = StringIO(tgtadm_response%(zvol, zvol))
@@ -135,7 +139,7 @@ class TestNasFunctions(unittest.TestCase):
 
 
     @mock.patch('imgstorage.imgstoragenas.runCommand')
-    @mock.patch('imgstorage.imgstoragenas.rocks.db.helper.DatabaseHelper.getHostAttr', return_value=False)
+    @mock.patch('imgstorage.host_attributes.get', return_value=False)
     def test_teardown_busy(self, mockHostSyncAttr, mockRunCommand):
         zvol = 'vol3_busy'
         mockRunCommand.return_value = StringIO(tgtadm_response%(zvol, zvol))
@@ -156,11 +160,38 @@ class TestNasFunctions(unittest.TestCase):
         self.client.queue_connector.publish_message.assert_called_with(
                 {'action': 'zvol_unmapped', 'status': 'error', 'error': 'ZVol %s is not mapped'%zvol},
                 routing_key='reply_to',
-                exchange='')
+                exchange='', correlation_id=None)
         self.assertFalse(self.check_zvol_busy(zvol))
 
 
 
+    @mock.patch('imgstorage.imgstoragenas.runCommand')
+    @mock.patch('imgstorage.imgstoragenas.NasDaemon.is_sync_node', return_value=False)
+    def test_unmap_zvols_batch(self, mockIsSyncMode, mockRunCommand):
+        mockRunCommand.return_value = (tgtadm_response%('vol2', 'vol2')).splitlines()
+        props = BasicProperties(reply_to='reply_to', message_id='message_id')
+        self.client.unmap_zvols(
+            {'action': 'unmap_zvols', 'zvols': ['vol2', 'vol1', 'vol3_busy']}, props)
+        self.assertTrue(self.check_zvol_busy('vol2'))
+        self.assertFalse(self.check_zvol_busy('vol1'))
+
+        # nothing goes back to the frontend until every zvol is done
+        (args, kwargs) = self.client.queue_connector.publish_message.call_args
+        self.assertEqual(json.loads(args[0])['action'], 'unmap_zvol')
+
+        self.client.zvol_unmapped(
+            {'action': 'zvol_unmapped', 'target': 'iqn.2001-04.com.nas-0-1-vol2', 'zvol': 'vol2', 'status': 'success'},
+            BasicProperties(reply_to='compute-0-3', correlation_id='message_id'))
+        (args, kwargs) = self.client.queue_connector.publish_message.call_args
+        self.assertEqual(kwargs['routing_key'], 'reply_to')
+        self.assertEqual(kwargs['correlation_id'], 'message_id')
+        self.assertEqual(json.loads(args[0]), {'action': 'zvols_unmapped', 'status': 'success', 'body': [
+            {'zvol': 'vol2', 'status': 'success'},
+            {'zvol': 'vol1', 'status': 'error', 'error': 'ZVol vol1 is not mapped'},
+            {'zvol': 'vol3_busy', 'status': 'error', 'error': 'ZVol vol3_busy is busy'}]})
+        self.assertFalse(self.check_zvol_busy('vol2'))
+        self.assertEqual(self.client.batches, {})
+
     @mock.patch('imgstorage.imgstoragenas.runCommand', return_value='')
     def test_del_zvol_success(self, mockRunCommand):
         zvol = 'vol1'
@@ -169,7 +200,7 @@ class TestNasFunctions(unittest.TestCase):
             BasicProperties(reply_to='reply_to'))
 
         self.client.queue_connector.publish_message.assert_called_with(
-            {'action': 'zvol_deleted', 'status': 'success'}, routing_key='reply_to', exchange='')
+            {'action': 'zvol_deleted', 'status': 'success'}, routing_key='reply_to', exchange='', correlation_id=None)
         mockRunCommand.assert_called_with(['zfs', 'destroy', 'mytank/%s'%(zvol), '-r'])
         self.assertFalse(self.check_zvol_busy(zvol))
 
@@ -182,7 +213,7 @@ class TestNasFunctions(unittest.TestCase):
             BasicProperties(reply_to='reply_to'))
         self.client.queue_connector.publish_message.assert_called_with(
             {'action': 'zvol_deleted', 'status': 'error', 'error': 'ZVol %s not found in database'%zvol},
-            routing_key='reply_to', exchange='')
+            routing_key='reply_to', exchange='', correlation_id=None)
         self.assertFalse(self.check_zvol_busy(zvol))
 
 
@@ -194,9 +225,38 @@ class TestNasFunctions(unittest.TestCase):
             BasicProperties(reply_to='reply_to'))
         self.client.queue_connector.publish_message.assert_called_with(
             {'action': 'zvol_deleted', 'status': 'error', 'error': 'Error deleting zvol %s: is mapped'%zvol},
-            routing_key='reply_to', exchange='')
+            routing_key='reply_to', exchange='', correlation_id=None)
         self.assertFalse(self.check_zvol_busy(zvol))
 
+    def list_zvols(self, **message):
+        message['action'] = 'list_zvols'
+        self.client.list_zvols(message, BasicProperties(reply_to='reply_to'))
+        (args, kwargs) = self.client.queue_connector.publish_message.call_args
+        return json.loads(args[0])
+
+    def test_list_zvols_filters(self):
+        reply = self.list_zvols(remotehost='compute-0-3')
+        self.assertEqual([z['zvol'] for z in reply['body']], ['vol2', 'vol3_busy', 'vol4_busy'])
+        self.assertEqual(reply['next'], None)
+
+        reply = self.list_zvols(state='unmapped')
+        self.assertEqual([z['zvol'] for z in reply['body']], ['vol1'])
+        reply = self.list_zvols(zvol='vol2', state='mapped')
+        self.assertEqual([z['zvol'] for z in reply['body']], ['vol2'])
+
+        reply = self.list_zvols(state='wrong')
+        self.assertEqual(reply['status'], 'error')
+
+    def test_list_zvols_pages(self):
+        reply = self.list_zvols(limit=2)
+        self.assertEqual([z['zvol'] for z in reply['body']], ['vol1', 'vol2'])
+        self.assertEqual(reply['next'], 'vol2')
+        reply = self.list_zvols(limit=2, after='vol2')
+        self.assertEqual([z['zvol'] for z in reply['body']], ['vol3_busy', 'vol4_busy'])
+        reply = self.list_zvols(limit=2, after='vol4_busy')
+        self.assertEqual(reply['body'], [])
+        self.assertEqual(reply['next'], None)
+
     @mock.patch('imgstorage.imgstoragenas.runCommand')
     def test_find_iscsi_target_num_not_found(self, mockRunCommand):
         zvol = 'vol1'
@@ -213,6 +273,20 @@ class TestNasFunctions(unittest.TestCase):
         self.assertEqual(self.client.find_iscsi_target_num(target), '1')
 
 
+    @mock.patch('imgstorage.imgstoragenas.runCommand')
+    def test_find_iscsi_target_num_cached(self, mockRunCommand):
+        zvol = 'vol2'
+        target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
+        mockRunCommand.return_value = (tgtadm_response%(zvol, zvol)).splitlines()
+        self.assertEqual(self.client.find_iscsi_target_num(target), '1')
+        self.assertEqual(self.client.find_iscsi_target_num(target), '1')
+        mockRunCommand.assert_called_once_with(['tgtadm', '--op', 'show', '--mode', 'target'])
+
+        self.client.detach_target(target, True)
+        mockRunCommand.assert_called_with(['tgtadm', '--lld', 'iscsi', '--op', 'delete', '--mode', 'target', '--tid', '1'])
+        self.assertEqual(self.client.iscsi_targets.targets, {})
+
+
     @mock.patch('imgstorage.imgstoragenas.runCommand')
     @mock.patch('imgstorage.imgstoragenas.NasDaemon.is_sync_node', return_value=False)
     def test_zvol_unmapped_success(self, mockIsSyncMode, mockRunCommand):
@@ -222,10 +296,73 @@ class TestNasFunctions(unittest.TestCase):
             {'action': 'zvol_unmapped', 'target':target, 'zvol':zvol, 'status':'success'},
             BasicProperties(reply_to='reply_to', correlation_id='message_id'))
         self.client.queue_connector.publish_message.assert_called_with(
-            {'action': 'zvol_unmapped', 'status': 'success'}, routing_key=u'reply_to', exchange='')
+            {'action': 'zvol_unmapped', 'status': 'success'}, routing_key=u'reply_to', exchange='', correlation_id=None)
         self.assertFalse(self.check_zvol_busy(zvol))
 
 
+    def test_reconcile_keeps_targets_changed_while_listing(self):
+        listing = Future()
+        self.client.iscsi_targets.reload(['Target 1: iqn.old'])
+        with mock.patch('imgstorage.imgstoragenas.runCommandBackground', return_value=listing):
+            done = self.client.reconcile_iscsi_targets()
+
+            # a map and a reclaim run while tgtadm lists the targets
+            self.client.iscsi_targets.add('iqn.new', '2')
+            self.client.iscsi_targets.remove('iqn.old')
+
+            listing.set_result((['Target 1: iqn.old', 'Target 3: iqn.other'], ''))
+            IOLoop.instance().run_sync(lambda : done)
+        self.assertEqual(self.client.iscsi_targets.targets, {'iqn.new': '2', 'iqn.other': '3'})
+        self.assertEqual(self.client.iscsi_targets.listings, [])
+
+
+    @mock.patch('imgstorage.imgstoragenas.runCommandBackground')
+    @mock.patch('imgstorage.imgstoragenas.NasDaemon.is_sync_node', return_value=False)
+    def test_zvol_unmapped_reclaims_target_later(self, mockIsSyncMode, mockRunCommand):
+        zvol = 'vol3_busy'
+        target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
+        def my_side_effect(*args, **kwargs):
+            if args[0][:3] == ['tgtadm', '--op', 'show']:  return (tgtadm_response%(zvol, zvol)).splitlines()
+            return []
+
+        mockRunCommand.side_effect = background(my_side_effect)
+        self.client.zvol_unmapped(
+            {'action': 'zvol_unmapped', 'target':target, 'zvol':zvol, 'status':'success'},
+            BasicProperties(reply_to='reply_to', correlation_id='message_id'))
+        self.client.queue_connector.publish_message.assert_called_with(
+            {'action': 'zvol_unmapped', 'status': 'success'}, routing_key=u'reply_to', exchange='', correlation_id=None)
+
+        # the target is deleted by the next reclaim batch
+        self.assertFalse(mockRunCommand.called)
+        self.assertEqual(self.client.detached_targets, set([target]))
+        self.client.queue_connector._connection.add_timeout.assert_called_with(
+            self.client.TARGETS_RECLAIM_DELAY, self.client.reclaim_iscsi_targets)
+
+        self.client.reclaim_iscsi_targets()
+        self.assertEqual(mockRunCommand.mock_calls, [
+            mock.call(['tgtadm', '--op', 'show', '--mode', 'target']),
+            mock.call(['tgtadm', '--lld', 'iscsi', '--op', 'delete', '--mode', 'target', '--tid', '1'])])
+        self.assertEqual(self.client.detached_targets, set())
+        self.assertFalse(self.client.iscsi_targets.targets)
+
+    def test_reclaim_keeps_targets_created_while_listing(self):
+        listing = Future()
+        self.client.iscsi_targets.reload(['Target 1: iqn.old'])
+        self.client.detached_targets.add('iqn.old')
+        with mock.patch('imgstorage.imgstoragenas.runCommandBackground', return_value=listing) as mockRunCommand:
+            done = self.client.reclaim_iscsi_targets()
+
+            # a map creates a target while tgtadm lists the targets
+            self.client.iscsi_targets.add('iqn.new', '2')
+
+            listing.set_result((['Target 1: iqn.old'], ''))
+            IOLoop.instance().run_sync(lambda : done)
+        mockRunCommand.assert_called_with(
+            ['tgtadm', '--lld', 'iscsi', '--op', 'delete', '--mode', 'target', '--tid', '1'])
+        self.assertEqual(self.client.iscsi_targets.targets, {'iqn.new': '2'})
+        self.assertEqual(self.client.detached_targets, set())
+
+
     @mock.patch('imgstorage.imgstoragenas.runCommand')
     def test_zvol_unmapped_got_error(self, mockRunCommand):
         zvol = 'vol3_busy'
@@ -234,7 +371,7 @@ class TestNasFunctions(unittest.TestCase):
             {'action': 'zvol_unmapped', 'target':target, 'zvol':zvol, 'status':'error', 'error':'Some error'},
             BasicProperties(reply_to='reply_to', correlation_id='message_id'))
         self.client.queue_connector.publish_message.assert_called_with(
-            {'action': 'zvol_unmapped', 'status': 'error', 'error': 'Error detaching iSCSI target from compute node: Some error'}, routing_key=u'reply_to', exchange='')
+            {'action': 'zvol_unmapped', 'status': 'error', 'error': 'Error detaching iSCSI target from compute node: Some error'}, routing_key=u'reply_to', exchange='', correlation_id=None)
         self.assertFalse(self.check_zvol_busy(zvol))
 
 
@@ -246,7 +383,7 @@ class TestNasFunctions(unittest.TestCase):
             {'action': 'zvol_mapped', 'target':target, 'bdev': 'sdc', 'status':'success'},
             BasicProperties(reply_to='reply_to', correlation_id='message_id'))
         self.client.queue_connector.publish_message.assert_called_with(
-            {'action': 'zvol_mapped', 'status': 'success', 'bdev': 'sdc'}, routing_key=u'reply_to', exchange='')
+            {'action': 'zvol_mapped', 'status': 'success', 'bdev': 'sdc'}, routing_key=u'reply_to', exchange='', correlation_id=None)
         self.assertFalse(self.check_zvol_busy(zvol))
 
     def test_zvol_mapped_got_error(self):
@@ -256,7 +393,7 @@ class TestNasFunctions(unittest.TestCase):
             {'action': 'zvol_mapped', 'target':target, 'status':'error', 'error':'Some error'},
             BasicProperties(reply_to='reply_to', correlation_id='message_id'))
         self.client.queue_connector.publish_message.assert_called_with(
-            {'action': 'zvol_mapped', 'status': 'error', 'error': 'Error attaching iSCSI target to compute node: Some error'}, routing_key=u'reply_to', exchange='')
+            {'action': 'zvol_mapped', 'status': 'error', 'error': 'Error attaching iSCSI target to compute node: Some error'}, routing_key=u'reply_to', exchange='', correlation_id=None)
         self.assertFalse(self.check_zvol_busy(zvol)) # TODO IS THIS RIGHT?
 
     def check_zvol_busy(self, zvol):
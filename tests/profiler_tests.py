@@ -0,0 +1,85 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+from imgstorage.profiler import Profiler, report
+from imgstorage import profiler
+
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+
+import json
+import tempfile
+import StringIO
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.trace = tempfile.mktemp()
+        self.profiler = Profiler()
+        self.profiler.enable(self.trace)
+
+    def tearDown(self):
+        self.profiler.disable()
+        if os.path.exists(self.trace):
+            os.remove(self.trace)
+
+    def entries(self):
+        with open(self.trace) as f:
+            return [json.loads(line) for line in f]
+
+    def test_disabled(self):
+        self.profiler.disable()
+        request = self.profiler.request('map_zvol', 'id1')
+        with request.context():
+            self.profiler.command(['zfs', 'list'], 0, 0, 10)
+        request.finish()
+        self.assertEqual(self.entries(), [])
+
+    def test_commands_of_request(self):
+        request = self.profiler.request('map_zvol', 'id1')
+        with request.context():
+            self.profiler.command(['/sbin/zfs', 'create', 'tank/vol1'], 0, 0, 0)
+        self.profiler.command(['tgtadm', '--op', 'show'], 0, 1, 100)
+        request.finish()
+        (create, show, done) = self.entries()
+        self.assertEqual((create['action'], create['request'], create['command']), ('map_zvol', 'id1', 'zfs'))
+        self.assertEqual((show['action'], show['returncode'], show['output']), (None, 1, 100))
+        self.assertEqual((done['type'], done['action']), ('request', 'map_zvol'))
+
+    def test_context_follows_callbacks(self):
+        io_loop = IOLoop()
+        request = self.profiler.request('unmap_zvol', 'id2')
+        future = Future()
+        with request.context():
+            io_loop.add_callback(lambda: self.profiler.command(['iscsiadm'], 0, 0))
+        request.finish(future)
+        io_loop.add_callback(io_loop.stop)
+        io_loop.start()
+        io_loop.close()
+        self.assertEqual([e['request'] for e in self.entries()], ['id2'])
+
+        future.set_result(None)
+        self.assertEqual(self.entries()[-1]['type'], 'request')
+        self.assertEqual(profiler.current_request(), None)
+
+    def test_report(self):
+        for request_id in ('id1', 'id2'):
+            request = self.profiler.request('map_zvol', request_id)
+            with request.context():
+                self.profiler.command(['tgtadm', '--op', 'new'], 0, 0)
+            request.finish()
+
+        out = StringIO.StringIO()
+        with open(self.trace) as f:
+            report(f, out)
+        self.assertTrue('map_zvol' in out.getvalue())
+        self.assertTrue('tgtadm' in out.getvalue())
+        self.assertTrue('request id2' in out.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
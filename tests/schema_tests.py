@@ -0,0 +1,81 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+from imgstorage import schema
+
+import uuid
+
+from pysqlite2 import dbapi2 as sqlite3
+
+
+class TestSchema(unittest.TestCase):
+
+    def setUp(self):
+        self.path = '/tmp/test_db_%s' % uuid.uuid4()
+        self.con = sqlite3.connect(self.path)
+
+    def tearDown(self):
+        self.con.close()
+        os.remove(self.path)
+
+    def version(self):
+        return self.con.execute('PRAGMA user_version').fetchone()[0]
+
+    def test_new_database(self):
+        self.assertEqual(schema.upgrade(self.con), 0)
+        self.assertEqual(self.version(), schema.VERSION)
+        cur = self.con.cursor()
+        self.assertTrue('speed' in schema.columns(cur, 'sync_queue'))
+        self.assertTrue('correlation_id' in schema.columns(cur, 'zvol_calls'))
+        self.assertTrue('started' in schema.columns(cur, 'merge_queue'))
+        self.assertTrue('trace' in schema.columns(cur, 'sync_queue'))
+
+        self.assertEqual(schema.upgrade(self.con), schema.VERSION)
+
+    def test_unversioned_vm_database(self):
+        with self.con:
+            self.con.execute('''CREATE TABLE sync_queue(zvol TEXT PRIMARY KEY NOT NULL,
+                iscsi_target TEXT UNIQUE, devsize INT, reply_to TEXT,
+                correlation_id TEXT, started BOOLEAN default 0, time INT)''')
+            self.con.execute('CREATE INDEX sync_queue_time ON sync_queue(time)')
+            self.con.execute('INSERT INTO sync_queue VALUES (?,?,?,?,?,?,?)',
+                ('vol1', 'iqn.2001-04.com.nas-0-1-vol1', 12345, 'reply_to', 'corr_id', 1, 1))
+
+        schema.upgrade(self.con)
+        self.assertEqual(self.con.execute('SELECT zvol, started FROM merge_queue').fetchall(), [('vol1', 1)])
+        self.assertEqual(self.con.execute('SELECT * FROM sync_queue').fetchall(), [])
+        self.assertEqual(self.con.execute("SELECT tbl_name FROM sqlite_master WHERE name = 'sync_queue_time'").fetchall(), [('sync_queue',)])
+
+    def test_unversioned_nas_database(self):
+        with self.con:
+            self.con.execute('CREATE TABLE zvol_calls(zvol TEXT PRIMARY KEY NOT NULL, reply_to TEXT NOT NULL, time INT NOT NULL)')
+            self.con.execute('''CREATE TABLE sync_queue(zvol TEXT PRIMARY KEY NOT NULL, zpool TEXT NOT NULL,
+                remotehost TEXT, is_sending BOOLEAN, is_delete_remote BOOLEAN, time INT)''')
+            self.con.execute("INSERT INTO zvol_calls VALUES ('vol1', 'reply_to', 1)")
+
+        schema.upgrade(self.con)
+        self.assertEqual(self.con.execute('SELECT zvol, correlation_id FROM zvol_calls').fetchall(), [('vol1', None)])
+        self.assertTrue('transferred' in schema.columns(self.con.cursor(), 'sync_queue'))
+
+    def test_sync_priority_of_queued_jobs(self):
+        with self.con:
+            self.con.execute('''CREATE TABLE sync_queue(zvol TEXT PRIMARY KEY NOT NULL, zpool TEXT NOT NULL,
+                remotehost TEXT, is_sending BOOLEAN, is_delete_remote BOOLEAN, time INT)''')
+            for (zvol, is_sending, is_delete_remote) in [('up', 1, 1), ('unmap', 0, 1), ('pull', 0, 0)]:
+                self.con.execute("INSERT INTO sync_queue VALUES (?, 'tank', 'compute-0-1', ?, ?, 1)",
+                    [zvol, is_sending, is_delete_remote])
+
+        schema.upgrade(self.con)
+        self.assertEqual(sorted(self.con.execute('SELECT zvol, priority FROM sync_queue').fetchall()),
+            [('pull', 2), ('unmap', 1), ('up', 0)])
+
+    def test_newer_database(self):
+        self.con.execute('PRAGMA user_version = %d' % (schema.VERSION + 1))
+        self.assertRaises(Exception, schema.upgrade, self.con)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+from imgstorage.statestore import StateStore
+
+import glob
+import threading
+import uuid
+
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = '/tmp/test_db_%s' % uuid.uuid4()
+        self.state = StateStore(self.path)
+
+    def tearDown(self):
+        self.state.close()
+        for f in glob.glob(self.path + '*'):
+            os.remove(f)
+
+    def test_connection_per_thread(self):
+        con = self.state.connect()
+        self.assertTrue(con is self.state.connect())
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.state.connect()))
+        thread.start()
+        thread.join()
+        self.assertFalse(con is other[0])
+
+    def test_wal(self):
+        con = self.state.connect()
+        self.assertEqual(con.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(con.execute('PRAGMA synchronous').fetchone()[0], 1)
+
+    def test_commit_keeps_connection(self):
+        with self.state.connect() as con:
+            con.execute('CREATE TABLE zvols(zvol TEXT PRIMARY KEY NOT NULL)')
+            con.execute('INSERT INTO zvols VALUES (?)', ['vol1'])
+        try:
+            with self.state.connect() as con:
+                con.execute('INSERT INTO zvols VALUES (?)', ['vol2'])
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(self.state.connect().execute('SELECT zvol FROM zvols').fetchall(), [('vol1',)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,7 @@ from mock import MagicMock, ANY
 import mock
 from imgstorage.imgstoragenas import NasDaemon
 from imgstorage.rabbitmqclient import RabbitMQCommonClient
+from imgstorage import ActionError
 
 import uuid
 import time
@@ -49,9 +50,9 @@ class TestSyncFunctions(unittest.TestCase):
             cur.execute('INSERT INTO zvols VALUES (?,?,?,?) ',('vol1', None, None, None))
             cur.execute('INSERT INTO zvols VALUES (?,?,?,?) ',('vol2', 'my_tank', None, 'compute-0-1'))
             cur.execute('INSERT INTO zvols VALUES (?,?,?,?) ',('vol3_busy', 'my_tank', None, 'compute-0-1'))
-            cur.execute('INSERT INTO zvol_calls VALUES (?,?,?)',('vol3_busy', 'reply_to', time.time()))
+            cur.execute('INSERT INTO zvol_calls(zvol, reply_to, time) VALUES (?,?,?)',('vol3_busy', 'reply_to', time.time()))
             cur.execute('INSERT INTO zvols VALUES (?,?,?,?) ',('vol4_busy', 'my_tank', 'iqn.2001-04.com.nas-0-1-vol4_busy', 'compute-0-1'))
-            cur.execute('INSERT INTO zvol_calls VALUES (?,?,?)',('vol4_busy', 'reply_to', time.time()))
+            cur.execute('INSERT INTO zvol_calls(zvol, reply_to, time) VALUES (?,?,?)',('vol4_busy', 'reply_to', time.time()))
             con.commit()
 
     def tearDown(self):
@@ -134,7 +135,7 @@ class TestSyncFunctions(unittest.TestCase):
         self.nas_client.schedule_next_sync()
 
         self.nas_client.queue_connector.publish_message.assert_called_with(
-            {'action': 'zvol_mapped', 'bdev':bdev, 'status': 'success'}, routing_key='reply_to', exchange='')
+            {'action': 'zvol_mapped', 'bdev':bdev, 'status': 'success'}, routing_key='reply_to', exchange='', correlation_id=None)
 
         self.assertTrue(self.check_zvol_busy(zvol))
         with sqlite3.connect(self.nas_client.SQLITE_DB) as con:
@@ -150,7 +151,7 @@ class TestSyncFunctions(unittest.TestCase):
         mock_run_command.return_value = (iscsiadm_session_response%(target, zvol)).splitlines()
         with sqlite3.connect(self.nas_client.SQLITE_DB) as con:
             cur = con.cursor()
-            cur.execute('INSERT INTO sync_queue VALUES(?,?,?,0,0,1)',[zvol, 'my_tank', 'compute-0-3'])
+            cur.execute('INSERT INTO sync_queue(zvol, zpool, remotehost, is_sending, is_delete_remote, time) VALUES(?,?,?,0,0,1)',[zvol, 'my_tank', 'compute-0-3'])
             con.commit()
 
             self.nas_client.zvol_unmapped(
@@ -169,6 +170,40 @@ class TestSyncFunctions(unittest.TestCase):
             print mock_run_command.mock_calls
             mock_run_command.assert_any_call(['su', 'img-storage', '-c', '/usr/bin/ssh compute-0-3 "/sbin/zfs destroy my_tank/%s -r"'%zvol])
 
+    def test_sync_queue_priorities(self):
+        self.nas_client.upload_snapshot = MagicMock()
+        self.nas_client.download_snapshot = MagicMock()
+        self.nas_client.SYNC_WORKERS = 3
+        self.nas_client.SYNC_PULL_WORKERS = 1
+        with sqlite3.connect(self.nas_client.SQLITE_DB) as con:
+            for (zvol, is_sending, priority, queued, estimate) in [
+                    ('pull_big', 0, 2, 1, 500 * 1024 ** 3),
+                    ('pull_small', 0, 2, 2, 1024 ** 3),
+                    ('unmap', 0, 1, 3, 10 * 1024 ** 3),
+                    ('upload', 1, 0, 4, 1024 ** 3)]:
+                con.execute('''INSERT INTO sync_queue(zvol, zpool, remotehost, is_sending,
+                    is_delete_remote, time, priority, estimate) VALUES(?,?,?,?,0,?,?,?)''',
+                    [zvol, 'my_tank', 'compute-0-1', is_sending, queued, priority, estimate])
+            con.commit()
+
+        # the big pull waits, the last worker is kept for uploads and unmaps
+        self.nas_client.schedule_next_sync()
+        self.nas_client.pool.close()
+        self.nas_client.pool.join()
+        self.assertEqual(sorted(self.nas_client.results.keys()), ['pull_small', 'unmap', 'upload'])
+
+    @mock.patch('imgstorage.imgstoragenas.IOLoop')
+    def test_sync_job_wakes_scheduler(self, mock_ioloop):
+        job = MagicMock(side_effect=ActionError('ssh failed'))
+        result = self.nas_client.pool.apply_async(self.nas_client.sync_job,
+                [job, 'my_tank', 'vol2', 'compute-0-1'], callback=self.nas_client.wake_sync)
+        self.nas_client.pool.close()
+        self.nas_client.pool.join()
+
+        job.assert_called_with('my_tank', 'vol2', 'compute-0-1')
+        self.assertTrue(isinstance(result.get(), ActionError))
+        mock_ioloop.instance().add_callback.assert_called_with(self.nas_client.process_sync_queue)
+
 
     @mock.patch('imgstorage.imgstoragenas.runCommand', return_value=
             ("my_tank/vm-hpcdev-pub03-1-vol@aaa\n"+
@@ -0,0 +1,78 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+from imgstorage import tracing
+
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+
+import logging
+import StringIO
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.log = StringIO.StringIO()
+        self.handler = logging.StreamHandler(self.log)
+        self.handler.setFormatter(logging.Formatter("'%(levelname) -10s %(name) -30s: %(message)s'"))
+        tracing.LOGGER.addHandler(self.handler)
+        tracing.LOGGER.setLevel(logging.INFO)
+
+    def tearDown(self):
+        tracing.LOGGER.removeHandler(self.handler)
+
+    def spans(self):
+        return tracing.read_spans(self.log.getvalue().splitlines())
+
+    def test_new_trace(self):
+        span = tracing.Span('map_zvol')
+        self.assertTrue(span.trace)
+        self.assertNotEqual(span.trace, tracing.Span('map_zvol').trace)
+
+    def test_span_logged(self):
+        span = tracing.Span('map_zvol', 'trace1', zvol='vol1', to=None)
+        span.finish()
+        [logged] = self.spans()['trace1']
+        self.assertEqual((logged['name'], logged['zvol']), ('map_zvol', 'vol1'))
+        self.assertFalse('to' in logged)
+        self.assertFalse('error' in logged)
+
+    def test_context_follows_callbacks(self):
+        io_loop = IOLoop()
+        span = tracing.Span('unmap_zvol', 'trace2')
+        seen = []
+        with span.context():
+            io_loop.add_callback(lambda: seen.append(tracing.current_trace()))
+        io_loop.add_callback(io_loop.stop)
+        io_loop.start()
+        io_loop.close()
+        self.assertEqual(seen, ['trace2'])
+        self.assertEqual(tracing.current_trace(), None)
+
+    def test_child_span_inherits_trace(self):
+        with tracing.Span('zvol_mapped', 'trace3').context():
+            self.assertEqual(tracing.Span('sync_zvol').trace, 'trace3')
+
+    def test_future_error(self):
+        future = Future()
+        tracing.Span('sync_zvol', 'trace4').finish(future)
+        self.assertEqual(self.spans(), {})
+        future.set_exception(Exception('merge failed'))
+        self.assertEqual(self.spans()['trace4'][0]['error'], 'merge failed')
+
+    def test_timeline(self):
+        for (name, trace) in (('map_zvol', 'trace5'), ('zvol_mapped', 'trace5'), ('list_zvols', 'other')):
+            tracing.Span(name, trace).finish()
+        spans = self.spans()
+        self.assertEqual([span['name'] for span in spans['trace5']], ['map_zvol', 'zvol_mapped'])
+        out = StringIO.StringIO()
+        tracing.timeline(spans['trace5'], out)
+        self.assertTrue(out.getvalue().startswith('trace trace5'))
+
+if __name__ == '__main__':
+    unittest.main()
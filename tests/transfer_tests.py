@@ -0,0 +1,80 @@
+#!/opt/rocks/bin/python
+
+import sys, os
+lib_path = os.path.abspath('src/img-storage')
+sys.path.insert(1, lib_path)
+
+import unittest
+from mock import MagicMock
+import mock
+from imgstorage import ActionError
+from imgstorage.zfstransfer import ZfsTransfer, parse_rate
+
+import shutil
+import tempfile
+
+
+class TestZfsTransfer(unittest.TestCase):
+    """ZfsTransfer with zfs send and receive replaced by cat"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'source')
+        self.dest = os.path.join(self.tmpdir, 'dest')
+        with open(self.source, 'w') as f:
+            f.write('x' * (3 * ZfsTransfer.BLOCK_SIZE + 17))
+
+        self.progress = MagicMock()
+        self.transfer = ZfsTransfer('tank/vol', progress=self.progress)
+        self.transfer.zfs = self.fake_zfs
+        self.failures = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fake_zfs(self, host, args):
+        if args[0] == 'send' and args[1] == '-nP':
+            return ['echo', 'size\t%s' % os.path.getsize(self.source)]
+        elif args[0] == 'send':
+            if self.failures:
+                self.failures -= 1
+                return ['sh', '-c', 'head -c 1000 %s; exit 1' % self.source]
+            return ['cat', self.source]
+        elif args[0] == 'receive':
+            return ['sh', '-c', 'cat >> %s' % self.dest]
+        elif args[0] == 'get':
+            return ['echo', '1-abcdef-token']
+
+    def test_send(self):
+        self.transfer.send('tank/vol@snap')
+        with open(self.dest) as f:
+            self.assertEqual(len(f.read()), os.path.getsize(self.source))
+        (transferred, size, speed) = self.progress.call_args[0]
+        self.assertEqual(transferred, os.path.getsize(self.source))
+        self.assertEqual(size, os.path.getsize(self.source))
+
+    def test_send_throttled(self):
+        self.transfer.flow = MagicMock()
+        self.transfer.send('tank/vol@snap')
+        self.assertEqual(sum(c[0][0] for c in self.transfer.flow.throttle.call_args_list),
+            os.path.getsize(self.source))
+
+    def test_send_resumes_after_failure(self):
+        self.failures = 1
+        self.transfer.stream = MagicMock(wraps=self.transfer.stream)
+        self.transfer.send('tank/vol@snap2', 'tank/vol@snap1')
+        self.assertEqual([c[0][0] for c in self.transfer.stream.call_args_list],
+            [['-i', 'tank/vol@snap1', 'tank/vol@snap2'], ['-t', '1-abcdef-token']])
+
+    def test_send_gives_up(self):
+        self.failures = ZfsTransfer.RETRIES + 1
+        self.assertRaises(ActionError, self.transfer.send, 'tank/vol@snap')
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('500'), 500)
+        self.assertEqual(parse_rate('10m'), 10 * 1024 ** 2)
+        self.assertEqual(parse_rate('1G'), 1024 ** 3)
+        self.assertRaises(ValueError, parse_rate, 'fast')
+
+if __name__ == '__main__':
+    unittest.main()
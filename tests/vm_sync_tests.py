@@ -5,9 +5,10 @@ lib_path = os.path.abspath('src/img-storage')
 sys.path.insert(1, lib_path)
 
 import unittest
+from helpers import background
 from mock import MagicMock, ANY
 import mock
-from imgstorage.imgstoragevm import VmDaemon
+from imgstorage.imgstoragevm import VmDaemon, BlockDeviceIndex
 from imgstorage.rabbitmqclient import RabbitMQCommonClient
 
 import uuid
@@ -18,6 +19,7 @@ from pysqlite2 import dbapi2 as sqlite3
 from pika.spec import BasicProperties
 from StringIO import StringIO
 
+
 class TestVmSyncFunctions(unittest.TestCase):
 
     def mock_rabbitcli(self, exchange, exchange_type, process_message=None):
@@ -33,21 +35,22 @@ class TestVmSyncFunctions(unittest.TestCase):
         self.vm_client.process_message = MagicMock()
         
         self.vm_client.ZPOOL = 'tank'
+        self.vm_client.blk_devs = BlockDeviceIndex('/nonexistent')
         self.vm_client.SQLITE_DB = '/tmp/test_db_%s'%uuid.uuid4()
         self.vm_client.run()
 
     def tearDown(self):
         os.remove(self.vm_client.SQLITE_DB)
 
-    @mock.patch('imgstorage.imgstoragevm.runCommand')
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
     def test_run_sync_initial_synced(self, mockRunCommand):
         zvol = 'vm-hpcdev-pub03-1-vol'
         target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
         bdev = 'sdc'
-        mockRunCommand.side_effect = self.create_iscsiadm_side_effect(target, bdev, 1)
+        mockRunCommand.side_effect = background(self.create_iscsiadm_side_effect(target, bdev))
         with sqlite3.connect(self.vm_client.SQLITE_DB) as con:
             cur = con.cursor()
-            cur.execute('INSERT INTO sync_queue VALUES (?,?,?,?,?,?,?)',(zvol, 'iqn.2001-04.com.nas-0-1-%s'%zvol, 12345, 'reply_to', 'corr_id', 0, 1))
+            cur.execute('INSERT INTO merge_queue VALUES (?,?,?,?,?,?,?)',(zvol, 'iqn.2001-04.com.nas-0-1-%s'%zvol, 12345, 'reply_to', 'corr_id', 0, 1))
             con.commit()
 
 
@@ -61,19 +64,19 @@ class TestVmSyncFunctions(unittest.TestCase):
         mockRunCommand.assert_any_call(['iscsiadm', '-m', 'node', '-T', 'iqn.2001-04.com.nas-0-1-%s'%zvol, '-u'])
 
         print  mockRunCommand.call_count
-        assert 10 == mockRunCommand.call_count
+        assert 9 == mockRunCommand.call_count
         self.vm_client.queue_connector.publish_message.assert_called_with({'action': 'zvol_synced', 'status': 'success', 'zvol': zvol}, u'reply_to', correlation_id=u'corr_id')
 
 
-    @mock.patch('imgstorage.imgstoragevm.runCommand')
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
     def test_run_sync_initial_not_synced(self, mockRunCommand):
         zvol = 'vm-hpcdev-pub03-2-vol'
         target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
         bdev = 'sdc'
-        mockRunCommand.side_effect = self.create_iscsiadm_side_effect(target, bdev, 2)
+        mockRunCommand.side_effect = background(self.create_iscsiadm_side_effect(target, bdev))
         with sqlite3.connect(self.vm_client.SQLITE_DB) as con:
             cur = con.cursor()
-            cur.execute('INSERT INTO sync_queue VALUES (?,?,?,?,?,?,?)',(zvol, 'iqn.2001-04.com.nas-0-1-%s'%zvol, 12345, 'reply_to', 'corr_id', 0, 1))
+            cur.execute('INSERT INTO merge_queue VALUES (?,?,?,?,?,?,?)',(zvol, 'iqn.2001-04.com.nas-0-1-%s'%zvol, 12345, 'reply_to', 'corr_id', 0, 1))
             con.commit()
 
 
@@ -82,52 +85,77 @@ class TestVmSyncFunctions(unittest.TestCase):
         mockRunCommand.assert_any_call(['dmsetup', 'suspend', '/dev/mapper/%s-snap'%zvol])
         mockRunCommand.assert_any_call(['dmsetup', 'reload', '/dev/mapper/%s-snap'%zvol, '--table', '0 12345 snapshot-merge /dev/zvol/tank/%s /dev/zvol/tank/%s-temp-write P 16'%(zvol, zvol)])
         mockRunCommand.assert_any_call(['dmsetup', 'resume', '/dev/mapper/%s-snap'%zvol])
+        mockRunCommand.assert_any_call(['dmsetup', 'wait', '%s-snap'%zvol, '0'])
 
         print  mockRunCommand.call_count
-        assert 4 == mockRunCommand.call_count
+        assert 6 == mockRunCommand.call_count
         assert not self.vm_client.queue_connector.publish_message.called, 'rabbotmq message was sent and should not have been'
 
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
+    def test_run_sync_parallel(self, mockRunCommand):
+        zvols = ['vm-hpcdev-pub03-2-vol', 'vm-hpcdev-pub03-1-vol', 'vm-hpcdev-pub03-3-vol']
+        mockRunCommand.side_effect = background(self.create_iscsiadm_side_effect('target', 'sdc'))
+        self.vm_client.SYNC_WORKERS = 2
+        with sqlite3.connect(self.vm_client.SQLITE_DB) as con:
+            cur = con.cursor()
+            for (i, zvol) in enumerate(zvols):
+                cur.execute('INSERT INTO merge_queue VALUES (?,?,?,?,?,?,?)',(zvol, 'iqn.2001-04.com.nas-0-1-%s'%zvol, 12345, 'reply_to', 'corr_%s'%zvol, 0, i))
+            con.commit()
+
+        self.vm_client.run_sync()
+        print mockRunCommand.mock_calls
+        mockRunCommand.assert_any_call(['dmsetup', 'suspend', '/dev/mapper/%s-snap'%zvols[0]])
+        mockRunCommand.assert_any_call(['dmsetup', 'suspend', '/dev/mapper/%s-snap'%zvols[1]])
+        assert mock.call(['dmsetup', 'suspend', '/dev/mapper/%s-snap'%zvols[2]]) not in mockRunCommand.mock_calls
+        assert 1 == mockRunCommand.mock_calls.count(mock.call(['dmsetup', 'status']))
+
+        self.vm_client.queue_connector.publish_message.assert_called_once_with({'action': 'zvol_synced', 'status': 'success', 'zvol': zvols[1]}, u'reply_to', correlation_id=u'corr_%s'%zvols[1])
+        self.assertEqual(self.vm_client.merges.keys(), [zvols[0]])
+        self.assertEqual(self.vm_client.merges[zvols[0]]['progress'], 0)
+        with sqlite3.connect(self.vm_client.SQLITE_DB) as con:
+            cur = con.cursor()
+            cur.execute('SELECT zvol, started FROM merge_queue ORDER BY time')
+            self.assertEqual(cur.fetchall(), [(zvols[0], 1), (zvols[2], 0)])
+
     """ Testing zvol sync """
-    @mock.patch('imgstorage.imgstoragevm.runCommand')
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
     @mock.patch('imgstorage.imgstoragevm.time.time',return_value=111)
     def test_sync_zvol_success(self, mockTime, mockRunCommand):
         zvol= 'vm-hpcdev-pub03-1-vol'
         target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
         bdev = 'sdc'
-        mockRunCommand.side_effect = self.create_iscsiadm_side_effect(target, bdev)
+        mockRunCommand.side_effect = background(self.create_iscsiadm_side_effect(target, bdev))
         self.vm_client.sync_zvol(
             {'action': 'sync_zvol', 'zvol':zvol, 'target':target},
             BasicProperties(reply_to='reply_to', message_id='message_id'))
         with sqlite3.connect(self.vm_client.SQLITE_DB) as con:
             cur = con.cursor()
-            cur.execute('SELECT * FROM sync_queue')
+            cur.execute('SELECT * FROM merge_queue')
             self.assertSequenceEqual(cur.fetchone(), [zvol, target, 12345, 'reply_to','message_id',0,111])
 
     
-    @mock.patch('imgstorage.imgstoragevm.runCommand')
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
     def test_get_dev_list(self, mockRunCommand):
         zvol= 'vm-hpcdev-pub03-1-vol'
         target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
         bdev = 'sdc'
-        mockRunCommand.side_effect = self.create_iscsiadm_side_effect(target, bdev)
-        dev_list = self.vm_client.get_dev_list()
+        mockRunCommand.side_effect = background(self.create_iscsiadm_side_effect(target, bdev))
+        dev_list = self.vm_client.get_dev_list().result()
         self.assertEqual(dev_list, {
             zvol: {'status': 'snapshot-merge', 'target': target, 'dev': '%s-snap'%zvol, 'synced': '32/73400320 32', 'bdev': bdev, 'size': 36}, 
             'vm-hpcdev-pub03-4-vol': {'status': 'linear', 'dev': 'vm-hpcdev-pub03-4-vol-snap', 'size': 36}, 
             'vm-hpcdev-pub03-2-vol': {'status': 'snapshot-merge', 'synced': '1321232/73400320 2592', 'dev': 'vm-hpcdev-pub03-2-vol-snap', 'size': 36}
         })
-        print self.vm_client.get_dev_list()
+        print dev_list
 
-    def create_iscsiadm_side_effect(self, target, bdev, dmsetup_return_line=None):
+    def create_iscsiadm_side_effect(self, target, bdev):
         def iscsiadm_side_effect(*args, **kwargs):
             if args[0][:3] == ['iscsiadm', '-m', 'session']:        return (iscsiadm_session_response%(target, bdev)).splitlines() # list local devices
             elif args[0][:3] == ['iscsiadm', '-m', 'discovery']:    return (iscsiadm_discovery_response%target).splitlines() # find remote targets
             elif args[0][:3] == ['iscsiadm', '-m', 'node']:         return '\n'.splitlines() # connect to iscsi target
-            elif args[0][:2] == ['dmsetup', 'status']:
-                if(not dmsetup_return_line):
-                    return dmsetup_status_response.splitlines()
-                else:
-                    return [dmsetup_status_response.splitlines()[dmsetup_return_line][len('vm-hpcdev-pub03-1-vol-snap: '):]]
+            elif args[0][:2] == ['dmsetup', 'status']:              return dmsetup_status_response.splitlines()
+            elif args[0][:2] == ['dmsetup', 'info']:                return ['  0']
+            elif args[0][:2] == ['dmsetup', 'wait']:                return []
             elif args[0][0] == 'blockdev':                          return '12345'.splitlines()
         return iscsiadm_side_effect
 
@@ -136,7 +164,7 @@ class TestVmSyncFunctions(unittest.TestCase):
     def check_zvol_busy(self, zvol):
         with sqlite3.connect(self.vm_client.SQLITE_DB) as con:
             cur = con.cursor()
-            cur.execute('SELECT count(*) from sync_queue where zvol = ?',[zvol])
+            cur.execute('SELECT count(*) from merge_queue where zvol = ?',[zvol])
             num_rows = cur.fetchone()[0]
             return num_rows > 0
 
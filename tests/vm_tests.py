@@ -5,20 +5,24 @@ lib_path = os.path.abspath('src/img-storage')
 sys.path.insert(1, lib_path)
 
 import unittest
+from helpers import background
 from mock import MagicMock, ANY
 import mock
-from imgstorage.imgstoragevm import VmDaemon
+from imgstorage.imgstoragevm import VmDaemon, BlockDeviceIndex
 from imgstorage.rabbitmqclient import RabbitMQCommonClient
-from imgstorage import ActionError
+from imgstorage import ActionError, FileUsage
 
 import uuid
 import time
+import shutil
+import tempfile
 
 from pysqlite2 import dbapi2 as sqlite3
 
 from pika.spec import BasicProperties
 from StringIO import StringIO
 
+
 class TestVmFunctions(unittest.TestCase):
 
     def mock_rabbitcli(self, exchange, exchange_type, process_message=None):
@@ -35,24 +39,25 @@ class TestVmFunctions(unittest.TestCase):
 
         self.client.run()
 
+        self.client.blk_devs = BlockDeviceIndex('/nonexistent')
         self.client.SQLITE_DB = '/tmp/test_db_%s'%uuid.uuid4()
         self.client.run()
 
         with sqlite3.connect(self.client.SQLITE_DB) as con:
             cur = con.cursor()
-            cur.execute('INSERT INTO sync_queue VALUES (?,?,?,?,?,?,?)',('vol1', 'iqn.2001-04.com.nas-0-1-vol1', 12345, 'reply_to', 'corr_id', 0, 1))
+            cur.execute('INSERT INTO merge_queue VALUES (?,?,?,?,?,?,?)',('vol1', 'iqn.2001-04.com.nas-0-1-vol1', 12345, 'reply_to', 'corr_id', 0, 1))
             con.commit()
 
 
     """ Testing mapping of zvol """
-    @mock.patch('imgstorage.imgstoragevm.runCommand')
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
     @mock.patch('imgstorage.imgstoragevm.VmDaemon.is_sync_enabled', return_value=False)
     def test_map_zvol_createnew_success(self, mockSyncEnabled, mockRunCommand):
         zvol = 'vol2'
         target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
         bdev = 'sdc'
 
-        mockRunCommand.side_effect = self.create_iscsiadm_side_effect(target, bdev)
+        mockRunCommand.side_effect = background(self.create_iscsiadm_side_effect(target, bdev))
         self.client.map_zvol(
             {'action': 'map_zvol', 'target':target, 'nas': 'nas-0-1', 'size':'35', 'zvol':zvol},
             BasicProperties(reply_to='reply_to', message_id='message_id'))
@@ -64,14 +69,14 @@ class TestVmFunctions(unittest.TestCase):
         assert 3 == mockRunCommand.call_count
 
     """ Testing mapping of zvol for missing block device """
-    @mock.patch('imgstorage.imgstoragevm.runCommand')
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
     @mock.patch('imgstorage.imgstoragevm.VmDaemon.is_sync_enabled', return_value=False)
     def test_map_zvol_createnew_missing_blkdev_error(self, mockSyncEnabled, mockRunCommand):
         zvol = 'vol2'
         target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
         bdev = 'sdc'
 
-        mockRunCommand.side_effect = self.create_iscsiadm_side_effect(target+"_missing_target", bdev)
+        mockRunCommand.side_effect = background(self.create_iscsiadm_side_effect(target+"_missing_target", bdev))
         self.client.map_zvol(
             {'action': 'map_zvol', 'target':target, 'nas': 'nas-0-1', 'size':'35', 'zvol':zvol},
             BasicProperties(reply_to='reply_to', message_id='message_id'))
@@ -81,13 +86,13 @@ class TestVmFunctions(unittest.TestCase):
             'reply_to', reply_to=self.client.NODE_NAME, correlation_id='message_id')
 
     """ Testing unmapping of zvol """
-    @mock.patch('imgstorage.imgstoragevm.runCommand')
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
     def test_unmap_zvol_success(self, mockRunCommand):
         zvol = 'vol2'
         target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
         bdev = 'sdc'
 
-        mockRunCommand.side_effect = self.create_iscsiadm_side_effect(target, bdev)
+        mockRunCommand.side_effect = background(self.create_iscsiadm_side_effect(target, bdev))
         self.client.unmap_zvol(
             {'action': 'unmap_zvol', 'target':target, 'zvol':zvol},
             BasicProperties(reply_to='reply_to', message_id='message_id'))
@@ -98,13 +103,13 @@ class TestVmFunctions(unittest.TestCase):
         mockRunCommand.assert_any_call(['iscsiadm', '-m', 'session', '-P3'])
 
     """ Testing unmapping of zvol when not found - still returns success """
-    @mock.patch('imgstorage.imgstoragevm.runCommand')
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
     def test_unmap_zvol_not_found(self, mockRunCommand):
         zvol = 'vol2'
         target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
         bdev = 'sdc'
 
-        mockRunCommand.side_effect = self.create_iscsiadm_side_effect(target, bdev)
+        mockRunCommand.side_effect = background(self.create_iscsiadm_side_effect(target, bdev))
         self.client.unmap_zvol(
             {'action': 'unmap_zvol', 'target':target+"not_found", 'zvol':zvol},
             BasicProperties(reply_to='reply_to', message_id='message_id'))
@@ -115,7 +120,7 @@ class TestVmFunctions(unittest.TestCase):
 
 
     """ Testing unmapping of zvol with error from system call """
-    @mock.patch('imgstorage.imgstoragevm.runCommand')
+    @mock.patch('imgstorage.imgstoragevm.runCommandBackground')
     def test_map_zvol_unmap_error(self, mockRunCommand):
         zvol = 'vol2'
         target = 'iqn.2001-04.com.nas-0-1-%s'%zvol
@@ -126,7 +131,7 @@ class TestVmFunctions(unittest.TestCase):
             elif args[0][:3] == ['iscsiadm', '-m', 'node']:
                 raise ActionError('Some error happened')
 
-        mockRunCommand.side_effect = my_side_effect
+        mockRunCommand.side_effect = background(my_side_effect)
         self.client.unmap_zvol(
             {'action': 'unmap_zvol', 'target':target, 'zvol':zvol},
             BasicProperties(reply_to='reply_to', message_id='message_id'))
@@ -135,6 +140,42 @@ class TestVmFunctions(unittest.TestCase):
             'reply_to', reply_to=self.client.NODE_NAME,  correlation_id='message_id')
         mockRunCommand.assert_called_with(['iscsiadm', '-m', 'node', '-T', target, '-u'])
 
+    def test_block_device_index(self):
+        sysfs = '/tmp/test_sysfs_%s'%uuid.uuid4()
+        def add_session(session, target, bdev=None):
+            os.makedirs(os.path.join(sysfs, session, 'device', 'target5:0:0', '5:0:0:0'))
+            with open(os.path.join(sysfs, session, 'targetname'), 'w') as f:
+                f.write(target + '\n')
+            if bdev:
+                os.makedirs(os.path.join(sysfs, session, 'device', 'target5:0:0', '5:0:0:1', 'block', bdev))
+        try:
+            add_session('session1', 'iqn.2001-04.com.nas-0-1-vol1', 'sdb')
+            add_session('session2', 'iqn.2001-04.com.nas-0-1-vol2')
+            index = BlockDeviceIndex(sysfs)
+            self.assertEqual(index.mappings(), {'iqn.2001-04.com.nas-0-1-vol1': 'sdb'})
+
+            # the kernel attaches the disk of session2 later on
+            os.makedirs(os.path.join(sysfs, 'session2', 'device', 'target5:0:0', '5:0:0:1', 'block', 'sdc'))
+            self.assertEqual(index.mappings(), {'iqn.2001-04.com.nas-0-1-vol1': 'sdb',
+                'iqn.2001-04.com.nas-0-1-vol2': 'sdc'})
+
+            shutil.rmtree(os.path.join(sysfs, 'session1'))
+            self.assertEqual(index.mappings(), {'iqn.2001-04.com.nas-0-1-vol2': 'sdc'})
+        finally:
+            shutil.rmtree(sysfs)
+
+    def test_file_usage(self):
+        (fd, path) = tempfile.mkstemp()
+        try:
+            usage = FileUsage(path)
+            self.assertEqual(usage.holder(), '/proc/%d/fd/%d'%(os.getpid(), fd))
+            self.assertTrue(usage.is_used())
+            os.close(fd)
+            self.assertFalse(usage.is_used())
+        finally:
+            os.remove(path)
+        self.assertRaises(OSError, FileUsage, path)
+
     def create_iscsiadm_side_effect(self, target, bdev):
         def iscsiadm_side_effect(*args, **kwargs):
             if args[0][:3] == ['iscsiadm', '-m', 'session']:        return (iscsiadm_session_response%(target, bdev)).splitlines() # list local devices